@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from lyamc.catalogue import compact, load_catalogue
+from lyamc.output import PhotonStore
+
+# Shards of the photon catalogue (lyamc.catalogue) are keyed by their file name: a chunk that is
+# written again after it went into the catalogue, like a requeued chunk of a work queue, replaces
+# its rows instead of adding duplicates.
+
+outdir = tempfile.mkdtemp()
+name, mode = 'test', 'zm'
+
+
+def write_chunk(j, n):
+    '''Writes chunk j with n photons the way lyamc.scheduler does, photon ids go into x'''
+    with PhotonStore(os.path.join(outdir, '%s_queue%06d_%s_last' % (name, j, mode)), chunk_size=n,
+                     background=False) as store:
+        store.append(np.zeros([n, 3]), np.zeros([n, 3]), 10. * j + np.arange(n), np.ones(n, dtype=int))
+
+
+try:
+    for j in range(3):
+        write_chunk(j, 10)
+    assert compact(name, mode, outdir) == 30
+    # chunk 1 runs again after the compaction, and a new chunk arrives
+    write_chunk(1, 10)
+    write_chunk(3, 5)
+    assert compact(name, mode, outdir) == 35
+    x = load_catalogue(name, mode, outdir)[2]
+    assert len(np.unique(x)) == len(x) == 35, 'duplicate photons in the catalogue'
+    # a rerun of a different size replaces the old rows as well
+    write_chunk(0, 4)
+    assert compact(name, mode, outdir) == 29
+    x = load_catalogue(name, mode, outdir)[2]
+    assert np.array_equal(np.sort(x), np.sort(np.concatenate([np.arange(4.), 10. + np.arange(10),
+                                                              20. + np.arange(10), 30. + np.arange(5)])))
+    # nothing new: the catalogue is not rewritten
+    assert compact(name, mode, outdir) == 29
+    # all shards and PhotonStore manifests are gone
+    assert sorted(os.listdir(outdir)) == ['%s_%s_catalogue' % (name, mode), '%s_%s_catalogue.lock' % (name, mode)]
+finally:
+    shutil.rmtree(outdir)
+print('requeued chunks replace their rows in the catalogue')
@@ -0,0 +1,49 @@
+import sys
+
+import numpy as np
+from scipy.stats import ks_2samp
+
+from lyamc.analytical import Dijkstra_sphere_test
+from lyamc.diffusion import run_photons_diffusion
+from lyamc.general import get_a, sigmaa0, cm_in_pc
+from lyamc.geometry import Zheng_sphere
+from lyamc.kernel import run_photons
+
+# Hybrid transport (lyamc.diffusion) in a static homogeneous sphere with a * tau0 = 1e4, tested
+# against the diffusion solution of Dijkstra et al. (2006) for a central source. With the argument
+# 'explicit' the hybrid spectra are also compared with the explicit scatterings of lyamc.kernel
+# for a central source and for a source at R / 2, whose diffusion steps use spheres inside the
+# medium; the explicit runs take about 6 s per photon.
+
+T, atau0 = 100., 1e4
+a = get_a(T)
+tau0 = atau0 / a
+geom = Zheng_sphere(nbar=tau0 / (sigmaa0(T) * cm_in_pc), T=T, R=1.)
+
+nsim = 20000
+x = run_photons_diffusion(geom, nsim, seed=1, N=10 ** 8)[2]
+
+# expected counts in bins of |x|
+edges = np.linspace(0., 60., 31)
+fine = np.linspace(0., edges[-1], 30001)
+J = Dijkstra_sphere_test(fine, a, tau0)
+cum = np.concatenate([[0.], np.cumsum((J[1:] + J[:-1]) / 2. * np.diff(fine))])
+expected = nsim * np.diff(np.interp(edges, fine, cum)) / cum[-1]
+counts = np.histogram(np.abs(x), edges)[0]
+use = expected > 5
+chi2 = np.sum((counts[use] - expected[use]) ** 2 / expected[use]) / use.sum()
+print('hybrid vs Dijkstra_sphere_test: chi2 / bin %.2f in %d bins, %d photons beyond |x| = %g' %
+      (chi2, use.sum(), np.sum(np.abs(x) >= edges[-1]), edges[-1]))
+assert chi2 < 2
+
+if 'explicit' in sys.argv:
+    nexp = 150
+    for r0 in [0., 0.5]:
+        P = np.zeros((nexp, 3))
+        P[:, 2] = r0
+        x_hyb = run_photons_diffusion(geom, 10 * nexp, seed=2, N=10 ** 8, P=np.zeros((10 * nexp, 3)) + P[0])[2]
+        x_exp = run_photons(geom, nexp, seed=2, N=10 ** 9, P=P)[2]
+        p = ks_2samp(np.abs(x_hyb), np.abs(x_exp)).pvalue
+        print('source at r = %g R: median |x| hybrid %.2f, explicit %.2f, KS p-value %.2f' %
+              (r0, np.median(np.abs(x_hyb)), np.median(np.abs(x_exp)), p))
+        assert p > 0.01
@@ -83,6 +83,24 @@ t2 = direct_approach(u0=u0, x=x,  a=a, N=N)
 
 plt.hist([t1, t2], 100, normed=True, histtype='step')
 
+# Throughput and acceptance rate of the batched ZM sampler against the direct sampler,
+# each batched call on fresh frequencies
+
+import time
+
+for oversample in [None, 1, 4]:
+    zm = ZMSampler(oversample=oversample)
+    t0 = time.time()
+    for rep in range(5):
+        t3 = zm.sample(np.random.normal(0, 3, N), a)
+    t_zm = (time.time() - t0) / 5
+    print('batched ZM, %s proposals per round: %0.2e samples/s, acceptance rate %0.3f, %0.2f proposals per sample' %
+          ('adaptive' if oversample is None else oversample, N / t_zm, zm.acceptance_rate, 1. / zm.efficiency))
+t0 = time.time()
+t4 = direct_approach(u0=u0, x=x, a=a, N=N)
+t_direct = time.time() - t0
+print('direct (one x only): %0.2e samples/s' % (N / t_direct))
+
 # u = np.linspace(-10, 10, 100000)
 # plt.plot(u, integrand(u, (x, a)))
 plt.yscale('log')
@@ -4,22 +4,24 @@ import numpy as np
 def Dijkstra_sphere_test(x, a, tau0):
     '''
     Return an analytical solution for a homogeneous sphere (without recoil) from Dijkstra et al.
-(2006)
-    :param x:
-    :param a:
-    :param tau0:
-    :return:
+(2006), Eq 9: spectrum emerging from a sphere with a source at line center in its center
+    :param x: dimensionless frequency
+    :param a: Voigt parameter
+    :param tau0: line-center optical depth from the center to the surface
+    :return: J(x)
     '''
     return np.sqrt(np.pi) / np.sqrt(24) / a / tau0 * x ** 2 / (
-        1. + np.cosh(np.sqrt(2. * np.pi / 27) * np.abs(x) ** 3 / a / tau0))
+        1. + np.cosh(np.sqrt(2. * np.pi ** 3 / 27) * np.abs(x) ** 3 / a / tau0))
 
 
 def Neufeld(x, tau, a):
     '''
-    See Dijkstra's notes Eq 92
-    :param x:
-    :param tau:
-    :return:
-
+    See Dijkstra's notes Eq 92: spectrum emerging from a homogeneous slab with a source at line
+    center in its midplane (Harrington 1973, Neufeld 1990), whose integral over x is 1 / (4 pi)
+    :param x: dimensionless frequency
+    :param tau: line-center optical depth from the midplane to the surface
+    :param a: Voigt parameter
+    :return: J(x)
     '''
-    np.sqrt(6) / 24. / np.sqrt(np.pi) / a / tau0
+    return np.sqrt(6) / 24. / np.sqrt(np.pi) / a / tau * x ** 2 / \
+        np.cosh(np.sqrt(np.pi ** 3 / 54.) * np.abs(x) ** 3 / a / tau)
@@ -1,4 +1,4 @@
-from numba import jit
+from numba import jit, vectorize
 from scipy.special import wofz
 
 from lyamc.general import *
@@ -30,6 +30,216 @@ def V(x, alpha, gamma):
     return np.real(wofz((x + 1j * gamma) / sigma / np.sqrt(2))) / sigma / np.sqrt(2 * np.pi)
 
 
+### Voigt function H(a, x) = Re[w(x + ia)] backends:
+
+def H_wofz(a, x):
+    """ Exact Voigt function from scipy.special.wofz """
+    return np.real(wofz(x + 1j * a))
+
+
+H_table_la = np.linspace(-6, 0, 41)  # log10(a)
+H_table_a = 10 ** H_table_la
+H_table_x = np.linspace(0, 20, 2001)
+H_table_values = H_wofz(H_table_a.reshape(-1, 1), H_table_x.reshape(1, -1))
+
+
+@vectorize(['float64(float64, float64)'])
+def H_table(a, x):
+    """
+    Voigt function interpolated from a precomputed table of H(a, |x|):
+    linear in a between log-spaced nodes, linear in x with step 0.01.
+    Beyond the table H = a / sqrt(pi) / x^2 (1 + 3 / (2 x^2)).
+    """
+    x = abs(x)
+    dla = H_table_la[1] - H_table_la[0]
+    dx = H_table_x[1] - H_table_x[0]
+    i = min(max(int((np.log10(a) - H_table_la[0]) / dla), 0), len(H_table_la) - 2)
+    j = int(x / dx)
+    if j >= len(H_table_x) - 1:
+        return a / np.sqrt(np.pi) / x ** 2 * (1. + 1.5 / x ** 2)
+    wa = (a - H_table_a[i]) / (H_table_a[i + 1] - H_table_a[i])
+    wx = x / dx - j
+    return (1. - wa) * ((1. - wx) * H_table_values[i, j] + wx * H_table_values[i, j + 1]) + \
+           wa * ((1. - wx) * H_table_values[i + 1, j] + wx * H_table_values[i + 1, j + 1])
+
+
+### Cumulative Voigt function CH(a, x) = int_0^x H(a, x') dx':
+
+# exact integral of the piecewise linear H_table at its nodes
+CH_table_values = np.concatenate([np.zeros((len(H_table_a), 1)),
+                                  np.cumsum((H_table_values[:, 1:] + H_table_values[:, :-1]) / 2. *
+                                            np.diff(H_table_x), axis=1)], axis=1)
+
+
+@jit(nopython=True)
+def _CH_wing(a, x):
+    '''int_x^inf of the far wing a / sqrt(pi) / x^2 (1 + 3 / (2 x^2)) used by H_table'''
+    return a / np.sqrt(np.pi) * (1. / x + 0.5 / x ** 3)
+
+
+@vectorize(['float64(float64, float64)'])
+def CH_table(a, x):
+    """
+    Cumulative Voigt function CH(a, x) = int_0^x H(a, x') dx', the exact integral of H_table,
+    so that the optical depth along a path on which x changes linearly is a difference of two
+    lookups. CH is odd in x and CH(a, inf) = sqrt(pi) / 2 up to the accuracy of the table.
+    """
+    s = 1.
+    if x < 0:
+        s = -1.
+        x = -x
+    dla = H_table_la[1] - H_table_la[0]
+    dx = H_table_x[1] - H_table_x[0]
+    i = min(max(int((np.log10(a) - H_table_la[0]) / dla), 0), len(H_table_la) - 2)
+    wa = (a - H_table_a[i]) / (H_table_a[i + 1] - H_table_a[i])
+    j = int(x / dx)
+    if j >= len(H_table_x) - 1:
+        j = len(H_table_x) - 1
+        C = (1. - wa) * CH_table_values[i, j] + wa * CH_table_values[i + 1, j]
+        return s * (C + _CH_wing(a, H_table_x[j]) - _CH_wing(a, x))
+    t = x / dx - j
+    h0 = (1. - wa) * H_table_values[i, j] + wa * H_table_values[i + 1, j]
+    h1 = (1. - wa) * H_table_values[i, j + 1] + wa * H_table_values[i + 1, j + 1]
+    C = (1. - wa) * CH_table_values[i, j] + wa * CH_table_values[i + 1, j]
+    return s * (C + dx * (h0 * t + (h1 - h0) * t ** 2 / 2.))
+
+
+@jit(nopython=True)
+def CH_inverse(a, C):
+    """
+    Inverse of CH_table in x, +-inf if |C| is beyond CH(a, inf)
+    """
+    s = 1.
+    if C < 0:
+        s = -1.
+        C = -C
+    dla = H_table_la[1] - H_table_la[0]
+    dx = H_table_x[1] - H_table_x[0]
+    i = min(max(int((np.log10(a) - H_table_la[0]) / dla), 0), len(H_table_la) - 2)
+    wa = (a - H_table_a[i]) / (H_table_a[i + 1] - H_table_a[i])
+    last = len(H_table_x) - 1
+    C_last = (1. - wa) * CH_table_values[i, last] + wa * CH_table_values[i + 1, last]
+    if C >= C_last:
+        # far wing: solve 1 / x + 1 / (2 x^3) = w by Newton's method
+        w = _CH_wing(a, H_table_x[last]) * np.sqrt(np.pi) / a - (C - C_last) * np.sqrt(np.pi) / a
+        if w <= 0:
+            return s * np.inf
+        x = 1. / w
+        for it in range(50):
+            f = 1. / x + 0.5 / x ** 3 - w
+            x_new = x + f / (1. / x ** 2 + 1.5 / x ** 4)
+            if np.abs(x_new - x) <= 1e-14 * x:
+                x = x_new
+                break
+            x = x_new
+        return s * max(x, H_table_x[last])
+    # bisection over the nodes, then the quadratic within the cell
+    lo, hi = 0, last
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if (1. - wa) * CH_table_values[i, mid] + wa * CH_table_values[i + 1, mid] <= C:
+            lo = mid
+        else:
+            hi = mid
+    j = lo
+    h0 = (1. - wa) * H_table_values[i, j] + wa * H_table_values[i + 1, j]
+    h1 = (1. - wa) * H_table_values[i, j + 1] + wa * H_table_values[i + 1, j + 1]
+    D = (C - (1. - wa) * CH_table_values[i, j] - wa * CH_table_values[i + 1, j]) / dx
+    A = (h1 - h0) / 2.
+    t = 2. * D / (h0 + np.sqrt(max(h0 ** 2 + 4. * A * D, 0.)))
+    return s * (j + min(max(t, 0.), 1.)) * dx
+
+
+@vectorize(['float64(float64, float64, float64, float64)'])
+def invert_linear(f0, f1, h, dtau):
+    """
+    Distance s in [0, h] at which int_0^s f dl = dtau for f linear between f0 (at 0) and f1 (at h),
+    the root of the quadratic in a form that is stable for f1 -> f0.
+    Used by the adaptive marches and the exact samplers of linear media.
+    """
+    A = (f1 - f0) / (2. * h)
+    disc = np.sqrt(max(f0 ** 2 + 4. * A * dtau, 0.))
+    if f0 + disc <= 0:
+        return h
+    return min(max(2. * dtau / (f0 + disc), 0.), h)
+
+
+@jit(nopython=True)
+def linear_tau(d, K, a, x0, x1):
+    """
+    Optical depth of a path of length d with d tau / dl = K H(a, x) and x changing linearly from x0 to x1,
+    see linear_tau_distance
+    """
+    if np.abs(x1 - x0) < 1e-6:
+        return K * d * (H_table(a, x0) + H_table(a, x1)) / 2.
+    return K * d * (CH_table(a, x1) - CH_table(a, x0)) / (x1 - x0)
+
+
+@jit(nopython=True)
+def linear_tau_distance(tau_target, d, K, a, x0, x1):
+    """
+    Distance at which the optical depth tau_target is reached on a path of length d with
+    d tau / dl = K H(a, x) and x changing linearly from x0 to x1, from CH_table and CH_inverse.
+    Where x hardly changes over the path or over the step, H is taken as linear in x instead,
+    since the difference of two values of CH would then be lost in rounding.
+    :param K: d tau / dl per unit H in 1/pc
+    :return: distance and escape flag (True if the optical depth of the whole path is below tau_target)
+    """
+    if np.abs(x1 - x0) < 1e-6:
+        f0, f1 = K * H_table(a, x0), K * H_table(a, x1)
+        if tau_target >= d * (f0 + f1) / 2.:
+            return d, True
+        return invert_linear(f0, f1, d, tau_target), False
+    if tau_target >= linear_tau(d, K, a, x0, x1):
+        return d, True
+    g = (x1 - x0) / d
+    c0 = CH_table(a, x0)
+    f0 = K * H_table(a, x0)
+    l = min(tau_target / f0, d)
+    if np.abs(g * l) < 1e-6:
+        # x is nearly constant over the step
+        return invert_linear(f0, K * H_table(a, x0 + g * l), l, tau_target), False
+    x = CH_inverse(a, c0 + tau_target * g / K)
+    return min(max((x - x0) / g, 0.), d), False
+
+
+voigt_backends = {'wofz': H_wofz, 'fit': H_fit, 'table': H_table}
+voigt_backend = 'wofz'
+
+
+def set_voigt_backend(name):
+    """
+    Selects the Voigt function used by sigma (and so by DtauDl)
+    :param name: 'wofz' (exact), 'fit' (Tasitsiomi 2006) or 'table' (interpolated, nopython-compatible)
+    """
+    global voigt_backend
+    if name not in voigt_backends:
+        raise ValueError('unknown Voigt backend %s, use one of %s' % (name, list(voigt_backends)))
+    voigt_backend = name
+
+
+def H(a, x):
+    """ Voigt function H(a, x) from the selected backend """
+    return voigt_backends[voigt_backend](a, x)
+
+
+def voigt_accuracy(name, a_list=(1e-5, 1e-4, 4.7e-4, 1e-3, 1e-2), x=np.linspace(-30, 30, 6001)):
+    """
+    Accuracy of a Voigt backend against wofz
+    :param name: backend name
+    :param a_list: Voigt parameters to test
+    :param x: dimensionless frequencies to test
+    :return: maximal relative and absolute errors
+    """
+    rel, ab = 0., 0.
+    for a in a_list:
+        exact = H_wofz(a, x)
+        err = np.abs(voigt_backends[name](a, x) - exact)
+        rel = max(rel, np.max(err / exact))
+        ab = max(ab, np.max(err))
+    return rel, ab
+
+
 @jit(nopython=False)
 def sigma(nu, T, u, k):
     '''
@@ -46,7 +256,8 @@ def sigma(nu, T, u, k):
     # Deltanua = nua * vth / c
     # a = DeltanuL / 2.0 / Deltanua
     a = 4.7e-4 * (T / 1e4) ** -0.5  # Eq 53 from D's motes
-    return 1.045e-13 * (T / 1e4) ** -0.5 * V(x_new, alpha=1., gamma=a)
+    # V(x_new, alpha=1., gamma=a) = H(a, x_new) / sqrt(pi)
+    return 1.045e-13 * (T / 1e4) ** -0.5 * H(a, x_new) / np.sqrt(np.pi)
     # return sigmaax(T, x_new)
 
 
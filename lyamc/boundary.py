@@ -0,0 +1,66 @@
+'''
+Analytic ray-boundary intersections.
+
+Distances in pc from a position p along a unit direction k to the surface of a sphere,
+a slab or a box. A photon outside the medium that moves away from it gets 0. The
+scalar versions are compiled for the kernels, the _batch versions take arrays [n,3].
+The distance samplers compare the sampled optical depth with the optical depth to
+these surfaces, so an escape is recorded in the same step.
+'''
+
+import numpy as np
+from numba import jit
+
+
+@jit(nopython=True)
+def sphere_exit(p, k, R):
+    '''Distance from p along k to the sphere of radius R around the origin'''
+    pk = p[0] * k[0] + p[1] * k[1] + p[2] * k[2]
+    pp = p[0] ** 2 + p[1] ** 2 + p[2] ** 2
+    return max(-pk + np.sqrt(max(pk ** 2 - pp + R ** 2, 0.)), 0.)
+
+
+@jit(nopython=True)
+def slab_exit(p, k, R, axis=0):
+    '''Distance from p along k to the surface of the slab |p[axis]| < R'''
+    if k[axis] > 0:
+        return max((R - p[axis]) / k[axis], 0.)
+    elif k[axis] < 0:
+        return max((-R - p[axis]) / k[axis], 0.)
+    return np.inf
+
+
+@jit(nopython=True)
+def box_exit(p, k, lo, hi):
+    '''Distance from p along k to the surface of the box [lo, hi]'''
+    d = np.inf
+    for ax in range(3):
+        if k[ax] > 0:
+            d = min(d, (hi[ax] - p[ax]) / k[ax])
+        elif k[ax] < 0:
+            d = min(d, (lo[ax] - p[ax]) / k[ax])
+    return max(d, 0.)
+
+
+def sphere_exit_batch(p, k, R):
+    '''sphere_exit for positions p [n,3] and directions k [n,3]'''
+    p, k = np.atleast_2d(p), np.atleast_2d(k)
+    pk = np.sum(p * k, axis=1)
+    return np.maximum(-pk + np.sqrt(np.maximum(pk ** 2 - np.sum(p ** 2, axis=1) + R ** 2, 0.)), 0.)
+
+
+def slab_exit_batch(p, k, R, axis=0):
+    '''slab_exit for positions p [n,3] and directions k [n,3]'''
+    p, k = np.atleast_2d(p), np.atleast_2d(k)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = (np.sign(k[:, axis]) * R - p[:, axis]) / k[:, axis]
+    d[k[:, axis] == 0] = np.inf
+    return np.maximum(d, 0.)
+
+
+def box_exit_batch(p, k, lo, hi):
+    '''box_exit for positions p [n,3] and directions k [n,3]'''
+    p, k = np.atleast_2d(p), np.atleast_2d(k)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = np.where(k > 0, (hi - p) / k, np.where(k < 0, (lo - p) / k, np.inf))
+    return np.maximum(d.min(axis=1), 0.)
@@ -0,0 +1,181 @@
+'''
+Photon catalogue: the escaped photons of one model in columnar .npy files.
+
+Output shards (single _last.npz files and the chunks of a PhotonStore) are merged
+into the catalogue by compact() and removed afterwards. The columns of every
+compaction are written under a new version and the catalogue manifest is switched
+to it atomically, so readers holding memory maps of an older version are not
+affected. The catalogue keeps the rows of every merged shard under the shard's file name:
+a shard that is written again under the name of a merged one (a requeued chunk of a work
+queue, or a chunk rewritten after a resume) replaces the rows of its first version instead
+of adding to them. Compactions of the same catalogue are serialized with a lock file, and
+chunks of a PhotonStore are only merged once they are listed in its manifest,
+so workers may keep writing while the catalogue is compacted.
+'''
+
+import fcntl
+import glob
+import json
+import os
+
+import numpy as np
+
+from lyamc.output import FIELDS, atomic_write_json
+
+
+class CatalogueLock:
+    '''Exclusive lock on a catalogue, held for the lifetime of the with block'''
+
+    def __init__(self, path):
+        self.path = path + '.lock'
+
+    def __enter__(self):
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        self.f.close()
+
+
+def catalogue_path(name, mode, outdir='output'):
+    '''Directory of the catalogue for the model name (see decodename) and mode'''
+    return os.path.join(outdir, '%s_%s_catalogue' % (name, mode))
+
+
+def read_manifest(path):
+    '''
+    Catalogue manifest, an empty catalogue if there is none yet. 'shards' lists the merged shards
+    in the order of their rows as [basename, number of photons, shard_id].
+    '''
+    mpath = os.path.join(path, 'catalogue.json')
+    if not os.path.exists(mpath):
+        return {'version': -1, 'nphotons': 0, 'shards': []}
+    with open(mpath) as f:
+        return json.load(f)
+
+
+def shard_id(path):
+    '''Size and modification time of a shard, which tell a merged shard from one rewritten under its name'''
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def find_shards(name, mode, outdir='output'):
+    '''
+    Shards that are ready to be merged: every _last.npz file without a PhotonStore
+    manifest and the chunks listed in the manifests of PhotonStores.
+    :return: list of shard paths and list of PhotonStore manifests that are complete
+    '''
+    files = sorted(glob.glob(os.path.join(outdir, name + '*%s_last*npz' % mode)))
+    manifests = sorted(glob.glob(os.path.join(outdir, name + '*%s_last.json' % mode)))
+    listed, chunk_files, complete = set(), set(), []
+    for m in manifests:
+        with open(m) as f:
+            manifest = json.load(f)
+        prefix = m[:-len('.json')]
+        chunk_files.update(f for f in files if f.startswith(prefix + '_'))
+        listed.update(os.path.join(outdir, c['file']) for c in manifest['chunks'])
+        if manifest['complete']:
+            complete.append(m)
+    shards = [f for f in files if (f not in chunk_files) or (f in listed)]
+    return shards, complete
+
+
+def compact(name, mode, outdir='output'):
+    '''
+    Merges all ready shards into the catalogue and removes them.
+    :param name: model name, see decodename
+    :param mode: parallel velocity mode of the runs
+    :param outdir: directory of the shards
+    :return: number of photons in the catalogue
+    '''
+    path = catalogue_path(name, mode, outdir)
+    os.makedirs(path, exist_ok=True)
+    with CatalogueLock(path):
+        manifest = read_manifest(path)
+        rows = manifest['shards']
+        known = {r[0]: r[2] for r in rows}
+        shards, complete = find_shards(name, mode, outdir)
+        todo = []
+        for s in shards:
+            if known.get(os.path.basename(s)) == shard_id(s):
+                # merged by a compaction that stopped before removing it
+                os.remove(s)
+            else:
+                todo.append(s)
+        shards = todo
+        if len(shards) > 0:
+            sizes = []
+            for s in shards:
+                with np.load(s) as temp:
+                    sizes.append(len(temp['x']))
+            # shards merged before under the same name lose their old rows
+            names = set(os.path.basename(s) for s in shards)
+            keep = [r for r in rows if r[0] not in names]
+            mask = None
+            if len(keep) < len(rows):
+                mask = np.repeat([r[0] not in names for r in rows], [r[1] for r in rows])
+            n0 = sum(r[1] for r in keep)
+            n = n0 + sum(sizes)
+            old = load_columns(path, manifest)
+            version = manifest['version'] + 1
+            for f in FIELDS:
+                shape = (n, 3) if f in ('p', 'k') else (n,)
+                col = np.lib.format.open_memmap(column_path(path, f, version) + '.tmp', mode='w+',
+                                                dtype=int if f == 'i' else float, shape=shape)
+                if n0 > 0:
+                    col[:n0] = old[f] if mask is None else old[f][mask]
+                j = n0
+                for s, size in zip(shards, sizes):
+                    with np.load(s) as temp:
+                        col[j:j + size] = np.asarray(temp[f]).reshape((-1,) + shape[1:])
+                    j += size
+                col.flush()
+                del col
+                os.replace(column_path(path, f, version) + '.tmp', column_path(path, f, version))
+            rows = keep + [[os.path.basename(s), size, shard_id(s)] for s, size in zip(shards, sizes)]
+            manifest = {'version': version, 'nphotons': n, 'shards': rows}
+            atomic_write_json(os.path.join(path, 'catalogue.json'), manifest)
+            for f in FIELDS:
+                for c in glob.glob(os.path.join(path, '%s.*.npy' % f)):
+                    if c != column_path(path, f, version):
+                        os.remove(c)
+            for s in shards:
+                os.remove(s)
+        # a finished PhotonStore whose chunks are all gone into the catalogue is not needed anymore
+        for m in complete:
+            with open(m) as f:
+                chunks = [c['file'] for c in json.load(f)['chunks']]
+            if not any(os.path.exists(os.path.join(outdir, c)) for c in chunks):
+                os.remove(m)
+        return manifest['nphotons']
+
+
+def column_path(path, field, version):
+    return os.path.join(path, '%s.%06d.npy' % (field, version))
+
+
+def load_columns(path, manifest, mmap=True):
+    '''Columns of the catalogue version in the manifest, as memory maps if mmap'''
+    if manifest['version'] < 0:
+        return {'p': np.zeros([0, 3]), 'k': np.zeros([0, 3]), 'x': np.zeros(0), 'i': np.zeros(0, dtype=int)}
+    return {f: np.load(column_path(path, f, manifest['version']), mmap_mode='r' if mmap else None)
+            for f in FIELDS}
+
+
+def load_catalogue(name, mode, outdir='output', mmap=True):
+    '''
+    Photons of the catalogue, without merging new shards.
+    :param mmap: return read-only memory maps instead of loading the columns
+    :return: p [n,3], k [n,3], x [n], i [n]
+    '''
+    path = catalogue_path(name, mode, outdir)
+    if not os.path.isdir(path):
+        columns = load_columns(path, read_manifest(path))
+    else:
+        # the lock keeps a compaction from removing the columns between reading the manifest and opening them
+        with CatalogueLock(path):
+            columns = load_columns(path, read_manifest(path), mmap)
+    return tuple(columns[f] for f in FIELDS)
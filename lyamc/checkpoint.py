@@ -0,0 +1,70 @@
+'''
+Periodic checkpoints of a transport run.
+
+A checkpoint holds the state of the photons in flight, the state of the output store
+(including the escaped photons not yet written) and the state of numpy's random
+generator. It is written through a temporary file and os.replace, so the file on
+disk is always a complete checkpoint.
+'''
+
+import os
+import pickle
+import time
+
+import numpy as np
+
+
+class Checkpointer:
+    '''
+    Saves the run state at most every `interval` seconds to `path`.
+    '''
+
+    def __init__(self, path, interval=600., run=None):
+        '''
+        :param path: checkpoint file
+        :param interval: minimal time between two checkpoints in seconds
+        :param run: description of the run (e.g. command line arguments); a checkpoint of another run is refused
+        '''
+        self.path = path
+        self.interval = interval
+        self.run = run
+        self.last = time.time()
+
+    def due(self):
+        '''True if the last checkpoint is older than the interval'''
+        return time.time() - self.last >= self.interval
+
+    def save(self, store, **state):
+        '''
+        Writes a checkpoint.
+        :param store: PhotonStore of the run
+        :param state: engine-specific state of the photons in flight
+        '''
+        state.update(run=self.run, store=store.state(), rng=np.random.get_state())
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp = self.path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.last = time.time()
+
+    def load(self):
+        '''
+        The latest checkpoint, None if there is none
+        '''
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        if state['run'] != self.run:
+            raise ValueError('checkpoint %s belongs to another run: %s' % (self.path, state['run']))
+        return state
+
+    def clear(self):
+        '''Removes the checkpoint once the run is finished'''
+        if os.path.exists(self.path):
+            os.remove(self.path)
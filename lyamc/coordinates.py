@@ -141,15 +141,18 @@ def boost_q(ein, qin, vb):
 # ---------------------------------------------------------------------
 # Main functions
 # ---------------------------------------------------------------------
-def samplephase(n):
+def samplephase(n, rng=None):
     """Function to generate n rays sampling the scattering phase function,
     assumed to be ~ (1 + \mu^2)
     Parameters:
         n: number of rays
+        rng: numpy Generator, np.random if None
     Outputs:
         nx3 array of direction cosines (relative to incoming rays on z)
     """
-    rvs = np.random.random((n, 2))
+    if rng is None:
+        rng = np.random
+    rvs = rng.random((n, 2))
     phis = rvs[:, 1] * 2.0 * np.pi
     sqfact = np.power(- 2.0 + 4.0 * rvs[:, 0] +
                       np.sqrt(5.0 - 16.0 * rvs[:, 0] + 16.0 * rvs[:, 0]**2),
@@ -161,12 +164,13 @@ def samplephase(n):
     return ns
 
 
-def scattering_lab_frame(freqs, ns, vs):
+def scattering_lab_frame(freqs, ns, vs, rng=None):
     """Function to perform one scattering for n rays off n atoms
     Parameters:
         freqs: array with n frequencies of input rays in units of hydrogen mass
         ns:    nx3 array with lab-frame direction cosines of input rays
         vs:    nx3 array with velocities of atoms (in units of c)
+        rng:   numpy Generator used for the outgoing directions, np.random if None
     Outputs:
         array with n frequencies of output rays in units of hydrogen mass
         nx3 array with lab-frame direction cosines of output rays
@@ -189,7 +193,7 @@ def scattering_lab_frame(freqs, ns, vs):
     qs_rot_euler = quat_to_rot(qs_in_com)
 
     # Sample outgoing rays in rotated center of mass frame
-    ns_out_rot_com = samplephase(len(freqs))
+    ns_out_rot_com = samplephase(len(freqs), rng)
     # Define output null-ray quaternions
     qs_out_rot_com = ns_to_quat(ns_out_rot_com)
 
@@ -0,0 +1,151 @@
+'''
+Hybrid transport with diffusion steps at extreme optical depths.
+
+When a photon is in the line core in a homogeneous static region with a * tau >= atau_min
+(tau the line-center optical depth to the nearest surface of the region), the explicit
+scatterings until it leaves the sphere of that radius around it are replaced by one step
+drawn from the diffusion solution of a sphere with a central source (Dijkstra et al. 2006,
+lyamc.analytical.Dijkstra_sphere_test): the photon is placed on the surface of the sphere
+with an outgoing direction and a frequency
+
+    |x|^3 = 2 artanh(u) a tau / beta,  beta = sqrt(2 pi^3 / 27),  u uniform in [0, 1),
+
+with a random sign. Inside the medium the sphere is not surrounded by vacuum, but until it
+first reaches the surface a photon follows the same scatterings as one in an isolated sphere
+of the same optical depth, so the escape spectrum is also the spectrum at the first crossing;
+photons that scatter back into the sphere are followed again from there. Photons in the
+wings, in thin regions and near surfaces are followed with the explicit scatterings of
+lyamc.kernel. The scatterings inside a diffusion step are not sampled, so the number of
+scatterings of the output counts the explicit ones only.
+
+The regions come from the diffusion_radius(p) method of the compiled geometry (see
+lyamc.jitgeometry): the distance to the surface of a homogeneous static sphere or slab, or
+to the nearest face of the cell or octree leaf.
+'''
+
+import numpy as np
+from numba import jit
+
+from lyamc.general import get_a, get_nu, get_x, sigmaa0, c, cm_in_pc
+from lyamc.geometry import Geometry
+from lyamc.kernel import _perp_basis, get_xcrit, kernel_geometry, scatter_atom
+from lyamc.rng import photon_rng, photon_seed
+
+beta_sphere = np.sqrt(2. * np.pi ** 3 / 27.)
+x_core = 3.  # diffusion steps start from |x| < x_core in the gas frame
+
+
+@jit(nopython=True)
+def sample_sphere_x(atau):
+    '''
+    Frequency of a photon diffusing out of a sphere, drawn from x^2 / (1 + cosh(beta |x|^3 / (a tau)))
+    :param atau: a * tau of the sphere at line center
+    :return: dimensionless frequency in the gas frame
+    '''
+    x = (2. * np.arctanh(np.random.rand()) * atau / beta_sphere) ** (1. / 3.)
+    if np.random.rand() < 0.5:
+        return -x
+    return x
+
+
+@jit(nopython=True)
+def diffusion_step(p, r, atau, u, T):
+    '''
+    Moves a photon to the surface of the sphere of radius r around p.
+    :param p: position in pc
+    :param r: radius of the sphere in pc
+    :param atau: a * tau of the sphere at line center
+    :param u: bulk velocity [3] of the gas in km/s
+    :param T: temperature in K
+    :return: new position, direction and frequency in Hz
+    '''
+    n = np.random.normal(0., 1., 3)
+    n /= np.sqrt(np.sum(n ** 2))
+    # outgoing directions weighted by mu (flux through the surface)
+    mu = np.sqrt(np.random.rand())
+    phi = np.random.rand() * 2. * np.pi
+    e0, e1 = _perp_basis(n)
+    s = np.sqrt(max(1. - mu ** 2, 0.))
+    k = mu * n + s * (np.cos(phi) * e0 + np.sin(phi) * e1)
+    return p + r * n, k, get_nu(sample_sphere_x(atau), T) / (1. - (u[0] * k[0] + u[1] * k[1] + u[2] * k[2]) / c)
+
+
+@jit(nopython=True)
+def run_photon_diffusion(p, k, x, geom, T_ic, N=10000, core_skip=False, atau_min=1e3):
+    '''
+    Follows one photon from emission to escape with diffusion steps, see lyamc.kernel.run_photon
+    :param geom: compiled geometry with a diffusion_radius method
+    :param N: maximum number of explicit scatterings and diffusion steps
+    :param atau_min: smallest a * tau of a region for a diffusion step
+    :return: position of the last scattering, final direction, final frequency, number of explicit scatterings
+    '''
+    p = p.copy()
+    k = k.copy()
+    nu = get_nu(x, T_ic)
+    i = 0
+    steps = 0
+    while steps < N - 1:
+        r = geom.diffusion_radius(p)
+        if r > 0:
+            T = geom.temperature(p)
+            a = get_a(T)
+            atau = a * sigmaa0(T) * geom.density(p) * r * cm_in_pc
+            u = geom.velocity(p)
+            if (atau >= atau_min) and (np.abs(get_x(nu * (1. - (u[0] * k[0] + u[1] * k[1] + u[2] * k[2]) / c),
+                                                    T)) < x_core):
+                p, k, nu = diffusion_step(p, r, atau, u, T)
+                steps += 1
+                continue
+        d_max = geom.distance_to_boundary(p, k)
+        d, escaped = geom.tau_distance(nu, p, k, -np.log(np.random.rand()), d_max)
+        if escaped:
+            break
+        p_new = p + k * d
+        T = geom.temperature(p_new)
+        x_crit = 0.
+        if core_skip:
+            x_crit = get_xcrit(T, geom.density(p_new), geom.R)
+        nu, k = scatter_atom(nu, k, geom.velocity(p_new), T, x_crit)
+        p = p_new
+        i += 1
+        steps += 1
+    return p, k, get_x(nu, T_ic), i
+
+
+@jit(nopython=True)
+def _run_photons_diffusion(P, x0, geom, T_ic, N, core_skip, atau_min, seed, first_id):
+    n = len(P)
+    p_last = np.zeros((n, 3))
+    k_last = np.zeros((n, 3))
+    x_last = np.zeros(n)
+    i_last = np.zeros(n, dtype=np.int64)
+    for j in range(n):
+        if seed >= 0:
+            np.random.seed(photon_seed(seed, first_id + j))
+        k = np.random.normal(0., 1., 3)
+        k /= np.sqrt(np.sum(k ** 2))
+        p_last[j], k_last[j], x_last[j], i_last[j] = run_photon_diffusion(P[j], k, x0, geom, T_ic, N, core_skip,
+                                                                          atau_min)
+    return p_last, k_last, x_last, i_last
+
+
+def run_photons_diffusion(geom, nsim, x0=0., N=10000, core_skip=False, seed=None, first_id=0, P=None,
+                          atau_min=1e3):
+    '''
+    Runs nsim photons with the hybrid kernel, see lyamc.kernel.run_photons.
+    :param atau_min: smallest a * tau of a region for a diffusion step; the diffusion solution holds
+                     for a * tau >~ 1e3
+    :return: p [nsim,3], k [nsim,3], x [nsim], i [nsim], i counting the explicit scatterings
+    '''
+    g = kernel_geometry(geom)
+    if P is not None:
+        P = np.ascontiguousarray(P, dtype=float).reshape(-1, 3)
+    elif not isinstance(geom, Geometry):
+        P = np.zeros((nsim, 3))
+    elif seed is None:
+        P = geom.get_ICs(nsim)
+    else:
+        P = np.array([geom.get_IC(photon_rng(seed, first_id + j)) for j in range(nsim)], dtype=float).reshape(-1, 3)
+    T_ic = float(g.temperature(P[0]))
+    return _run_photons_diffusion(P, float(x0), g, T_ic, N, core_skip, float(atau_min),
+                                  -1 if seed is None else int(seed), int(first_id))
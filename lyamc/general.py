@@ -5,6 +5,7 @@ import numpy as np
 from numba import jit
 
 import lyamc.cons as cons
+from lyamc.catalogue import compact, load_catalogue
 
 NU0 = cons.NULYA / (cons.MHK * cons.K2HZ)
 
@@ -57,35 +58,28 @@ def sigmaax(T, x):
     return 5.9e-14 * (T / 1e4) ** -0.5 * H_fit(anu, x)
 
 
-def read_last(geom, params, mode):
-    s = glob.glob('output/' + decodename(geom, params, sep='_') + '*%s_last*npz'%mode)
-    temp = np.load(s[0])
-    k = temp['k'].copy()
-    x = temp['x'].copy()
-    p = temp['p'].copy()
-    i = temp['i'].copy()
-    for si in s[1:]:
-        temp = np.load(si)
-        k = np.concatenate([k, temp['k']])
-        x = np.concatenate([x, temp['x']])
-        p = np.concatenate([p, temp['p']])
-        i = np.concatenate([i, temp['i']])
-    # x = np.array(x).reshape(-1,1)
-    # k = np.array(k).reshape(-
-    filename = str(np.random.rand())[2:]
-    np.savez('output/' + decodename(geom, params) + '_%s_%s_last.npz' % (filename, mode),
-             p=p,
-             k=k,
-             x=x,
-             i=i)
-    for si in s:
-        os.system('rm -f ' + si)
-    direction = npsumdot(k, [0, 0, 1])
+def read_last(geom, params, mode, mmap=True):
+    '''
+    Merges the output shards of a model into its catalogue and loads it, see lyamc.catalogue
+    :param geom: geometry name
+    :param params: geometry parameters
+    :param mode: parallel velocity mode of the runs
+    :param mmap: memory-map the catalogue instead of loading it
+    :return: x, k, direction (k_z) and number of scatterings i
+    '''
+    name = decodename(geom, params, sep='_')
+    compact(name, mode)
+    p, k, x, i = load_catalogue(name, mode, mmap=mmap)
+    direction = k[:, 2]
     print(len(x))
     return x, k, direction, i
 
+
 def decodename(geom, params, sep='_'):
-    if len(params) == 6:
+    if os.path.exists(geom):
+        # grids are given by their path
+        s = ' '.join([os.path.splitext(os.path.basename(geom))[0]] + ['%.2e' % p for p in params])
+    elif len(params) == 6:
         s = '%s %0.2f %.1e %0.2f %0.2f %0.2f %0.2f' % (
         geom, params[0], params[1], params[2], params[3], params[4], params[5])
     elif len(params) == 3:
@@ -1,10 +1,72 @@
+import os
+
 import numpy as np
 
+from lyamc.boundary import box_exit_batch, slab_exit_batch, sphere_exit_batch
 from lyamc.general import sigmaa0, cm_in_pc
-from lyamc.redistribution import random_n
+from lyamc.grid import grid_march_batch, grid_tau_batch
+from lyamc.jitgeometry import GridKernel, NeufeldKernel, OctreeKernel, PlaneKernel, ZhengKernel, SlabReduced, \
+    SphereReduced, readonly
+from lyamc.octree import build_octree, octree_leaves, octree_march_batch, octree_tau_batch
+
+
+def as_points(x):
+    '''Positions as an array [n,3], a single position [3] becomes [1,3]'''
+    return np.atleast_2d(np.asarray(x, dtype=float))
+
+
+class Geometry:
+    '''
+    Interface of the geometries, vectorized over photons.
+    Positions are arrays [n,3] in pc (a single position [3] counts as n = 1) and every field
+    returns one value per position: density [n] in cm^-3, velocity [n,3] in km/s and
+    temperature [n] in K. Emission points are drawn n at a time with get_ICs.
+    '''
+    IC = 'center'
+    homogeneous_static = False
+    # uniform density and temperature with a velocity linear in position, see get_distance_linear
+    linear_velocity = False
+
+    def density(self, x):
+        raise NotImplementedError
+
+    def velocity(self, x):
+        raise NotImplementedError
+
+    def temperature(self, x):
+        raise NotImplementedError
+
+    def fields(self, x):
+        '''Density [n], velocity [n,3] and temperature [n] at the positions x [n,3] in one call'''
+        x = as_points(x)
+        return self.density(x), self.velocity(x), self.temperature(x)
+
+    def distance_to_boundary(self, p, k):
+        '''Distances [n] in pc from the positions p [n,3] along the directions k [n,3] to the boundary'''
+        raise NotImplementedError
+
+    def get_ICs(self, n, rng=None):
+        '''
+        Emission points of n photons
+        :param rng: numpy Generator, np.random if None
+        :return: positions [n,3] in pc
+        '''
+        return np.zeros((n, 3))
+
+    def get_IC(self, rng=None):
+        '''Emission point [3] of one photon, see get_ICs'''
+        return self.get_ICs(1, rng)[0]
+
+    def kernel(self):
+        '''Compiled form of the geometry for lyamc.kernel, see lyamc.jitgeometry'''
+        raise ValueError('geometry %s is not supported by the kernel' % type(self).__name__)
 
+    def reduced(self):
+        '''Symmetry-reduced form for lyamc.reduced, None if the geometry has no symmetry'''
+        return None
 
-class Neufeld_test:
+
+class Neufeld_test(Geometry):
     def __init__(self, tau=1e4, T=10.):
         self.T = T
         self.tau = tau
@@ -12,60 +74,75 @@ class Neufeld_test:
         s = sigmaa0(T)
         self.N = self.tau / s
         self.n = self.N / (self.R * cm_in_pc)
+        self.nbar = self.n
         self.IC = 'center'
+        self.homogeneous_static = True
 
-    def get_IC(self):
-        p = [0, 0, 0]
-        return p
+    def distance_to_boundary(self, p, k):
+        '''Distance in pc from p along k to the slab surface |x| = R.'''
+        return slab_exit_batch(as_points(p), as_points(k), self.R, 0)
 
     def velocity(self, x):
-        return 0 * x
+        return np.zeros_like(as_points(x))
 
     def temperature(self, x):
-        return self.T
+        return np.full(len(as_points(x)), float(self.T))
 
     def density(self, x):
-        d = x[:, 0] * 0. + self.n
+        x = as_points(x)
+        d = np.full(len(x), self.n)
         d[np.abs(x[:, 0]) > self.R] = 0
         return d
 
-class plane_gradient:
+    def kernel(self):
+        return NeufeldKernel(float(self.R), float(self.n), float(self.T))
+
+    def reduced(self):
+        return SlabReduced(float(self.R), float(self.n), float(self.T), 0, False)
+
+class plane_gradient(Geometry):
     def __init__(self, gradV=0, T=1e4, n=10.):
         self.gradV = gradV
         self.T = T
         self.n = n
+        self.nbar = n
         s = sigmaa0(T)
         self.R = 1e6 / s / n / cm_in_pc
+        self.homogeneous_static = (gradV == 0)
+        self.linear_velocity = (gradV != 0)
 
-    def get_IC(self):
-        p = [0, 0, 0]
-        return p
+    def distance_to_boundary(self, p, k):
+        '''The medium is infinite: photons that travel further than 2 R are considered escaped.'''
+        return np.ones(len(as_points(p))) * 2 * self.R
 
     def velocity(self, x):
         '''Return velocity in km/s.
         Coordinates are in pc.
         Gradient is in km/s/pc'''
-        v = x.copy()
-        v *= 0
-        if x.shape[0] == 3:
-            v[0] = x[2] * self.gradV
-        else:
-            v[:, 0] = x[:, 2] * self.gradV
+        x = as_points(x)
+        v = np.zeros_like(x)
+        v[:, 0] = x[:, 2] * self.gradV
         return v
 
     def temperature(self, x):
         '''Temperature in K as a function of position.'''
-        return self.T
+        return np.full(len(as_points(x)), float(self.T))
 
     def density(self, x):
         '''Density in 1/cm^3 as a function of position.'''
-        return self.n
+        return np.full(len(as_points(x)), float(self.n))
 
-    def stop_condition(self, x):
-        return False
+    def kernel(self):
+        return PlaneKernel(float(self.R), float(self.n), float(self.T), float(self.gradV))
 
+    def reduced(self):
+        # the shear flow v_x(z) depends on the azimuth of the photon
+        if self.gradV != 0:
+            return None
+        return SlabReduced(float(self.R), float(self.n), float(self.T), 2, True)
 
-class Zheng_sphere:
+
+class Zheng_sphere(Geometry):
     '''
     Examples from http://iopscience.iop.org/article/10.1088/0004-637X/794/2/116/pdf
     '''
@@ -78,17 +155,26 @@ class Zheng_sphere:
         self.V = V
         self.DeltaV = DeltaV
         self.IC = IC
+        self.homogeneous_static = (A == 0) and (V == 0) and (DeltaV == 0)
+        self.linear_velocity = (A == 0) and not self.homogeneous_static
 
-    def get_IC(self):
+    def get_ICs(self, n, rng=None):
+        '''Emission points [n,3]: the centre, or uniform within the sphere (IC = "uniform")'''
         if self.IC == 'center':
-            p = [0, 0, 0]
+            return np.zeros((n, 3))
         elif self.IC == 'uniform':
-            k, temp = random_n([], mode='uniform')
-            p = np.random.rand() ** 0.3333 * k * self.R
-        return p
+            rng = np.random if rng is None else rng
+            k = rng.normal(size=(n, 3))
+            k /= np.sqrt(np.sum(k ** 2, axis=1)).reshape(-1, 1)
+            return (rng.random(n) ** (1. / 3.) * self.R).reshape(-1, 1) * k
+        raise ValueError('unknown IC %s' % self.IC)
+
+    def distance_to_boundary(self, p, k):
+        '''Distance in pc from p along k to the surface of the sphere.'''
+        return sphere_exit_batch(as_points(p), as_points(k), self.R)
 
     def temperature(self, x):
-        return self.T
+        return np.full(len(as_points(x)), float(self.T))
 
     def density(self, x):
         '''
@@ -96,6 +182,7 @@ class Zheng_sphere:
         :param x:
         :return:
         '''
+        x = as_points(x)
         r = np.sqrt((x ** 2).sum(axis=-1))
         temp = self.nbar * (1.0 - 2.0 * self.A * x[:, 2] / self.R)
         temp[r > self.R] = 0.
@@ -109,6 +196,7 @@ class Zheng_sphere:
         '''
         # r = np.sqrt((x**2).sum(axis=-1))
         # rhat = np.array(x) / r
+        x = as_points(x)
         temp = x.copy()
         temp[:, 0] = 0
         temp[:, 1] = 0
@@ -116,9 +204,214 @@ class Zheng_sphere:
         return x / self.R * self.V + \
                temp
 
-    def stop_condition(self, x):
-        r = np.sqrt((x ** 2).sum(axis=-1))
-        if r > self.R:
-            return True
-        else:
-            return False
+    def kernel(self):
+        return ZhengKernel(float(self.R), float(self.nbar), float(self.T), float(self.A), float(self.V),
+                           float(self.DeltaV))
+
+    def reduced(self):
+        if (self.A != 0) or (self.DeltaV != 0):
+            return None
+        return SphereReduced(float(self.R), float(self.nbar), float(self.T), float(self.V))
+
+
+class Cartesian_grid(Geometry):
+    '''
+    Uniform 3-D grid of density, velocity and temperature, e.g. from a simulation snapshot.
+    The box [-L/2, L/2] is centred on the origin and quantities are constant within a cell;
+    optical depths are integrated exactly cell by cell, see lyamc.grid.
+    '''
+
+    def __init__(self, density, velocity, temperature, L, IC='center'):
+        '''
+        :param density: HI number density [nx,ny,nz] in cm^-3
+        :param velocity: bulk velocity [nx,ny,nz,3] in km/s
+        :param temperature: temperature [nx,ny,nz] (or a scalar) in K
+        :param L: size of the box in pc, scalar or [3]
+        :param IC: 'center' or the emission point [3] in pc
+        '''
+        self.density_grid = np.ascontiguousarray(density)
+        self.velocity_grid = np.ascontiguousarray(velocity)
+        self.temperature_grid = np.ascontiguousarray(np.broadcast_to(temperature, self.density_grid.shape))
+        if self.velocity_grid.shape != self.density_grid.shape + (3,):
+            raise ValueError('velocity must have shape %s' % str(self.density_grid.shape + (3,)))
+        self.L = np.broadcast_to(np.asarray(L, dtype=float), (3,)).copy()
+        self.lo = -self.L / 2.
+        self.dx = self.L / np.array(self.density_grid.shape)
+        self.IC = IC
+        self.R = self.L.min() / 2.
+        self.nbar = float(self.density_grid.mean())
+        self.homogeneous_static = False
+
+    @classmethod
+    def from_file(cls, path, IC='center', **kwargs):
+        '''
+        Grid from an .npz file with arrays density, velocity, temperature and L (see __init__).
+        The arrays are memory-mapped from .npy files in a directory with the same names.
+        '''
+        if os.path.isdir(path):
+            load = lambda f: np.load(os.path.join(path, f + '.npy'), mmap_mode='r')
+            return cls(load('density'), load('velocity'), load('temperature'), load('L'), IC, **kwargs)
+        with np.load(path) as temp:
+            return cls(temp['density'], temp['velocity'], temp['temperature'], temp['L'], IC, **kwargs)
+
+    def get_ICs(self, n, rng=None):
+        if isinstance(self.IC, str) and self.IC == 'center':
+            return np.zeros((n, 3))
+        return np.tile(np.asarray(self.IC, dtype=float), (n, 1))
+
+    def cell_index(self, x):
+        '''Cell indices [n,3] of points x [n,3] and a mask of points inside the grid'''
+        x = as_points(x)
+        f = np.floor((x - self.lo) / self.dx).astype(int)
+        inside = np.all((f >= 0) & (f < np.array(self.density_grid.shape)), axis=1)
+        return np.clip(f, 0, np.array(self.density_grid.shape) - 1), inside
+
+    def density(self, x):
+        idx, inside = self.cell_index(x)
+        return np.where(inside, self.density_grid[idx[:, 0], idx[:, 1], idx[:, 2]], 0.)
+
+    def velocity(self, x):
+        idx, inside = self.cell_index(x)
+        return np.where(inside.reshape(-1, 1), self.velocity_grid[idx[:, 0], idx[:, 1], idx[:, 2]], 0.)
+
+    def temperature(self, x):
+        idx, inside = self.cell_index(x)
+        return self.temperature_grid[idx[:, 0], idx[:, 1], idx[:, 2]]
+
+    def fields(self, x):
+        # one cell lookup for the three fields
+        idx, inside = self.cell_index(x)
+        i, j, l = idx[:, 0], idx[:, 1], idx[:, 2]
+        return np.where(inside, self.density_grid[i, j, l], 0.), \
+               np.where(inside.reshape(-1, 1), self.velocity_grid[i, j, l], 0.), self.temperature_grid[i, j, l]
+
+    def distance_to_boundary(self, p, k):
+        '''Distance in pc from p along k to the surface of the box.'''
+        return box_exit_batch(as_points(p), as_points(k), self.lo, self.lo + self.L)
+
+    def kernel(self):
+        return GridKernel(readonly(self.density_grid), readonly(self.velocity_grid), readonly(self.temperature_grid),
+                          readonly(self.lo), readonly(self.dx), float(self.R))
+
+    def tau_distance(self, nu, p, k, tau_target, d_max=None):
+        '''
+        Exact distances at which n rays reach their target optical depths, see lyamc.grid.grid_walk
+        :return: distances in pc [n] and a mask of rays that left the grid (or passed d_max) first
+        '''
+        n = len(nu)
+        d_max = np.full(n, np.inf) if d_max is None else np.broadcast_to(d_max, (n,)).astype(float)
+        return grid_march_batch(np.asarray(nu, dtype=float).reshape(-1), np.asarray(p, dtype=float).reshape(-1, 3),
+                                np.asarray(k, dtype=float).reshape(-1, 3),
+                                np.asarray(tau_target, dtype=float).reshape(-1), d_max, self.density_grid,
+                                self.velocity_grid, self.temperature_grid, self.lo, self.dx)
+
+    def tau(self, nu, p, k, d=None):
+        '''Optical depths along n rays over the distances d (to the surface of the grid if None)'''
+        n = len(nu)
+        d = np.full(n, np.inf) if d is None else np.broadcast_to(d, (n,)).astype(float)
+        return grid_tau_batch(np.asarray(nu, dtype=float).reshape(-1), np.asarray(p, dtype=float).reshape(-1, 3),
+                              np.asarray(k, dtype=float).reshape(-1, 3), d, self.density_grid, self.velocity_grid,
+                              self.temperature_grid, self.lo, self.dx)
+
+
+class Octree_grid(Cartesian_grid):
+    '''
+    Octree built from a uniform grid with 2^m cells per side, see lyamc.octree.
+    Empty and smooth regions are merged into large leaves, which are crossed in one step;
+    only the tree is kept in memory.
+    '''
+
+    def __init__(self, density, velocity, temperature, L, IC='center', rtol=0.05, vtol=0.1):
+        '''
+        :param density: HI number density [n,n,n] in cm^-3
+        :param velocity: bulk velocity [n,n,n,3] in km/s
+        :param temperature: temperature [n,n,n] (or a scalar) in K
+        :param L: size of the box in pc, scalar or [3]
+        :param IC: 'center' or the emission point [3] in pc
+        :param rtol: relative variation of density and temperature allowed within a leaf
+        :param vtol: variation of the velocity allowed within a leaf in units of the thermal velocity
+        '''
+        density = np.asarray(density)
+        temperature = np.broadcast_to(temperature, density.shape)
+        if np.shape(velocity) != density.shape + (3,):
+            raise ValueError('velocity must have shape %s' % str(density.shape + (3,)))
+        self.child, self.level, self.node_density, self.node_velocity, self.node_temperature = \
+            build_octree(density, velocity, temperature, rtol, vtol)
+        self.L = np.broadcast_to(np.asarray(L, dtype=float), (3,)).copy()
+        self.lo = -self.L / 2.
+        self.dx = self.L / np.array(density.shape)
+        self.IC = IC
+        self.R = self.L.min() / 2.
+        self.nbar = float(density.mean())
+        self.homogeneous_static = False
+        self.nleaves = int((self.child < 0).sum())
+        self.ncells = density.size
+
+    def leaf_index(self, x):
+        '''Leaves containing the points x [n,3], -1 outside the box'''
+        return octree_leaves(as_points(x), self.child, self.lo, self.L)
+
+    def density(self, x):
+        leaf = self.leaf_index(x)
+        return np.where(leaf >= 0, self.node_density[leaf], 0.)
+
+    def velocity(self, x):
+        leaf = self.leaf_index(x)
+        return np.where(leaf.reshape(-1, 1) >= 0, self.node_velocity[leaf], 0.)
+
+    def temperature(self, x):
+        # outside the box the mean temperature of the root
+        return self.node_temperature[np.maximum(self.leaf_index(x), 0)]
+
+    def fields(self, x):
+        leaf = self.leaf_index(x)
+        return np.where(leaf >= 0, self.node_density[leaf], 0.), \
+               np.where(leaf.reshape(-1, 1) >= 0, self.node_velocity[leaf], 0.), \
+               self.node_temperature[np.maximum(leaf, 0)]
+
+    def kernel(self):
+        return OctreeKernel(readonly(self.child, np.int64), readonly(self.node_density), readonly(self.node_velocity),
+                            readonly(self.node_temperature), readonly(self.lo), readonly(self.L), float(self.R))
+
+    def tau_distance(self, nu, p, k, tau_target, d_max=None):
+        '''
+        Distances at which n rays reach their target optical depths, see lyamc.octree.octree_walk
+        :return: distances in pc [n] and a mask of rays that left the box (or passed d_max) first
+        '''
+        n = len(nu)
+        d_max = np.full(n, np.inf) if d_max is None else np.broadcast_to(d_max, (n,)).astype(float)
+        return octree_march_batch(np.asarray(nu, dtype=float).reshape(-1), np.asarray(p, dtype=float).reshape(-1, 3),
+                                  np.asarray(k, dtype=float).reshape(-1, 3),
+                                  np.asarray(tau_target, dtype=float).reshape(-1), d_max, self.child,
+                                  self.node_density, self.node_velocity, self.node_temperature, self.lo, self.L)
+
+    def tau(self, nu, p, k, d=None):
+        '''Optical depths along n rays over the distances d (to the surface of the box if None)'''
+        n = len(nu)
+        d = np.full(n, np.inf) if d is None else np.broadcast_to(d, (n,)).astype(float)
+        return octree_tau_batch(np.asarray(nu, dtype=float).reshape(-1), np.asarray(p, dtype=float).reshape(-1, 3),
+                                np.asarray(k, dtype=float).reshape(-1, 3), d, self.child, self.node_density,
+                                self.node_velocity, self.node_temperature, self.lo, self.L)
+
+
+def get_geometry(name, params):
+    '''
+    Geometry from its name and the parameters of the command line of runner.py
+    :param name: 'Neufeld_test', 'plane_gradient', 'Zheng_sphere' or the path of a grid
+    :param params: parameters in the order of decodename; for a grid rtol and optionally vtol of
+                   Octree_grid, or 0 for the uniform Cartesian_grid
+    :return: geometry
+    '''
+    if name == 'Neufeld_test':
+        return Neufeld_test(tau=params[0], T=params[1])
+    elif name == 'plane_gradient':
+        return plane_gradient(n=params[0], T=params[1], gradV=params[2])
+    elif name == 'Zheng_sphere':
+        return Zheng_sphere(nbar=params[0], T=params[1], R=params[2], A=params[3], V=params[4], DeltaV=params[5],
+                            IC='center')
+    elif os.path.exists(name):
+        # a snapshot on a uniform grid, see Cartesian_grid.from_file
+        if params[0] > 0:
+            return Octree_grid.from_file(name, rtol=params[0], vtol=params[1] if len(params) > 1 else 0.1)
+        return Cartesian_grid.from_file(name)
+    raise ValueError('unknown geometry %s' % name)
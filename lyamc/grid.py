@@ -0,0 +1,105 @@
+'''
+Ray traversal of uniform Cartesian grids.
+
+Density, velocity and temperature are constant within a cell, so the frequency in the
+frame of the gas and d\\tau / dl are constant along the part of a ray inside a cell and
+the optical depth is integrated exactly, cell by cell (3-D DDA, Amanatides & Woo 1987).
+'''
+
+import numpy as np
+from numba import jit
+
+from lyamc.atomic import H_table
+from lyamc.boundary import box_exit
+from lyamc.general import get_x, c, cm_in_pc
+
+
+@jit(nopython=True)
+def cell_dtaudl(nu, k, ndens, u, T):
+    '''d\\tau / dl in 1/pc in a cell with density ndens, velocity u [3] and temperature T'''
+    if ndens <= 0:
+        return 0.
+    x = get_x((1. - (u[0] * k[0] + u[1] * k[1] + u[2] * k[2]) / c) * nu, T)
+    a = 4.7e-4 * (T / 1e4) ** -0.5
+    return 1.045e-13 / np.sqrt(np.pi) * (T / 1e4) ** -0.5 * H_table(a, x) * ndens * cm_in_pc
+
+
+@jit(nopython=True)
+def grid_walk(nu, p, k, tau_target, d_max, density, velocity, temperature, lo, dx):
+    '''
+    Walks one ray through the grid cell by cell until tau_target is reached.
+    :param nu: frequency in Hz
+    :param p: position [3] in pc
+    :param k: direction [3]
+    :param tau_target: optical depth to reach
+    :param d_max: the ray stops after this distance
+    :param density: [nx,ny,nz] in cm^-3
+    :param velocity: [nx,ny,nz,3] in km/s
+    :param temperature: [nx,ny,nz] in K
+    :param lo: lower corner of the grid [3] in pc
+    :param dx: cell size [3] in pc
+    :return: distance in pc, escape flag (True if tau_target was not reached) and optical depth covered
+    '''
+    shape = density.shape
+    hi = lo + dx * np.array([shape[0], shape[1], shape[2]], dtype=np.float64)
+    d_max = min(d_max, box_exit(p, k, lo, hi))
+    idx = np.zeros(3, dtype=np.int64)
+    step = np.zeros(3, dtype=np.int64)
+    t_next = np.zeros(3)
+    t_delta = np.zeros(3)
+    for ax in range(3):
+        idx[ax] = min(max(int(np.floor((p[ax] - lo[ax]) / dx[ax])), 0), shape[ax] - 1)
+        if k[ax] > 0:
+            step[ax] = 1
+            t_next[ax] = (lo[ax] + (idx[ax] + 1) * dx[ax] - p[ax]) / k[ax]
+            t_delta[ax] = dx[ax] / k[ax]
+        elif k[ax] < 0:
+            step[ax] = -1
+            t_next[ax] = (lo[ax] + idx[ax] * dx[ax] - p[ax]) / k[ax]
+            t_delta[ax] = -dx[ax] / k[ax]
+        else:
+            t_next[ax] = np.inf
+            t_delta[ax] = np.inf
+    t = 0.
+    tau = 0.
+    while t < d_max:
+        ax = 0
+        if t_next[1] < t_next[ax]:
+            ax = 1
+        if t_next[2] < t_next[ax]:
+            ax = 2
+        t1 = min(max(t_next[ax], t), d_max)
+        i, j, l = idx[0], idx[1], idx[2]
+        kappa = cell_dtaudl(nu, k, density[i, j, l], velocity[i, j, l], temperature[i, j, l])
+        dtau = kappa * (t1 - t)
+        if tau + dtau >= tau_target:
+            return t + (tau_target - tau) / kappa, False, tau_target
+        tau += dtau
+        t = t1
+        idx[ax] += step[ax]
+        if (idx[ax] < 0) or (idx[ax] >= shape[ax]):
+            break
+        t_next[ax] += t_delta[ax]
+    return d_max, True, tau
+
+
+@jit(nopython=True)
+def grid_march_batch(nu, P, K, tau_target, d_max, density, velocity, temperature, lo, dx):
+    '''grid_walk for n rays: distances in pc [n] and escape flags [n]'''
+    n = len(nu)
+    d = np.zeros(n)
+    escaped = np.zeros(n, dtype=np.bool_)
+    for j in range(n):
+        d[j], escaped[j], tau = grid_walk(nu[j], P[j], K[j], tau_target[j], d_max[j], density, velocity,
+                                          temperature, lo, dx)
+    return d, escaped
+
+
+@jit(nopython=True)
+def grid_tau_batch(nu, P, K, d, density, velocity, temperature, lo, dx):
+    '''Optical depths along n rays from P to P + d K, or to the surface of the grid'''
+    n = len(nu)
+    tau = np.zeros(n)
+    for j in range(n):
+        tau[j] = grid_walk(nu[j], P[j], K[j], np.inf, d[j], density, velocity, temperature, lo, dx)[2]
+    return tau
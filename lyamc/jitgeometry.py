@@ -0,0 +1,556 @@
+'''
+Geometries compiled in nopython mode for the transport kernel (lyamc.kernel).
+
+A compiled geometry is a numba jitclass with an attribute R (size in pc, used for the
+core-skipping a * tau0) and the methods
+    density(p) -> cm^-3, velocity(p) -> [3] km/s, temperature(p) -> K,
+    distance_to_boundary(p, k) -> pc,
+    tau_distance(nu, p, k, tau_target, d_max) -> (distance in pc, escape flag),
+    tau(nu, p, k, d) -> optical depth over the distance d,
+for one position p [3] and direction k [3], and optionally
+    diffusion_radius(p) -> pc,
+the radius of a sphere around p in which the medium is homogeneous and static (0 if there is
+none), used by the diffusion steps of lyamc.diffusion. Analytic geometries integrate the optical
+depth with adaptive_march, gridded ones exactly cell by cell. The kernel is compiled
+once for every geometry class it is called with, so a user geometry only has to follow
+this interface; the geometries of lyamc.geometry return theirs from their kernel() method.
+
+Reduced geometries (SphereReduced, SlabReduced) have the same methods in the coordinates
+(r, mu) of a spherically symmetric or plane-parallel medium, where r is the radius or the
+height and mu the cosine to the radial direction or the normal, plus reduce(p) (reduced
+coordinate of a 3-D position), move(r, mu, d) and embed(r, mu); they are used by lyamc.reduced.
+'''
+
+import numpy as np
+from numba import jit, boolean, float64, int64, types
+from numba.experimental import jitclass
+
+from lyamc.atomic import H_table, invert_linear, linear_tau, linear_tau_distance
+from lyamc.boundary import box_exit, slab_exit, sphere_exit
+from lyamc.general import get_x, c, cm_in_pc
+from lyamc.grid import cell_dtaudl, grid_walk
+from lyamc.octree import find_leaf, octree_walk
+
+array1d = types.Array(float64, 1, 'C', readonly=True)
+array2d = types.Array(float64, 2, 'C', readonly=True)
+array3d = types.Array(float64, 3, 'C', readonly=True)
+array4d = types.Array(float64, 4, 'C', readonly=True)
+
+
+def readonly(a, dtype=float):
+    '''Read-only C-contiguous view of a (copied if needed), as expected by the compiled geometries'''
+    a = np.ascontiguousarray(a, dtype=dtype).view()
+    a.flags.writeable = False
+    return a
+
+
+@jit(nopython=True)
+def dtaudl(nu, p, k, geom):
+    '''d\\tau / dl for l in pc at p, same as lyamc.atomic.DtauDl for one point'''
+    ndens = geom.density(p)
+    if ndens <= 0:
+        return 0.
+    T = geom.temperature(p)
+    u = geom.velocity(p)
+    x = get_x((1. - (u[0] * k[0] + u[1] * k[1] + u[2] * k[2]) / c) * nu, T)
+    a = 4.7e-4 * (T / 1e4) ** -0.5
+    return 1.045e-13 / np.sqrt(np.pi) * (T / 1e4) ** -0.5 * H_table(a, x) * ndens * cm_in_pc
+
+
+@jit(nopython=True)
+def ray_dtaudl(nu, p, k, l, geom):
+    '''d\\tau / dl at the distance l along the ray from p along k'''
+    return dtaudl(nu, p + k * l, k, geom)
+
+
+@jit(nopython=True)
+def _march(nu, p, k, tau_target, d_max, geom, rtol, atol, along):
+    '''
+    Adaptive march of adaptive_march and reduced_march
+    :param p, k: start of the ray, a position and direction or reduced coordinates
+    :param along: compiled function along(nu, p, k, l, geom) that gives d\\tau / dl at the distance l
+    :return: distance, escape flag and optical depth covered
+    '''
+    l = 0.
+    tau = 0.
+    f0 = along(nu, p, k, 0., geom)
+    if f0 > 0:
+        h = min(0.5 * max(tau_target, 0.1) / f0, d_max)
+    else:
+        h = 1e-3 * d_max
+    while l < d_max:
+        hh = min(h, d_max - l)
+        fm = along(nu, p, k, l + hh / 2., geom)
+        f2 = along(nu, p, k, l + hh, geom)
+        trap = hh / 2. * (f0 + f2)
+        simp = hh / 6. * (f0 + 4. * fm + f2)
+        err = np.abs(simp - trap)
+        tol = rtol * simp + atol
+        if err > 0:
+            h = hh * min(max(0.9 * (tol / err) ** (1. / 3.), 0.2), 4.)
+        else:
+            h = hh * 4.
+        if err > tol:
+            continue
+        need = tau_target - tau
+        if simp >= need:
+            I1 = hh / 4. * (f0 + fm)
+            if need <= I1:
+                return l + invert_linear(f0, fm, hh / 2., need), False, tau_target
+            return l + hh / 2. + invert_linear(fm, f2, hh / 2., need - I1), False, tau_target
+        l += hh
+        tau += simp
+        f0 = f2
+    return d_max, True, tau
+
+
+@jit(nopython=True)
+def adaptive_march(nu, p, k, tau_target, d_max, geom, rtol=1e-3, atol=1e-4):
+    '''
+    Integrates d\\tau / dl along the ray with steps adapted to the local mean free path and to the
+    local error (Simpson vs trapezoid) until tau_target is reached or the ray leaves after d_max.
+    lyamc.trajectory.march_to_tau_batch runs it for the geometries of lyamc.geometry.
+    :return: distance in pc and escape flag
+    '''
+    d, escaped, tau = _march(nu, p, k, tau_target, d_max, geom, rtol, atol, ray_dtaudl)
+    return d, escaped
+
+
+@jit(nopython=True)
+def adaptive_tau(nu, p, k, d, geom, rtol=1e-3, atol=1e-4):
+    '''Optical depth from p along k over the distance d, integrated as in adaptive_march'''
+    return _march(nu, p, k, np.inf, d, geom, rtol, atol, ray_dtaudl)[2]
+
+
+@jit(nopython=True)
+def homogeneous_tau_distance(nu, p, k, tau_target, d_max, geom):
+    '''
+    Exact distance sampling in a homogeneous static medium: the photon escapes in this step
+    if tau_target is larger than the optical depth to the boundary at distance d_max
+    '''
+    kappa = dtaudl(nu, p, k, geom)
+    if tau_target >= kappa * d_max:
+        return d_max, True
+    return tau_target / kappa, False
+
+
+@jit(nopython=True)
+def _linear_velocity_ray(nu, p, k, d, geom):
+    '''K, a, x0 and x1 of lyamc.atomic.linear_tau_distance for the ray from p to p + d k'''
+    T = geom.temperature(p)
+    u0 = geom.velocity(p)
+    u1 = geom.velocity(p + k * d)
+    x0 = get_x((1. - (u0[0] * k[0] + u0[1] * k[1] + u0[2] * k[2]) / c) * nu, T)
+    x1 = get_x((1. - (u1[0] * k[0] + u1[1] * k[1] + u1[2] * k[2]) / c) * nu, T)
+    K = 1.045e-13 / np.sqrt(np.pi) * (T / 1e4) ** -0.5 * geom.density(p) * cm_in_pc
+    return K, 4.7e-4 * (T / 1e4) ** -0.5, x0, x1
+
+
+@jit(nopython=True)
+def linear_velocity_tau_distance(nu, p, k, tau_target, d_max, geom):
+    '''
+    Exact distance sampling with uniform density and temperature and a velocity that is linear
+    in position: x is linear along the ray and the optical depth follows from the cumulative
+    Voigt function, see lyamc.atomic.linear_tau_distance
+    '''
+    K, a, x0, x1 = _linear_velocity_ray(nu, p, k, d_max, geom)
+    return linear_tau_distance(tau_target, d_max, K, a, x0, x1)
+
+
+@jit(nopython=True)
+def linear_velocity_tau(nu, p, k, d, geom):
+    '''Optical depth over the distance d in the media of linear_velocity_tau_distance'''
+    K, a, x0, x1 = _linear_velocity_ray(nu, p, k, d, geom)
+    return linear_tau(d, K, a, x0, x1)
+
+
+@jitclass([('R', float64), ('n', float64), ('T', float64)])
+class NeufeldKernel:
+    '''Compiled Neufeld_test: slab |x| < R'''
+
+    def __init__(self, R, n, T):
+        self.R = R
+        self.n = n
+        self.T = T
+
+    def density(self, p):
+        if np.abs(p[0]) > self.R:
+            return 0.
+        return self.n
+
+    def velocity(self, p):
+        return np.zeros(3)
+
+    def temperature(self, p):
+        return self.T
+
+    def distance_to_boundary(self, p, k):
+        return slab_exit(p, k, self.R, 0)
+
+    def diffusion_radius(self, p):
+        return max(self.R - np.abs(p[0]), 0.)
+
+    def tau_distance(self, nu, p, k, tau_target, d_max):
+        return homogeneous_tau_distance(nu, p, k, tau_target, d_max, self)
+
+    def tau(self, nu, p, k, d):
+        return dtaudl(nu, p, k, self) * d
+
+
+@jitclass([('R', float64), ('n', float64), ('T', float64), ('gradV', float64)])
+class PlaneKernel:
+    '''Compiled plane_gradient'''
+
+    def __init__(self, R, n, T, gradV):
+        self.R = R
+        self.n = n
+        self.T = T
+        self.gradV = gradV
+
+    def density(self, p):
+        return self.n
+
+    def velocity(self, p):
+        v = np.zeros(3)
+        v[0] = p[2] * self.gradV
+        return v
+
+    def temperature(self, p):
+        return self.T
+
+    def distance_to_boundary(self, p, k):
+        return 2 * self.R
+
+    def diffusion_radius(self, p):
+        # the medium has no surface, escape is a flight longer than 2 R
+        return 0.
+
+    def tau_distance(self, nu, p, k, tau_target, d_max):
+        if self.gradV == 0:
+            return homogeneous_tau_distance(nu, p, k, tau_target, d_max, self)
+        return linear_velocity_tau_distance(nu, p, k, tau_target, d_max, self)
+
+    def tau(self, nu, p, k, d):
+        if self.gradV == 0:
+            return dtaudl(nu, p, k, self) * d
+        return linear_velocity_tau(nu, p, k, d, self)
+
+
+@jitclass([('R', float64), ('nbar', float64), ('T', float64), ('A', float64), ('V', float64),
+           ('DeltaV', float64)])
+class ZhengKernel:
+    '''Compiled Zheng_sphere'''
+
+    def __init__(self, R, nbar, T, A, V, DeltaV):
+        self.R = R
+        self.nbar = nbar
+        self.T = T
+        self.A = A
+        self.V = V
+        self.DeltaV = DeltaV
+
+    def density(self, p):
+        if p[0] ** 2 + p[1] ** 2 + p[2] ** 2 > self.R ** 2:
+            return 0.
+        return self.nbar * (1.0 - 2.0 * self.A * p[2] / self.R)
+
+    def velocity(self, p):
+        v = p / self.R * self.V
+        v[2] += p[2] / self.R * self.DeltaV
+        return v
+
+    def temperature(self, p):
+        return self.T
+
+    def distance_to_boundary(self, p, k):
+        return sphere_exit(p, k, self.R)
+
+    def diffusion_radius(self, p):
+        if (self.A != 0) or (self.V != 0) or (self.DeltaV != 0):
+            return 0.
+        return max(self.R - np.sqrt(p[0] ** 2 + p[1] ** 2 + p[2] ** 2), 0.)
+
+    def tau_distance(self, nu, p, k, tau_target, d_max):
+        if (self.A == 0) and (self.V == 0) and (self.DeltaV == 0):
+            return homogeneous_tau_distance(nu, p, k, tau_target, d_max, self)
+        elif self.A == 0:
+            return linear_velocity_tau_distance(nu, p, k, tau_target, d_max, self)
+        return adaptive_march(nu, p, k, tau_target, d_max, self)
+
+    def tau(self, nu, p, k, d):
+        if (self.A == 0) and (self.V == 0) and (self.DeltaV == 0):
+            return dtaudl(nu, p, k, self) * d
+        elif self.A == 0:
+            return linear_velocity_tau(nu, p, k, d, self)
+        return adaptive_tau(nu, p, k, d, self)
+
+
+@jitclass([('R', float64), ('density_grid', array3d), ('velocity_grid', array4d), ('temperature_grid', array3d),
+           ('lo', array1d), ('dx', array1d), ('hi', array1d)])
+class GridKernel:
+    '''Compiled Cartesian_grid'''
+
+    def __init__(self, density, velocity, temperature, lo, dx, R):
+        self.density_grid = density
+        self.velocity_grid = velocity
+        self.temperature_grid = temperature
+        self.lo = lo
+        self.dx = dx
+        self.hi = lo + dx * np.array([density.shape[0], density.shape[1], density.shape[2]], dtype=np.float64)
+        self.R = R
+
+    def cell(self, p):
+        '''Cell index of p, clipped to the grid, and whether p is inside'''
+        shape = self.density_grid.shape
+        idx = np.zeros(3, dtype=np.int64)
+        inside = True
+        for ax in range(3):
+            f = int(np.floor((p[ax] - self.lo[ax]) / self.dx[ax]))
+            if (f < 0) or (f >= shape[ax]):
+                inside = False
+            idx[ax] = min(max(f, 0), shape[ax] - 1)
+        return idx, inside
+
+    def density(self, p):
+        idx, inside = self.cell(p)
+        if not inside:
+            return 0.
+        return self.density_grid[idx[0], idx[1], idx[2]]
+
+    def velocity(self, p):
+        idx, inside = self.cell(p)
+        if not inside:
+            return np.zeros(3)
+        return self.velocity_grid[idx[0], idx[1], idx[2]].copy()
+
+    def temperature(self, p):
+        idx, inside = self.cell(p)
+        return self.temperature_grid[idx[0], idx[1], idx[2]]
+
+    def distance_to_boundary(self, p, k):
+        return box_exit(p, k, self.lo, self.hi)
+
+    def diffusion_radius(self, p):
+        '''Distance to the nearest face of the cell of p'''
+        idx, inside = self.cell(p)
+        if not inside:
+            return 0.
+        r = np.inf
+        for ax in range(3):
+            f = p[ax] - self.lo[ax] - idx[ax] * self.dx[ax]
+            r = min(r, f, self.dx[ax] - f)
+        return max(r, 0.)
+
+    def tau_distance(self, nu, p, k, tau_target, d_max):
+        d, escaped, tau = grid_walk(nu, p, k, tau_target, d_max, self.density_grid, self.velocity_grid,
+                                    self.temperature_grid, self.lo, self.dx)
+        return d, escaped
+
+    def tau(self, nu, p, k, d):
+        return grid_walk(nu, p, k, np.inf, d, self.density_grid, self.velocity_grid, self.temperature_grid,
+                         self.lo, self.dx)[2]
+
+
+@jitclass([('R', float64), ('child', types.Array(int64, 1, 'C', readonly=True)), ('node_density', array1d),
+           ('node_velocity', array2d), ('node_temperature', array1d), ('lo', array1d), ('size', array1d)])
+class OctreeKernel:
+    '''Compiled Octree_grid'''
+
+    def __init__(self, child, density, velocity, temperature, lo, size, R):
+        self.child = child
+        self.node_density = density
+        self.node_velocity = velocity
+        self.node_temperature = temperature
+        self.lo = lo
+        self.size = size
+        self.R = R
+
+    def leaf(self, p):
+        '''Leaf containing p, -1 outside the box'''
+        for ax in range(3):
+            if (p[ax] < self.lo[ax]) or (p[ax] >= self.lo[ax] + self.size[ax]):
+                return -1
+        return find_leaf(p, np.zeros(3), self.child, self.lo, self.size)[0]
+
+    def density(self, p):
+        j = self.leaf(p)
+        if j < 0:
+            return 0.
+        return self.node_density[j]
+
+    def velocity(self, p):
+        j = self.leaf(p)
+        if j < 0:
+            return np.zeros(3)
+        return self.node_velocity[j].copy()
+
+    def temperature(self, p):
+        return self.node_temperature[max(self.leaf(p), 0)]
+
+    def distance_to_boundary(self, p, k):
+        return box_exit(p, k, self.lo, self.lo + self.size)
+
+    def diffusion_radius(self, p):
+        '''Distance to the nearest face of the leaf of p, leaves being uniform'''
+        if self.leaf(p) < 0:
+            return 0.
+        j, corner, s = find_leaf(p, np.zeros(3), self.child, self.lo, self.size)
+        r = np.inf
+        for ax in range(3):
+            r = min(r, p[ax] - corner[ax], corner[ax] + s[ax] - p[ax])
+        return max(r, 0.)
+
+    def tau_distance(self, nu, p, k, tau_target, d_max):
+        d, escaped, tau = octree_walk(nu, p, k, tau_target, d_max, self.child, self.node_density,
+                                      self.node_velocity, self.node_temperature, self.lo, self.size)
+        return d, escaped
+
+    def tau(self, nu, p, k, d):
+        return octree_walk(nu, p, k, np.inf, d, self.child, self.node_density, self.node_velocity,
+                           self.node_temperature, self.lo, self.size)[2]
+
+
+# ---------------------------------------------------------------------
+# Symmetry-reduced geometries
+# ---------------------------------------------------------------------
+@jit(nopython=True)
+def reduced_dtaudl(nu, r, mu, geom):
+    '''d\\tau / dl in 1/pc at the reduced coordinates (r, mu)'''
+    return cell_dtaudl(nu, np.array([0., 0., mu]), geom.density(r), np.array([0., 0., geom.velocity(r)]),
+                       geom.temperature(r))
+
+
+@jit(nopython=True)
+def reduced_ray_dtaudl(nu, r, mu, l, geom):
+    '''d\\tau / dl at the distance l along the ray that starts at the reduced coordinates (r, mu)'''
+    r2, mu2 = geom.move(r, mu, l)
+    return reduced_dtaudl(nu, r2, mu2, geom)
+
+
+@jit(nopython=True)
+def reduced_march(nu, r, mu, tau_target, d_max, geom, rtol=1e-3, atol=1e-4):
+    '''adaptive_march along a ray given by its reduced coordinates'''
+    d, escaped, tau = _march(nu, r, mu, tau_target, d_max, geom, rtol, atol, reduced_ray_dtaudl)
+    return d, escaped
+
+
+@jit(nopython=True)
+def _random_unit():
+    k = np.random.normal(0., 1., 3)
+    return k / np.sqrt(np.sum(k ** 2))
+
+
+@jit(nopython=True)
+def _around(e, mu):
+    '''Unit vector at cosine mu from the unit vector e, with a random azimuth'''
+    if np.abs(e[0]) < 0.9:
+        t = np.array([1., 0., 0.])
+    else:
+        t = np.array([0., 1., 0.])
+    e0 = np.cross(e, t)
+    e0 /= np.sqrt(np.sum(e0 ** 2))
+    e1 = np.cross(e, e0)
+    phi = np.random.rand() * 2. * np.pi
+    s = np.sqrt(max(1. - mu ** 2, 0.))
+    return mu * e + s * (np.cos(phi) * e0 + np.sin(phi) * e1)
+
+
+@jitclass([('R', float64), ('nbar', float64), ('T', float64), ('V', float64)])
+class SphereReduced:
+    '''Sphere of radius R with density nbar, temperature T and radial velocity V r / R (Zheng_sphere, A = 0)'''
+
+    def __init__(self, R, nbar, T, V):
+        self.R = R
+        self.nbar = nbar
+        self.T = T
+        self.V = V
+
+    def density(self, r):
+        if r > self.R:
+            return 0.
+        return self.nbar
+
+    def velocity(self, r):
+        return r / self.R * self.V
+
+    def temperature(self, r):
+        return self.T
+
+    def reduce(self, p):
+        return np.sqrt(p[0] ** 2 + p[1] ** 2 + p[2] ** 2)
+
+    def move(self, r, mu, d):
+        r2 = np.sqrt(max(r ** 2 + 2. * r * mu * d + d ** 2, 0.))
+        if r2 <= 0:
+            return 0., 1.
+        return r2, min(max((r * mu + d) / r2, -1.), 1.)
+
+    def distance_to_boundary(self, r, mu):
+        return -r * mu + np.sqrt(max((r * mu) ** 2 - r ** 2 + self.R ** 2, 0.))
+
+    def tau_distance(self, nu, r, mu, tau_target, d_max):
+        if self.V == 0:
+            # homogeneous and static: exact
+            kappa = reduced_dtaudl(nu, r, mu, self)
+            if tau_target >= kappa * d_max:
+                return d_max, True
+            return tau_target / kappa, False
+        return reduced_march(nu, r, mu, tau_target, d_max, self)
+
+    def embed(self, r, mu):
+        '''Position and direction in 3-D, randomly oriented'''
+        e = _random_unit()
+        return r * e, _around(e, mu)
+
+
+@jitclass([('R', float64), ('n', float64), ('T', float64), ('axis', int64), ('infinite', boolean)])
+class SlabReduced:
+    '''
+    Static homogeneous slab |z| < R with normal along the given axis (Neufeld_test), or an infinite
+    medium in which photons that travel further than 2 R escape (plane_gradient without gradient)
+    '''
+
+    def __init__(self, R, n, T, axis, infinite):
+        self.R = R
+        self.n = n
+        self.T = T
+        self.axis = axis
+        self.infinite = infinite
+
+    def density(self, z):
+        if (not self.infinite) and (np.abs(z) > self.R):
+            return 0.
+        return self.n
+
+    def velocity(self, z):
+        return 0.
+
+    def temperature(self, z):
+        return self.T
+
+    def reduce(self, p):
+        return p[self.axis]
+
+    def move(self, z, mu, d):
+        return z + mu * d, mu
+
+    def distance_to_boundary(self, z, mu):
+        if self.infinite:
+            return 2 * self.R
+        if mu > 0:
+            return (self.R - z) / mu
+        elif mu < 0:
+            return (-self.R - z) / mu
+        return np.inf
+
+    def tau_distance(self, nu, z, mu, tau_target, d_max):
+        kappa = reduced_dtaudl(nu, z, mu, self)
+        if tau_target >= kappa * d_max:
+            return d_max, True
+        return tau_target / kappa, False
+
+    def embed(self, z, mu):
+        '''Position and direction in 3-D, with a random azimuth about the normal'''
+        e = np.zeros(3)
+        e[self.axis] = 1.
+        return z * e, _around(e, mu)
@@ -0,0 +1,262 @@
+'''
+Single-photon transport kernel compiled in nopython mode.
+
+A photon is followed from emission to escape (distance sampling, atom velocity,
+scattering and frequency update) without returning to the interpreter.
+Geometries are passed as compiled (jitclass) objects, see lyamc.jitgeometry.
+'''
+
+import numpy as np
+from numba import jit
+
+from lyamc.general import get_a, get_nu, get_vth, get_x, sigmaa0, c, cm_in_pc
+from lyamc.geometry import Geometry
+from lyamc.rng import photon_rng, photon_seed
+import lyamc.cons as cons
+
+m_hz = cons.MHK * cons.K2HZ
+
+
+def kernel_geometry(geom):
+    '''
+    Compiled form of a geometry, see lyamc.jitgeometry.
+    :param geom: geometry of lyamc.geometry, or a compiled geometry which is returned as it is
+    :return: jitclass instance
+    '''
+    if isinstance(geom, Geometry):
+        return geom.kernel()
+    return geom
+
+
+# ---------------------------------------------------------------------
+# Atom velocity and scattering
+# ---------------------------------------------------------------------
+@jit(nopython=True)
+def _par_velocity_zm(x, a):
+    '''Zheng & Miralda-Escude (2002) rejection sampler, parallel velocity in units of vth'''
+    s = 1.
+    if x < 0:
+        s = -1.
+        x = -x
+    if x < 3.:
+        u0 = x - 0.01 * a ** (1. / 6.) * np.exp(1.2 * x)
+    else:
+        u0 = 1.85 - np.log(a) / 6.73 + np.log(np.log(x))
+        if x < 4.:
+            u0 = min(u0, x - 0.01 * a ** (1. / 6.) * np.exp(1.2 * x))
+    u0 = max(u0, 0.)
+    theta0 = np.arctan((u0 - x) / a)
+    p = (theta0 + np.pi / 2) / ((1. - np.exp(-u0 ** 2)) * theta0 + (1. + np.exp(-u0 ** 2)) * np.pi / 2.)
+    while True:
+        if np.random.rand() < p:
+            theta = np.random.rand() * (theta0 + np.pi / 2.) - np.pi / 2
+        else:
+            theta = np.random.rand() * (np.pi / 2. - theta0) + theta0
+        u = a * np.tan(theta) + x
+        acc = np.random.rand()
+        if u <= u0:
+            if acc < np.exp(-u ** 2):
+                return s * u
+        elif acc < np.exp(u0 ** 2 - u ** 2):
+            return s * u
+
+
+@jit(nopython=True)
+def _perp_basis(k):
+    '''Two unit vectors perpendicular to k and to each other'''
+    if np.abs(k[0]) < 0.9:
+        e = np.array([1., 0., 0.])
+    else:
+        e = np.array([0., 1., 0.])
+    e0 = np.cross(k, e)
+    e0 /= np.sqrt(np.sum(e0 ** 2))
+    return e0, np.cross(k, e0)
+
+
+@jit(nopython=True)
+def _perp_velocity(x, T, k, x_crit):
+    '''Perpendicular atom velocity in km/s, with core-skipping for |x| < x_crit'''
+    vth = get_vth(T)
+    e0, e1 = _perp_basis(k)
+    if np.abs(x) < x_crit:
+        u = np.sqrt(x_crit ** 2 - np.log(np.random.rand()))
+        phi = np.random.rand() * 2. * np.pi
+        return u * vth * (np.cos(phi) * e0 + np.sin(phi) * e1)
+    return vth / np.sqrt(2) * (np.random.normal() * e0 + np.random.normal() * e1)
+
+
+@jit(nopython=True)
+def _boost(E, n, v):
+    '''Boosts a photon with energy E and direction n into the frame moving with velocity v (units of c)'''
+    v2 = v[0] ** 2 + v[1] ** 2 + v[2] ** 2
+    if v2 == 0:
+        return E, n.copy()
+    gamma = 1.0 / np.sqrt(1.0 - v2)
+    vn = v[0] * n[0] + v[1] * n[1] + v[2] * n[2]
+    E_out = gamma * E * (1.0 - vn)
+    n_out = n + ((gamma - 1.) * vn / v2 - gamma) * v
+    n_out /= np.sqrt(np.sum(n_out ** 2))
+    return E_out, n_out
+
+
+@jit(nopython=True)
+def _samplephase(k):
+    '''New direction drawn from the phase function ~ (1 + mu^2) around k'''
+    r = np.random.rand()
+    q = (-2.0 + 4.0 * r + np.sqrt(5.0 - 16.0 * r + 16.0 * r ** 2)) ** (1.0 / 3.0)
+    mu = q - 1 / q
+    phi = np.random.rand() * 2.0 * np.pi
+    e0, e1 = _perp_basis(k)
+    s = np.sqrt(max(1.0 - mu ** 2, 0.))
+    return mu * k + s * (np.cos(phi) * e0 + np.sin(phi) * e1)
+
+
+@jit(nopython=True)
+def _to_com(E, n, v):
+    '''Photon with frequency E (units of hydrogen mass) and direction n in the centre of momentum frame of
+    its scattering on an atom with velocity v (units of c): frequency, direction and velocity of the frame'''
+    E_arf, n_arf = _boost(E, n, v)
+    v_com = E_arf / (1.0 + E_arf) * n_arf
+    E_com, n_com = _boost(E_arf, n_arf, v_com)
+    return E_com, n_com, v_com
+
+
+@jit(nopython=True)
+def _from_com(E_com, n_out, v_com, v):
+    '''Frequency and direction in the lab frame of a photon leaving the scattering with direction n_out'''
+    E_arf, n_arf = _boost(E_com, n_out, -v_com)
+    return _boost(E_arf, n_arf, -v)
+
+
+@jit(nopython=True)
+def _scatter(E, n, v):
+    '''
+    Same as lyamc.coordinates.scattering_lab_frame for one photon
+    :param E: frequency in units of hydrogen mass
+    :param n: direction
+    :param v: atom velocity in units of c
+    :return: new frequency and direction
+    '''
+    E_com, n_com, v_com = _to_com(E, n, v)
+    return _from_com(E_com, _samplephase(n_com), v_com, v)
+
+
+# ---------------------------------------------------------------------
+# Transport
+# ---------------------------------------------------------------------
+@jit(nopython=True)
+def get_xcrit(T, ndens, R):
+    '''Core-skipping x_crit = 0.2 (a tau0)^(1/3), 0 for a tau0 < 1'''
+    atau0 = get_a(T) * sigmaa0(T) * ndens * R * cm_in_pc
+    if atau0 > 1:
+        return 0.2 * atau0 ** (1. / 3.)
+    return 0.
+
+
+@jit(nopython=True)
+def atom_velocity(nu, k, u, T, x_crit):
+    '''
+    Velocity of the atom a photon scatters on, drawn from the local gas.
+    :param nu: frequency in Hz
+    :param k: direction
+    :param u: bulk velocity [3] in km/s
+    :param T: temperature in K
+    :param x_crit: core-skipping threshold, 0 for none
+    :return: atom velocity [3] in km/s
+    '''
+    vth = get_vth(T)
+    x_gas = get_x(nu * (1. - (u[0] * k[0] + u[1] * k[1] + u[2] * k[2]) / c), T)
+    return u + _par_velocity_zm(x_gas, get_a(T)) * vth * k + _perp_velocity(x_gas, T, k, x_crit)
+
+
+@jit(nopython=True)
+def scatter_atom(nu, k, u, T, x_crit):
+    '''
+    Scatters a photon on an atom drawn from the local gas, see atom_velocity
+    :return: new frequency in Hz and direction
+    '''
+    E, k = _scatter(nu / m_hz, k, atom_velocity(nu, k, u, T, x_crit) / c)
+    return E * m_hz, k
+
+
+@jit(nopython=True)
+def run_photon(p, k, x, geom, T_ic, N=10000, core_skip=False):
+    '''
+    Follows one photon from emission to escape. The photon carries its frequency in the lab frame,
+    which is converted to the local x only for the optical depths and the atom velocities.
+    :param p: initial position in pc
+    :param k: initial direction
+    :param x: initial dimensionless frequency
+    :param geom: compiled geometry, see lyamc.jitgeometry
+    :param T_ic: temperature of the initial and final x (as in runner.py)
+    :param N: maximum number of scatterings
+    :param core_skip: skip core scatterings, x_crit is set by the local a * tau0
+    :return: position of the last scattering, final direction, final frequency, number of scatterings
+    '''
+    p = p.copy()
+    k = k.copy()
+    nu = get_nu(x, T_ic)
+    i = 0
+    while i < N - 1:
+        d_max = geom.distance_to_boundary(p, k)
+        d, escaped = geom.tau_distance(nu, p, k, -np.log(np.random.rand()), d_max)
+        if escaped:
+            break
+        p_new = p + k * d
+        T = geom.temperature(p_new)
+        x_crit = 0.
+        if core_skip:
+            x_crit = get_xcrit(T, geom.density(p_new), geom.R)
+        nu, k = scatter_atom(nu, k, geom.velocity(p_new), T, x_crit)
+        p = p_new
+        i += 1
+    return p, k, get_x(nu, T_ic), i
+
+
+@jit(nopython=True)
+def seed_kernel(seed):
+    '''Seeds the random generator of the compiled code, which is separate from numpy's'''
+    np.random.seed(seed)
+
+
+@jit(nopython=True)
+def _run_photons(P, x0, geom, T_ic, N, core_skip, seed, first_id):
+    n = len(P)
+    p_last = np.zeros((n, 3))
+    k_last = np.zeros((n, 3))
+    x_last = np.zeros(n)
+    i_last = np.zeros(n, dtype=np.int64)
+    for j in range(n):
+        if seed >= 0:
+            np.random.seed(photon_seed(seed, first_id + j))
+        k = np.random.normal(0., 1., 3)
+        k /= np.sqrt(np.sum(k ** 2))
+        p_last[j], k_last[j], x_last[j], i_last[j] = run_photon(P[j], k, x0, geom, T_ic, N, core_skip)
+    return p_last, k_last, x_last, i_last
+
+
+def run_photons(geom, nsim, x0=0., N=10000, core_skip=False, seed=None, first_id=0, P=None):
+    '''
+    Runs nsim photons through the geometry with the compiled kernel.
+    The output matches runner.py and lyamc.transport.run_batch.
+    :param geom: geometry of lyamc.geometry or a compiled geometry (lyamc.jitgeometry)
+    :param nsim: number of photons
+    :param x0: initial dimensionless frequency
+    :param N: maximum number of scatterings per photon
+    :param core_skip: skip core scatterings
+    :param seed: seed of the run; each photon then gets its own stream, see lyamc.rng
+    :param first_id: id of the first photon, photons are first_id, ..., first_id + nsim - 1
+    :param P: emission points [nsim,3]; by default from geom.get_ICs, or the origin for a compiled geometry
+    :return: p [nsim,3], k [nsim,3], x [nsim], i [nsim]
+    '''
+    g = kernel_geometry(geom)
+    if P is not None:
+        P = np.ascontiguousarray(P, dtype=float).reshape(-1, 3)
+    elif not isinstance(geom, Geometry):
+        P = np.zeros((nsim, 3))
+    elif seed is None:
+        P = geom.get_ICs(nsim)
+    else:
+        P = np.array([geom.get_IC(photon_rng(seed, first_id + j)) for j in range(nsim)], dtype=float).reshape(-1, 3)
+    T_ic = float(g.temperature(P[0]))
+    return _run_photons(P, float(x0), g, T_ic, N, core_skip, -1 if seed is None else int(seed), int(first_id))
@@ -0,0 +1,160 @@
+'''
+Octree built from a uniform grid and ray traversal of its leaves.
+
+A node becomes a leaf when its cells are empty or smooth (density and temperature
+within a relative tolerance, velocity within a fraction of the thermal velocity); the
+leaf keeps the mean of its cells. Nodes are stored breadth first in flat arrays, the
+8 children of a node being contiguous, so the traversal runs in nopython mode: a ray
+descends to the leaf that contains it, crosses the leaf in one step (exact optical
+depth, as in lyamc.grid) and continues from the exit point.
+'''
+
+import numpy as np
+from numba import jit
+
+from lyamc.boundary import box_exit
+from lyamc.general import get_vth
+from lyamc.grid import cell_dtaudl
+
+
+def _coarsen(a, op):
+    '''Reduces 2x2x2 blocks of a [n,n,n,...] to [n/2,n/2,n/2,...]'''
+    n = a.shape[0] // 2
+    return op(op(op(a.reshape((n, 2, n, 2, n, 2) + a.shape[3:]), axis=1), axis=2), axis=3)
+
+
+def build_octree(density, velocity, temperature, rtol=0.05, vtol=0.1):
+    '''
+    Octree of a cubic grid with 2^m cells per side.
+    :param density: [n,n,n] in cm^-3
+    :param velocity: [n,n,n,3] in km/s
+    :param temperature: [n,n,n] in K
+    :param rtol: relative tolerance of density and temperature within a leaf
+    :param vtol: tolerance of the velocity within a leaf in units of the thermal velocity
+    :return: child [nnodes] (index of the first child, -1 for leaves), level [nnodes], density [nnodes],
+             velocity [nnodes,3] and temperature [nnodes] of the nodes
+    '''
+    n = density.shape[0]
+    m = int(round(np.log2(n)))
+    if (2 ** m != n) or (density.shape != (n, n, n)):
+        raise ValueError('the octree needs a cubic grid with 2^m cells per side, got %s' % str(density.shape))
+    # block statistics on every level, level m are the cells
+    dens, vel, T = np.asarray(density), np.asarray(velocity), np.asarray(temperature)
+    stats = [None] * (m + 1)
+    stats[m] = (dens, dens, dens, vel, vel, vel, T, T, T)
+    for l in range(m - 1, -1, -1):
+        dmin, dmax, dmean, vmin, vmax, vmean, Tmin, Tmax, Tmean = stats[l + 1]
+        stats[l] = (_coarsen(dmin, np.min), _coarsen(dmax, np.max), _coarsen(dmean, np.mean),
+                    _coarsen(vmin, np.min), _coarsen(vmax, np.max), _coarsen(vmean, np.mean),
+                    _coarsen(Tmin, np.min), _coarsen(Tmax, np.max), _coarsen(Tmean, np.mean))
+    child, level, ndens, nvel, ntemp = [], [], [], [], []
+    nnodes = 1
+    active = np.zeros((1, 3), dtype=np.int64)
+    octants = np.array([[i, j, k] for i in range(2) for j in range(2) for k in range(2)], dtype=np.int64)
+    for l in range(m + 1):
+        dmin, dmax, dmean, vmin, vmax, vmean, Tmin, Tmax, Tmean = stats[l]
+        i, j, k = active[:, 0], active[:, 1], active[:, 2]
+        leaf = (dmax[i, j, k] <= 0) | (l == m)
+        smooth = (dmax[i, j, k] - dmin[i, j, k] <= rtol * dmean[i, j, k]) & \
+                 (Tmax[i, j, k] - Tmin[i, j, k] <= rtol * Tmean[i, j, k]) & \
+                 np.all(vmax[i, j, k] - vmin[i, j, k] <= vtol * get_vth(Tmin[i, j, k]).reshape(-1, 1), axis=1)
+        leaf |= smooth
+        first = np.full(len(active), -1, dtype=np.int64)
+        first[~leaf] = nnodes + 8 * np.arange((~leaf).sum())
+        nnodes += 8 * (~leaf).sum()
+        child.append(first)
+        level.append(np.full(len(active), l, dtype=np.int64))
+        ndens.append(np.where(leaf, dmean[i, j, k], 0.))
+        nvel.append(np.where(leaf.reshape(-1, 1), vmean[i, j, k], 0.))
+        ntemp.append(Tmean[i, j, k])
+        active = (2 * active[~leaf].reshape(-1, 1, 3) + octants.reshape(1, 8, 3)).reshape(-1, 3)
+    return np.concatenate(child), np.concatenate(level), np.concatenate(ndens), np.concatenate(nvel), \
+           np.concatenate(ntemp)
+
+
+@jit(nopython=True)
+def find_leaf(p, k, child, lo, size):
+    '''
+    Leaf containing p; on a face between nodes the one k points into.
+    :param p: position [3] in pc
+    :param k: direction [3]
+    :param child: index of the first child of each node, -1 for leaves
+    :param lo: lower corner of the root [3] in pc
+    :param size: size of the root [3] in pc
+    :return: index of the leaf, its lower corner [3] and size [3]
+    '''
+    node = 0
+    corner = lo.copy()
+    s = size.copy()
+    while child[node] >= 0:
+        s /= 2.
+        o = 0
+        for ax in range(3):
+            mid = corner[ax] + s[ax]
+            if (p[ax] > mid) or ((p[ax] == mid) and (k[ax] > 0)):
+                o += 4 >> ax
+                corner[ax] = mid
+        node = child[node] + o
+    return node, corner, s
+
+
+@jit(nopython=True)
+def octree_walk(nu, p, k, tau_target, d_max, child, density, velocity, temperature, lo, size):
+    '''
+    Walks one ray leaf by leaf until tau_target is reached, see lyamc.grid.grid_walk
+    :return: distance in pc, escape flag and optical depth covered
+    '''
+    hi = lo + size
+    d_max = min(d_max, box_exit(p, k, lo, hi))
+    eps = 1e-12 * size.max()
+    t = 0.
+    tau = 0.
+    q = p.copy()
+    while t < d_max:
+        node, corner, s = find_leaf(q, k, child, lo, size)
+        t1 = min(t + max(box_exit(q, k, corner, corner + s), eps), d_max)
+        kappa = cell_dtaudl(nu, k, density[node], velocity[node], temperature[node])
+        dtau = kappa * (t1 - t)
+        if tau + dtau >= tau_target:
+            return t + (tau_target - tau) / kappa, False, tau_target
+        tau += dtau
+        t = t1
+        q = p + k * t
+    return d_max, True, tau
+
+
+@jit(nopython=True)
+def octree_march_batch(nu, P, K, tau_target, d_max, child, density, velocity, temperature, lo, size):
+    '''octree_walk for n rays: distances in pc [n] and escape flags [n]'''
+    n = len(nu)
+    d = np.zeros(n)
+    escaped = np.zeros(n, dtype=np.bool_)
+    for j in range(n):
+        d[j], escaped[j], tau = octree_walk(nu[j], P[j], K[j], tau_target[j], d_max[j], child, density, velocity,
+                                            temperature, lo, size)
+    return d, escaped
+
+
+@jit(nopython=True)
+def octree_tau_batch(nu, P, K, d, child, density, velocity, temperature, lo, size):
+    '''Optical depths along n rays from P to P + d K, or to the surface of the root'''
+    n = len(nu)
+    tau = np.zeros(n)
+    for j in range(n):
+        tau[j] = octree_walk(nu[j], P[j], K[j], np.inf, d[j], child, density, velocity, temperature, lo, size)[2]
+    return tau
+
+
+@jit(nopython=True)
+def octree_leaves(P, child, lo, size):
+    '''Leaves containing the points P [n,3], -1 outside the root'''
+    n = len(P)
+    res = np.zeros(n, dtype=np.int64)
+    k = np.zeros(3)
+    for j in range(n):
+        inside = True
+        for ax in range(3):
+            if (P[j, ax] < lo[ax]) or (P[j, ax] >= lo[ax] + size[ax]):
+                inside = False
+        res[j] = find_leaf(P[j], k, child, lo, size)[0] if inside else -1
+    return res
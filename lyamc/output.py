@@ -0,0 +1,203 @@
+'''
+Append-only output of escaped photons.
+
+Photons are buffered and written in fixed-size chunks, each chunk to its own .npz file
+by a background thread. A chunk file appears under its final name only once it is
+completely written, and the JSON manifest next to the chunks lists the complete ones,
+so a killed job loses at most the photons of the chunk in flight.
+'''
+
+import glob
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+FIELDS = ('p', 'k', 'x', 'i')
+
+
+def atomic_write_json(path, obj):
+    '''Writes obj to path through a temporary file'''
+    tmp = path + '.%d.tmp' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class PhotonStore:
+    '''
+    Chunked store of escaped photons: position of the last scattering p [3], direction k [3],
+    frequency x and number of scatterings i, the same fields as the _last.npz files.
+    Chunks are prefix_000000.npz, prefix_000001.npz, ..., the manifest is prefix.json.
+    '''
+
+    def __init__(self, prefix, chunk_size=1000, compress=False, background=True, max_pending=16):
+        '''
+        :param prefix: path of the output without extension
+        :param chunk_size: number of photons per chunk
+        :param compress: write chunks with np.savez_compressed
+        :param background: write chunks from a background thread
+        :param max_pending: number of chunks waiting for the writer before append blocks
+        '''
+        self.prefix = prefix
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.buffer = {f: [] for f in FIELDS}
+        self.nbuffer = 0
+        self.nchunks = 0
+        self.manifest = {'chunk_size': chunk_size, 'compress': compress, 'complete': False,
+                         'nphotons': 0, 'chunks': []}
+        self.error = None
+        self.closed = False
+        dirname = os.path.dirname(prefix)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.queue = None
+        if background:
+            self.queue = queue.Queue(maxsize=max_pending)
+            self.writer = threading.Thread(target=self._writer, daemon=True)
+            self.writer.start()
+
+    @property
+    def manifest_path(self):
+        return self.prefix + '.json'
+
+    def chunk_path(self, ichunk):
+        return self.prefix + '_%06d.npz' % ichunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, p, k, x, i):
+        '''
+        Adds escaped photons to the store
+        :param p: positions of the last scattering [n,3] (or [3] for one photon)
+        :param k: directions [n,3]
+        :param x: dimensionless frequencies [n]
+        :param i: numbers of scatterings [n]
+        '''
+        self._check()
+        p = np.asarray(p, dtype=float).reshape(-1, 3)
+        k = np.asarray(k, dtype=float).reshape(-1, 3)
+        x = np.asarray(x, dtype=float).reshape(-1)
+        i = np.asarray(i, dtype=int).reshape(-1)
+        for f, v in zip(FIELDS, (p, k, x, i)):
+            self.buffer[f].append(v)
+        self.nbuffer += len(x)
+        while self.nbuffer >= self.chunk_size:
+            self._flush(self.chunk_size)
+
+    def flush(self):
+        '''Writes the buffered photons as a (possibly short) chunk'''
+        if self.nbuffer > 0:
+            self._flush(self.nbuffer)
+
+    def close(self):
+        '''Flushes the buffer, waits for the writer and marks the output as complete'''
+        if self.closed:
+            return
+        self.flush()
+        if self.queue is not None:
+            self.queue.put(None)
+            self.writer.join()
+        self.closed = True
+        self._check()
+        self.manifest['complete'] = True
+        atomic_write_json(self.manifest_path, self.manifest)
+
+    def _flush(self, n):
+        data = {f: np.concatenate(self.buffer[f]) for f in FIELDS}
+        self.buffer = {f: [data[f][n:]] for f in FIELDS}
+        self.nbuffer -= n
+        chunk = (self.nchunks, {f: data[f][:n] for f in FIELDS})
+        self.nchunks += 1
+        if self.queue is None:
+            self._write(*chunk)
+        else:
+            self.queue.put(chunk)
+
+    def _write(self, ichunk, data):
+        path = self.chunk_path(ichunk)
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            (np.savez_compressed if self.compress else np.savez)(f, **data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.manifest['chunks'].append({'file': os.path.basename(path), 'n': len(data['x'])})
+        self.manifest['nphotons'] += len(data['x'])
+        atomic_write_json(self.manifest_path, self.manifest)
+
+    def _writer(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                self.queue.task_done()
+                return
+            if self.error is None:
+                try:
+                    self._write(*chunk)
+                except Exception as e:
+                    self.error = e
+            self.queue.task_done()
+
+    def drain(self):
+        '''Waits until all flushed chunks are on disk'''
+        if self.queue is not None:
+            self.queue.join()
+        self._check()
+
+    def state(self):
+        '''
+        Everything needed to continue the store in another process, see resume.
+        Chunks already handed to the writer are written first.
+        '''
+        self.drain()
+        return {'prefix': self.prefix, 'chunk_size': self.chunk_size, 'compress': self.compress,
+                'nchunks': self.nchunks, 'manifest': self.manifest,
+                'buffer': {f: np.concatenate(self.buffer[f]) if self.nbuffer > 0 else None for f in FIELDS}}
+
+    @classmethod
+    def resume(cls, state, background=True):
+        '''
+        Continues a store from its state: chunks written after the state was taken are
+        dropped and the buffered photons are restored.
+        '''
+        store = cls(state['prefix'], state['chunk_size'], state['compress'], background)
+        store.nchunks = state['nchunks']
+        store.manifest = state['manifest']
+        for path in glob.glob(store.prefix + '_*.npz'):
+            if int(path[len(store.prefix) + 1:-len('.npz')]) >= store.nchunks:
+                os.remove(path)
+        atomic_write_json(store.manifest_path, store.manifest)
+        if state['buffer']['x'] is not None:
+            store.append(*[state['buffer'][f] for f in FIELDS])
+        return store
+
+    def _check(self):
+        if self.error is not None:
+            raise IOError('writing %s failed: %s' % (self.prefix, self.error))
+
+
+def load_store(prefix):
+    '''
+    Reads the complete chunks of a PhotonStore
+    :param prefix: path of the output without extension
+    :return: p [n,3], k [n,3], x [n], i [n]
+    '''
+    with open(prefix + '.json') as f:
+        manifest = json.load(f)
+    dirname = os.path.dirname(prefix)
+    data = {'p': [np.zeros([0, 3])], 'k': [np.zeros([0, 3])], 'x': [np.zeros(0)], 'i': [np.zeros(0, dtype=int)]}
+    for chunk in manifest['chunks']:
+        with np.load(os.path.join(dirname, chunk['file'])) as temp:
+            for f in FIELDS:
+                data[f].append(temp[f])
+    return tuple(np.concatenate(data[f]) for f in FIELDS)
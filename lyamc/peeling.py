@@ -0,0 +1,185 @@
+'''
+Peeling-off (next-event) estimator of spectra and images at fixed observers.
+
+At the emission and at every scattering each observer direction k_o receives the
+probability per steradian that the photon leaves toward it,
+
+    w = P(k_o) exp(-tau),
+
+P being the phase function (1 / (4 pi) at the emission, 3 / (16 pi) (1 + mu^2) in the
+frame of the scattering) and tau the optical depth from that point to the surface along
+k_o at the frequency of the photon sent toward k_o (the tau method of the compiled
+geometry, see lyamc.jitgeometry). The weight goes to the spectrum of the observer at
+that frequency, binned in x at the emission temperature like the escaped photons, and
+to its image at the projected position. Every photon thus adds to
+every sightline, while selecting the escaped photons within a cone adds only those few.
+
+The peeled photons use no random numbers, so the escaped photons are the same as with
+lyamc.kernel.run_photons for the same seed.
+'''
+
+import numpy as np
+from numba import jit
+
+from lyamc.general import get_nu, get_x, c
+from lyamc.geometry import Geometry
+from lyamc.kernel import _from_com, _perp_basis, _samplephase, _to_com, atom_velocity, get_xcrit, \
+    kernel_geometry, m_hz
+from lyamc.rng import photon_rng, photon_seed
+
+
+class Observers:
+    '''
+    Observer directions with their spectra and images, accumulated by run_photons_peeling.
+    The image of an observer is the projection on the plane perpendicular to its direction,
+    with the axes of lyamc.kernel._perp_basis.
+    '''
+
+    def __init__(self, directions, x_edges=np.linspace(-40, 40, 161), npix=64, size=20., center=(0., 0., 0.)):
+        '''
+        :param directions: directions toward the observers [m,3], normalised here
+        :param x_edges: edges of the frequency bins of the spectra
+        :param npix: number of pixels per side of the images
+        :param size: side of the images in pc
+        :param center: center of the images [3] in pc
+        '''
+        self.directions = np.atleast_2d(np.asarray(directions, dtype=float))
+        self.directions /= np.sqrt(np.sum(self.directions ** 2, axis=1)).reshape(-1, 1)
+        basis = [_perp_basis(k) for k in self.directions]
+        self.e0 = np.array([b[0] for b in basis])
+        self.e1 = np.array([b[1] for b in basis])
+        self.x_edges = np.asarray(x_edges, dtype=float)
+        self.npix = npix
+        self.size = float(size)
+        self.center = np.asarray(center, dtype=float)
+        self.spectra = np.zeros((len(self.directions), len(self.x_edges) - 1))
+        self.images = np.zeros((len(self.directions), npix, npix))
+        self.nphot = 0
+
+    def spectrum(self):
+        '''Spectra [m,nx] per emitted photon, per steradian and per unit x'''
+        return self.spectra / max(self.nphot, 1) / np.diff(self.x_edges)
+
+    def image(self):
+        '''Images [m,npix,npix] per emitted photon and per steradian in each pixel'''
+        return self.images / max(self.nphot, 1)
+
+    def state(self):
+        '''Accumulated sums, for checkpoints'''
+        return {'spectra': self.spectra.copy(), 'images': self.images.copy(), 'nphot': self.nphot}
+
+    def resume(self, state):
+        '''Restores the sums of state()'''
+        self.spectra = state['spectra'].copy()
+        self.images = state['images'].copy()
+        self.nphot = state['nphot']
+
+    def save(self, path):
+        '''Writes the directions, frequency bins, spectra and images to an npz file'''
+        np.savez(path, directions=self.directions, x_edges=self.x_edges, size=self.size, center=self.center,
+                 spectrum=self.spectrum(), image=self.image(), nphot=self.nphot)
+
+
+@jit(nopython=True)
+def _peel(p, nu, w, T_ic, geom, K, E0, E1, x_edges, size, center, spectra, images):
+    '''
+    Adds the weight w of a photon at p with frequency nu toward observer o to its spectrum, binned in x at T_ic,
+    and to its image
+    '''
+    for o in range(len(K)):
+        ko = K[o]
+        if w[o] <= 0:
+            continue
+        wo = w[o] * np.exp(-geom.tau(nu[o], p, ko, geom.distance_to_boundary(p, ko)))
+        x = get_x(nu[o], T_ic)
+        j = np.searchsorted(x_edges, x, side='right') - 1
+        if (j >= 0) and (j < spectra.shape[1]):
+            spectra[o, j] += wo
+        npix = images.shape[1]
+        q = p - center
+        ix = int(np.floor(((q[0] * E0[o, 0] + q[1] * E0[o, 1] + q[2] * E0[o, 2]) / size + 0.5) * npix))
+        iy = int(np.floor(((q[0] * E1[o, 0] + q[1] * E1[o, 1] + q[2] * E1[o, 2]) / size + 0.5) * npix))
+        if (ix >= 0) and (ix < npix) and (iy >= 0) and (iy < npix):
+            images[o, ix, iy] += wo
+
+
+@jit(nopython=True)
+def run_photon_peeling(p, k, x, geom, T_ic, N, core_skip, K, E0, E1, x_edges, size, center, spectra, images):
+    '''
+    lyamc.kernel.run_photon that peels off toward the observer directions K [m,3] at the emission and at
+    every scattering, adding to spectra [m,nx] and images [m,npix,npix] (see Observers)
+    :return: position of the last scattering, final direction, final frequency, number of scatterings
+    '''
+    p = p.copy()
+    k = k.copy()
+    m = len(K)
+    nu = get_nu(x, T_ic)
+    _peel(p, np.full(m, nu), np.full(m, 1. / (4. * np.pi)), T_ic, geom, K, E0, E1, x_edges, size,
+          center, spectra, images)
+    nu_o = np.zeros(m)
+    w = np.zeros(m)
+    i = 0
+    while i < N - 1:
+        d_max = geom.distance_to_boundary(p, k)
+        d, escaped = geom.tau_distance(nu, p, k, -np.log(np.random.rand()), d_max)
+        if escaped:
+            break
+        p_new = p + k * d
+        T = geom.temperature(p_new)
+        x_crit = 0.
+        if core_skip:
+            x_crit = get_xcrit(T, geom.density(p_new), geom.R)
+        v = atom_velocity(nu, k, geom.velocity(p_new), T, x_crit) / c
+        E_com, n_com, v_com = _to_com(nu / m_hz, k, v)
+        for o in range(m):
+            mu = n_com[0] * K[o, 0] + n_com[1] * K[o, 1] + n_com[2] * K[o, 2]
+            w[o] = 3. / (16. * np.pi) * (1. + mu ** 2)
+            nu_o[o] = _from_com(E_com, K[o], v_com, v)[0] * m_hz
+        _peel(p_new, nu_o, w, T_ic, geom, K, E0, E1, x_edges, size, center, spectra, images)
+        E, k = _from_com(E_com, _samplephase(n_com), v_com, v)
+        nu = E * m_hz
+        p = p_new
+        i += 1
+    return p, k, get_x(nu, T_ic), i
+
+
+@jit(nopython=True)
+def _run_photons_peeling(P, x0, geom, T_ic, N, core_skip, seed, first_id, K, E0, E1, x_edges, size, center, spectra,
+                         images):
+    n = len(P)
+    p_last = np.zeros((n, 3))
+    k_last = np.zeros((n, 3))
+    x_last = np.zeros(n)
+    i_last = np.zeros(n, dtype=np.int64)
+    for j in range(n):
+        if seed >= 0:
+            np.random.seed(photon_seed(seed, first_id + j))
+        k = np.random.normal(0., 1., 3)
+        k /= np.sqrt(np.sum(k ** 2))
+        p_last[j], k_last[j], x_last[j], i_last[j] = run_photon_peeling(P[j], k, x0, geom, T_ic, N, core_skip, K, E0,
+                                                                        E1, x_edges, size, center, spectra, images)
+    return p_last, k_last, x_last, i_last
+
+
+def run_photons_peeling(geom, nsim, observers, x0=0., N=10000, core_skip=False, seed=None, first_id=0, P=None):
+    '''
+    Runs nsim photons with the compiled kernel and peels them off toward the observers,
+    see lyamc.kernel.run_photons.
+    :param observers: Observers, whose spectra and images are accumulated
+    :return: p [nsim,3], k [nsim,3], x [nsim], i [nsim] of the escaped photons
+    '''
+    g = kernel_geometry(geom)
+    if P is not None:
+        P = np.ascontiguousarray(P, dtype=float).reshape(-1, 3)
+    elif not isinstance(geom, Geometry):
+        P = np.zeros((nsim, 3))
+    elif seed is None:
+        P = geom.get_ICs(nsim)
+    else:
+        P = np.array([geom.get_IC(photon_rng(seed, first_id + j)) for j in range(nsim)], dtype=float).reshape(-1, 3)
+    T_ic = float(g.temperature(P[0]))
+    res = _run_photons_peeling(P, float(x0), g, T_ic, N, core_skip, -1 if seed is None else int(seed),
+                               int(first_id), observers.directions, observers.e0, observers.e1, observers.x_edges,
+                               observers.size, observers.center, observers.spectra, observers.images)
+    observers.nphot += len(P)
+    return res
@@ -0,0 +1,131 @@
+'''
+Warm worker pool for running many photons on one node.
+
+The workers are started once and keep the geometry, the compiled functions and the
+parallel velocity tables in memory; they are warmed up in the parent before the pool
+forks, so everything is compiled and loaded only once. A run is split into chunks of
+photons, every photon with its own random stream, and the workers write their photons directly
+into a shared-memory array.
+'''
+
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+
+from lyamc.general import get_a
+from lyamc.geometry import get_geometry
+from lyamc.kernel import run_photons, seed_kernel
+from lyamc.redistribution import ZMSampler
+from lyamc.tables import ParVelocityTable
+from lyamc.transport import run_batch
+
+# columns of the shared array: p [3], k [3], x, i
+NCOL = 8
+
+_worker = {}
+
+
+def _init_worker(name, params, engine, mode, core_skip):
+    '''Builds the geometry and the sampler of a worker and compiles the engine'''
+    if _worker.get('key') == (name, tuple(params), engine, mode, core_skip):
+        return
+    geom = get_geometry(name, params)
+    sampler = ParVelocityTable() if mode == 'lookup' else ZMSampler()
+    _worker.update(key=(name, tuple(params), engine, mode, core_skip), geom=geom, engine=engine, mode=mode,
+                   core_skip=core_skip, sampler=sampler, shm=None)
+    if mode == 'lookup':
+        sampler.get_table(get_a(geom.temperature(geom.get_IC())[0]))
+    # a photon with at most one scattering compiles the engine
+    _run(1, N=2)
+
+
+def _run(n, N=10000, seed=None, first_id=0):
+    if _worker['engine'] == 'kernel':
+        return run_photons(_worker['geom'], n, N=N, core_skip=_worker['core_skip'], seed=seed, first_id=first_id)
+    return run_batch(_worker['geom'], n, N=N, core_skip=_worker['core_skip'], mode=_worker['mode'], verbal=False,
+                     sampler=_worker['sampler'], seed=seed, first_id=first_id)
+
+
+def _run_chunk(task):
+    '''
+    Runs one chunk of photons and writes them into the shared array
+    :param task: name of the shared memory, total number of photons, first row, number of photons,
+                 seed of the run and seed of the chunk
+    :return: first row and number of photons
+    '''
+    shm_name, nsim, start, n, seed, chunk_seed = task
+    if (_worker['shm'] is None) or (_worker['shm'].name != shm_name):
+        if _worker['shm'] is not None:
+            _worker['shm'].close()
+        _worker['shm'] = shared_memory.SharedMemory(name=shm_name)
+    # the photons draw from per-photon streams, the chunk seed only covers the shared generators
+    np.random.seed(chunk_seed)
+    seed_kernel(chunk_seed)
+    p, k, x, i = _run(n, seed=seed, first_id=start)
+    out = np.ndarray((nsim, NCOL), dtype=float, buffer=_worker['shm'].buf)
+    out[start:start + n, 0:3] = p
+    out[start:start + n, 3:6] = k
+    out[start:start + n, 6] = x
+    out[start:start + n, 7] = i
+    del out
+    return start, n
+
+
+class WarmPool:
+    '''
+    Pool of long-lived workers for one geometry, see the module docstring.
+    '''
+
+    def __init__(self, name, params, nproc=None, engine='kernel', mode='zm', core_skip=False):
+        '''
+        :param name: geometry name, see get_geometry
+        :param params: geometry parameters
+        :param nproc: number of workers, all cores if None
+        :param engine: 'kernel' (lyamc.kernel) or 'batch' (lyamc.transport)
+        :param mode: parallel velocity mode of the batch engine, 'zm' or 'lookup'
+        :param core_skip: skip core scatterings
+        '''
+        initargs = (name, list(params), engine, mode, core_skip)
+        _init_worker(*initargs)
+        self.pool = Pool(nproc, initializer=_init_worker, initargs=initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, nsim, chunk_size=100, seed=None, verbal=True, store=None):
+        '''
+        Runs nsim photons on the workers.
+        :param nsim: number of photons
+        :param chunk_size: number of photons per task
+        :param seed: seed of the run, random if None. Both engines give the same photons
+                     for any number of workers and chunk size
+        :param store: PhotonStore (lyamc.output) to which every chunk is appended as soon as it is done,
+                      in the order the chunks finish
+        :return: p [nsim,3], k [nsim,3], x [nsim], i [nsim], in the order of the photon ids
+        '''
+        if seed is None:
+            seed = np.random.randint(2 ** 31 - 2 ** 20)
+        shm = shared_memory.SharedMemory(create=True, size=nsim * NCOL * 8)
+        try:
+            tasks = [(shm.name, nsim, start, min(chunk_size, nsim - start), seed, seed + j)
+                     for j, start in enumerate(range(0, nsim, chunk_size))]
+            done = 0
+            for start, n in self.pool.imap_unordered(_run_chunk, tasks):
+                done += n
+                if store is not None:
+                    rows = np.ndarray((nsim, NCOL), dtype=float, buffer=shm.buf)[start:start + n].copy()
+                    store.append(rows[:, 0:3], rows[:, 3:6], rows[:, 6], rows[:, 7].astype(int))
+                if verbal:
+                    print(done, 'photons done')
+            res = np.ndarray((nsim, NCOL), dtype=float, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+        return res[:, 0:3], res[:, 3:6], res[:, 6], res[:, 7].astype(int)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -1,8 +1,12 @@
+from collections import OrderedDict
+
 from numba import jit
 from scipy import integrate
 
 from lyamc.cons import *
 from lyamc.general import *
+from lyamc.rng import subset
+from lyamc.tables import ParVelocityTable
 
 
 # ALYA = 6.2648e+8
@@ -26,28 +30,32 @@ def rotation_matrix(axis, theta):
 
 
 @jit(nopython=False)
-def rotate_by_theta(n, theta):
-    '''rotates vector n by theta in random direction'''
-    axis = np.random.randn(3)
+def rotate_by_theta(n, theta, rng=None):
+    '''rotates vector n by theta in random direction, drawn from rng (a numpy Generator) or np.random'''
+    if rng is None:
+        rng = np.random
+    axis = rng.standard_normal(3)
     axis -= axis.dot(n) * n / np.linalg.norm(n) ** 2
     axis /= np.linalg.norm(axis)
     return np.dot(rotation_matrix(axis, theta), n)
 
 
 @jit(nopython=False)
-def random_n(n, mode='Rayleigh'):
-    ''' Returns a new direction for the photon
+def random_n(n, mode='Rayleigh', rng=None):
+    ''' Returns a new direction for the photon, rng is a numpy Generator or None for np.random
     '''
+    if rng is None:
+        rng = np.random
     if mode == 'uniform':
-        x = np.random.normal(size=(3))
+        x = rng.normal(size=(3))
         x /= np.sqrt(x[0] ** 2 + x[1] ** 2 + x[2] ** 2)
         return x, 1
     elif mode == 'Rayleigh':
-        r = np.random.rand()
+        r = rng.random()
         q = ((16. * r * r - 16 * r + 5.) ** 0.5 - 4. * r + 2.) ** (1. / 3.)
         nu = 1. / q - q
         theta = np.arccos(nu)
-        return rotate_by_theta(np.array(n).copy(), theta), nu
+        return rotate_by_theta(np.array(n).copy(), theta, rng), nu
     else:
         print('error')
 
@@ -79,12 +87,16 @@ def get_parallel_PDF(v, u, n, nu, T):
     # return np.exp( - mp_over_2kB / T * (v_par-u_par)**2) / ((x - v_par/c)**2 + a**2)
 
 
-def get_lookup_table_for_par_velocity(T):
+def get_lookup_table_for_par_velocity(T, table=None):
     '''
     Precalculates lookup table for parallel velocities
-    :param T:
-    :return:
+    :param T: temperature in K
+    :param table: ParVelocityTable holding the slices, a new one with the default grids if None
+    :return: x_list, p_list and the parallel velocities in km/s [len(x_list), len(p_list)]
     '''
+    if table is None:
+        table = ParVelocityTable()
+    return table.x_list, table.p_list, table.get_table(get_a(T)) * get_vth(T)
 
 
 def integrand_for_par_vel(v, args):
@@ -114,8 +126,99 @@ def p_zm(u0, x, a):
 
 
 
+def get_par_velocity_cdf(nu, T, umod):
+    '''
+    Normalized CDF of the parallel velocity used by the 'integral' mode.
+
+    :param nu: frequency in Hz
+    :param T: temperature in K
+    :param umod: projection of the bulk velocity on the photon direction in km/s
+    :return: velocity grid in km/s and the CDF on it
+    '''
+    vth = get_vth(T)
+    w_list = np.sort(
+        np.concatenate([np.linspace(-7 * vth, 7 * vth, 1000), -umod / vth + np.linspace(-0.2, 0.2, 100)]))
+    res = np.zeros(len(w_list))
+    for i in range(len(w_list) - 1):
+        res[i + 1] = \
+            integrate.quad(integrand_for_par_vel, a=w_list[i], b=w_list[i + 1], args=[vth, nu, umod], limit=10)[0]
+    res = np.cumsum(res)
+    res /= res[-1]
+    return w_list, res
+
+
+class CDFCache:
+    '''
+    LRU cache of the 'integral' mode CDFs.
+
+    States are quantized in ln(T), x (lab frame) and u.n / vth; the CDF of a bin is
+    computed for its centre, so the result does not depend on which photon filled it.
+    Least recently used CDFs are dropped once their total size exceeds max_bytes.
+    '''
+
+    def __init__(self, max_bytes=64 * 2 ** 20, T_resolution=1e-3, x_resolution=1e-2, u_resolution=1e-2):
+        '''
+        :param max_bytes: memory budget for the stored CDFs
+        :param T_resolution: bin width in ln(T)
+        :param x_resolution: bin width in x
+        :param u_resolution: bin width in u.n in units of vth
+        '''
+        self.max_bytes = max_bytes
+        self.T_resolution = T_resolution
+        self.x_resolution = x_resolution
+        self.u_resolution = u_resolution
+        self.cdfs = OrderedDict()
+        self.nbytes = 0
+        self.requests = 0
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.cdfs)
+
+    @property
+    def hit_rate(self):
+        '''Fraction of requests served from the cache'''
+        return self.hits / max(self.requests, 1)
+
+    def key(self, nu, T, umod):
+        '''Quantized state (ln T, x, u.n / vth)'''
+        T = float(np.ravel(T)[0])
+        vth = get_vth(T)
+        return (int(np.rint(np.log(T) / self.T_resolution)),
+                int(np.rint(float(np.ravel(get_x(nu, T))[0]) / self.x_resolution)),
+                int(np.rint(float(np.ravel(umod)[0]) / vth / self.u_resolution)))
+
+    def get(self, nu, T, umod):
+        '''
+        CDF for the bin of the state, see get_par_velocity_cdf
+        :return: velocity grid in km/s and the CDF on it
+        '''
+        key = self.key(nu, T, umod)
+        self.requests += 1
+        if key in self.cdfs:
+            self.hits += 1
+            self.cdfs.move_to_end(key)
+            return self.cdfs[key]
+        Tq = np.exp(key[0] * self.T_resolution)
+        cdf = get_par_velocity_cdf(get_nu(x=key[1] * self.x_resolution, T=Tq), Tq,
+                                   key[2] * self.u_resolution * get_vth(Tq))
+        self.cdfs[key] = cdf
+        self.nbytes += cdf[0].nbytes + cdf[1].nbytes
+        while self.nbytes > self.max_bytes and len(self.cdfs) > 1:
+            w_list, res = self.cdfs.popitem(last=False)[1]
+            self.nbytes -= w_list.nbytes + res.nbytes
+        return cdf
+
+    def clear(self):
+        self.cdfs.clear()
+        self.nbytes = 0
+
+
+cdf_cache = CDFCache()
+
+
 @jit(nopython=False)
-def get_par_velocity_of_atom(nu, T, u, n, f_ltab, mode='integral'):
+def get_par_velocity_of_atom(nu, T, u, n, f_ltab, mode='integral', rng=None):
     '''
     Generates a parallel component for the velocity of the atom.
 
@@ -123,34 +226,22 @@ def get_par_velocity_of_atom(nu, T, u, n, f_ltab, mode='integral'):
     :param T:  local gas temperature in K
     :param u:  bulk gas evlocity
     :param n:  photon direction
+    :param rng: numpy Generator of the photon, np.random if None
     :return:   vector parallel to
     '''
+    if rng is None:
+        rng = np.random
     if mode == 'integral':
-        x = get_x(nu, T)
-        vth = get_vth(T)
-        a = 4.7e-4 * (T / 1e4) ** -0.5
         umod = np.dot(u, n)
-        # I = lambda w: integrate.quad(q, w[0], w[1], )[0]
-        # w_list = np.linspace(-10 * vth, 10 * vth, 1024)
-        w_list = np.sort(
-            np.concatenate([np.linspace(-7 * vth, 7 * vth, 1000), -umod / vth + np.linspace(-0.2, 0.2, 100)]))
-        res = np.zeros(len(w_list))
-        for i in range(len(w_list) - 1):
-            res[i + 1] = \
-                integrate.quad(integrand_for_par_vel, a=w_list[i], b=w_list[i + 1], args=[vth, nu, umod], limit=10)[0]
-        res = np.cumsum(res)
-        res /= res[-1]
-        r = np.random.rand()
-        # print(r)
+        w_list, res = cdf_cache.get(nu, T, umod)
+        r = rng.random()
         return n * np.interp(r, res, w_list)
     elif mode == 'lookup':
-        r = np.random.rand()
-        # print(r)
-        vth = get_vth(T)
+        # f_ltab is a ParVelocityTable
+        r = rng.random()
         umod = np.dot(u, n)
-        x = get_x(nu * (1 + umod / c), T)[0]
-        # print(r, x)
-        return n * f_ltab(r, x)
+        x = get_x(nu * (1 - umod / c), T)[0]
+        return n * f_ltab(r, x, T)
         # if x > 0:
         #     print(f_ltab(r, x))
         #     return n * f_ltab(r, x) * vth / np.sqrt(2)
@@ -158,34 +249,9 @@ def get_par_velocity_of_atom(nu, T, u, n, f_ltab, mode='integral'):
         #     print(-f_ltab(r, -x))
         #     return n * -1. * f_ltab(r, -x) * vth
     elif mode == 'zm':
-        N = 10
-        x = get_x(nu, T)
-        vth = get_vth(T)
-        upar = np.dot(u, n)[0] / vth
-        a = 4.7e-4 * (T / 1e4) ** -0.5
-        if x < 0:
-            x = -x
-            upar = -upar
-        u0 = upar/200
-        p = p_zm(u0, x, a)
-        theta0 = np.arctan((u0 - x) / a)
-        res = []
-        while len(res) == 0:
-            print('more', x, u0)
-            R = np.random.rand(N)
-            theta = np.random.rand(N)
-            theta[R < p] = theta[R < p] * (theta0 + np.pi / 2.) - np.pi / 2
-            theta[R >= p] = theta[R >= p] * (np.pi / 2. - theta0) + theta0
-            # theta = np.random.rand(N)*np.pi - np.pi/2.
-            uu = a * np.tan(theta) + x
-            # g = g_zm(u0, u, x, a)
-            acc = np.random.rand(N)
-            res = uu[((acc < np.exp(-uu ** 2)) & (uu <= u0)) | ((acc < (np.exp(-uu ** 2) / np.exp(-u0 ** 2))) & (uu > u0))]
-            if N<1e7: N *= 10
-        if x < 0:
-            return -n * res[0] * vth
-        else:
-            return n * res[0] * vth
+        umod = np.dot(u, n)
+        x = get_x(nu * (1 - umod / c), T)
+        return n * get_par_velocity_of_atoms(x, get_a(T), rng)[0] * get_vth(T)
 
 
 
@@ -216,20 +282,195 @@ def get_par_velocity_of_atom(nu, T, u, n, f_ltab, mode='integral'):
     #     return n * v_par[r][0]
 
 
-def get_perp_velocity_of_atom(nu, T, u, n):
+def get_atau0(T, ndens, L):
+    '''
+    a * tau0 for a region of size L at line center
+    :param T: temperature in K
+    :param ndens: number density of hydrogen in 1/cm^3
+    :param L: size in pc
+    :return: a * tau0
+    '''
+    return get_a(T) * sigmaa0(T) * ndens * L * cm_in_pc
+
+
+def get_xcrit(atau0):
+    '''
+    Critical frequency for core-skipping, x_crit = 0.2 (a tau0)^(1/3) (e.g. Smith et al. 2015).
+    No skipping for a * tau0 <= 1.
+    :param atau0: local a * tau0
+    :return: x_crit
+    '''
+    atau0 = np.asarray(atau0, dtype=float)
+    return np.where(atau0 > 1., 0.2 * np.maximum(atau0, 1.) ** (1. / 3.), 0.)
+
+
+def get_perp_velocity_of_atom(nu, T, u, n, x_crit=0., rng=None):
     '''
 
     Drawing a random velocity of an atom in a direction perpendicular to the current LOS.
+    With x_crit > 0 and |x| < x_crit (x in the frame of the gas) the core is skipped:
+    the perpendicular speed is drawn from the truncated distribution u exp(-u^2), u > x_crit.
 
-    :param nu: frequency TODO: unused!
+    :param nu: frequency
     :param T:  temperature
-    :param u:  velocity  TODO: unused!
+    :param u:  bulk gas velocity
     :param n:  direction of the LOS
+    :param x_crit: critical frequency for core-skipping, see get_xcrit
+    :param rng: numpy Generator of the photon, np.random if None
     :return:   3-vector of the velocity component perpendicular to the LOS
     '''
+    if rng is None:
+        rng = np.random
     vth = get_vth(T)
-    v_perp = np.random.normal(loc=0, scale=1., size=2) * vth / np.sqrt(2)
-    direction0 = rotate_by_theta(n, np.pi / 2)
+    direction0 = rotate_by_theta(n, np.pi / 2, rng)
     direction1 = np.cross(direction0, n)
     # TODO: Replace with a simpler approach without using cross
+    if (x_crit > 0) and (np.abs(get_x(nu * (1. - np.sum(u * n) / c), T)) < x_crit):
+        u_perp = np.sqrt(x_crit ** 2 - np.log(rng.random())) * vth
+        phi = rng.random() * 2. * np.pi
+        return u_perp * (np.cos(phi) * direction0 + np.sin(phi) * direction1)
+    v_perp = rng.normal(loc=0, scale=1., size=2) * vth / np.sqrt(2)
     return v_perp[0] * direction0 + v_perp[1] * direction1
+
+
+# ---------------------------------------------------------------------
+# Batched versions: n photons at once
+# ---------------------------------------------------------------------
+def get_u0_zm(x, a):
+    '''
+    Empirical choice of the ZM rejection parameter u0 (Semelin et al. 2007).
+    Between x = 3 and 4 the smaller of the two rules is taken, the wing rule alone
+    overshoots x there and the acceptance drops by orders of magnitude.
+    :param x: |x|, dimensionless frequency in the gas frame
+    :param a: Voigt parameter
+    :return: u0 >= 0
+    '''
+    x = np.asarray(x, dtype=float)
+    core = x - 0.01 * a ** (1. / 6.) * np.exp(1.2 * np.minimum(x, 4.))
+    wing = 1.85 - np.log(a) / 6.73 + np.log(np.log(np.maximum(x, 3.)))
+    return np.maximum(np.where(x < 3., core, np.where(x < 4., np.minimum(core, wing), wing)), 0.)
+
+
+def zm_propose(x, a, m=1, rng=None):
+    '''
+    m Zheng & Miralda-Escude (2002) proposals per photon, with u0 from get_u0_zm.
+
+    :param x: |x|, dimensionless frequencies in the gas frame [n]
+    :param a: Voigt parameters [n]
+    :param m: number of proposals per photon
+    :param rng: numpy Generator, np.random if None, or the PhotonStreams of the photons
+    :return:  proposed parallel velocities in units of vth [n,m] and mask of accepted ones [n,m]
+    '''
+    if rng is None:
+        rng = np.random
+    x = x.reshape(-1, 1)
+    a = a.reshape(-1, 1)
+    u0 = get_u0_zm(x, a)
+    theta0 = np.arctan((u0 - x) / a)
+    p = p_zm(u0, x, a)
+    # three numbers per proposal, so proposal j of a photon is the same whatever m is
+    R, theta, acc = np.moveaxis(rng.random((len(x), m, 3)), -1, 0)
+    theta = np.where(R < p, theta * (theta0 + np.pi / 2.) - np.pi / 2, theta * (np.pi / 2. - theta0) + theta0)
+    uu = a * np.tan(theta) + x
+    ok = ((uu <= u0) & (acc < np.exp(-uu ** 2))) | ((uu > u0) & (acc < np.exp(u0 ** 2 - uu ** 2)))
+    return uu, ok
+
+
+def get_par_velocity_of_atoms(x, a, rng=None):
+    '''
+    Zheng & Miralda-Escude (2002) rejection sampler for n photons at once.
+
+    :param x: dimensionless frequencies in the gas frame [n]
+    :param a: Voigt parameter(s)
+    :param rng: numpy Generator, np.random if None, or the PhotonStreams of the photons
+    :return:  parallel velocities of the atoms in units of vth [n]
+    '''
+    return ZMSampler(oversample=1).sample(x, a, rng)
+
+
+class ZMSampler:
+    '''
+    Batched ZM sampler.
+
+    Each photon still waiting for a sample gets m proposals per round (all photons at
+    once with zm_propose) and takes the first accepted one. By default m is the inverse
+    acceptance rate of the previous round, so a round accepts about one proposal per
+    photon: the core photons of the first round (m = 1) waste hardly any proposals, and
+    the few wing photons left over get enough proposals to finish in a few more rounds.
+    Samples are drawn at the exact x of each photon.
+    '''
+
+    def __init__(self, oversample=None, max_oversample=64):
+        '''
+        :param oversample: fixed number of proposals per photon and round, adaptive if None
+        :param max_oversample: upper limit of the adaptive number of proposals
+        '''
+        self.oversample = oversample
+        self.max_oversample = max_oversample
+        self.proposed = 0
+        self.accepted = 0
+        self.sampled = 0
+
+    @property
+    def acceptance_rate(self):
+        '''Fraction of accepted proposals'''
+        return self.accepted / max(self.proposed, 1)
+
+    @property
+    def efficiency(self):
+        '''Fraction of proposals that became a sample, the others were rejected or thrown away'''
+        return self.sampled / max(self.proposed, 1)
+
+    def sample(self, x, a, rng=None):
+        '''
+        :param x: dimensionless frequencies in the gas frame [n]
+        :param a: Voigt parameter(s)
+        :param rng: numpy Generator, np.random if None, or the PhotonStreams of the photons
+        :return:  parallel velocities of the atoms in units of vth [n]
+        '''
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        a = np.broadcast_to(a, x.shape)
+        s = np.where(x < 0, -1., 1.)
+        xa = np.abs(x)
+        res = np.zeros(len(x))
+        todo = np.arange(len(x))
+        m = 1 if self.oversample is None else self.oversample
+        while len(todo) > 0:
+            uu, ok = zm_propose(xa[todo], a[todo], m, rng=rng)
+            naccepted = ok.sum()
+            self.proposed += uu.size
+            self.accepted += naccepted
+            has = ok.any(axis=1)
+            first = np.argmax(ok, axis=1)
+            res[todo[has]] = uu[has, first[has]]
+            self.sampled += has.sum()
+            todo = todo[~has]
+            rng = subset(rng, ~has)
+            if self.oversample is None:
+                m = min(max(int(round(uu.size / max(naccepted, 1))), 1), self.max_oversample)
+        return s * res
+
+
+def get_perp_velocity_of_atoms(T, n, x=None, x_crit=0., rng=None):
+    '''
+    Batched version of get_perp_velocity_of_atom.
+
+    :param T: temperatures [n] (or scalar)
+    :param n: directions of the LOS [n,3]
+    :param x: dimensionless frequencies in the gas frame [n], needed for core-skipping
+    :param x_crit: critical frequencies for core-skipping [n] (or scalar)
+    :param rng: numpy Generator, np.random if None, or the PhotonStreams of the photons
+    :return:  velocity components perpendicular to the LOS in km/s [n,3]
+    '''
+    if rng is None:
+        rng = np.random
+    vth = np.broadcast_to(get_vth(T), (len(n),))
+    v = rng.normal(loc=0, scale=1., size=n.shape) * (vth / np.sqrt(2)).reshape(-1, 1)
+    v -= np.sum(v * n, axis=1).reshape(-1, 1) * n
+    if x is not None:
+        x_crit = np.broadcast_to(x_crit, (len(n),))
+        skip = np.abs(x) < x_crit
+        if skip.any():
+            u_perp = np.sqrt(x_crit[skip] ** 2 - np.log(subset(rng, skip).random(skip.sum()))) * vth[skip]
+            v[skip] *= (u_perp / np.sqrt(np.sum(v[skip] ** 2, axis=1))).reshape(-1, 1)
+    return v
@@ -0,0 +1,165 @@
+'''
+Symmetry-reduced transport for spherically symmetric and plane-parallel media.
+
+In a sphere whose density, temperature and radial velocity depend on r only, or in a
+slab whose fields depend on the height z only (with the velocity along the normal), a
+photon is fully described by (r, mu) or (z, mu) and x, mu being the cosine between its
+direction and the radial direction or the normal. The photon is moved along its ray
+in these coordinates and scattered in a local frame with the symmetry axis along z:
+scatter_reduced draws the atom and the relativistic scattering of lyamc.kernel on scalar
+components, with the photon in the x-z plane, and keeps only the new mu. Static homogeneous
+media are sampled exactly, the others with an adaptive march along the ray.
+
+Geometries opt in with their reduced() method, which returns a reduced geometry of
+lyamc.jitgeometry (or None). At the end the photon is placed back in 3-D with a random
+orientation about the symmetry, so the output has the format of the other engines.
+Slabs do not keep the transverse coordinates, and these are set to 0.
+
+The scattering of lyamc.kernel allocates its 3-vectors and takes most of the time of a step;
+on scalars it is about 4 times cheaper, and the reduced engine is about 3.6 times faster than
+lyamc.kernel for a static homogeneous sphere, 3 times for a slab and 2 times for an expanding
+sphere, whose steps are dominated by the march.
+'''
+
+import numpy as np
+from numba import jit
+
+from lyamc.general import c, get_a, get_nu, get_vth, get_x
+from lyamc.geometry import Geometry
+from lyamc.kernel import _par_velocity_zm, get_xcrit, m_hz
+from lyamc.rng import photon_rng, photon_seed
+
+
+# ---------------------------------------------------------------------
+# Scattering in the local frame, on scalar components
+# ---------------------------------------------------------------------
+@jit(nopython=True)
+def _boost(E, n0, n1, n2, v0, v1, v2):
+    '''lyamc.kernel._boost on the components of n and v'''
+    v2_ = v0 ** 2 + v1 ** 2 + v2 ** 2
+    if v2_ == 0:
+        return E, n0, n1, n2
+    gamma = 1.0 / np.sqrt(1.0 - v2_)
+    vn = v0 * n0 + v1 * n1 + v2 * n2
+    f = (gamma - 1.) * vn / v2_ - gamma
+    n0, n1, n2 = n0 + f * v0, n1 + f * v1, n2 + f * v2
+    norm = np.sqrt(n0 ** 2 + n1 ** 2 + n2 ** 2)
+    return gamma * E * (1.0 - vn), n0 / norm, n1 / norm, n2 / norm
+
+
+@jit(nopython=True)
+def _samplephase(n0, n1, n2):
+    '''lyamc.kernel._samplephase on the components of n'''
+    r = np.random.rand()
+    q = (-2.0 + 4.0 * r + np.sqrt(5.0 - 16.0 * r + 16.0 * r ** 2)) ** (1.0 / 3.0)
+    mu = q - 1 / q
+    phi = np.random.rand() * 2.0 * np.pi
+    # basis of lyamc.kernel._perp_basis: e0 = n x e, e1 = n x e0
+    if np.abs(n0) < 0.9:
+        e0, e1, e2 = 0., n2, -n1
+    else:
+        e0, e1, e2 = -n2, 0., n0
+    norm = np.sqrt(e0 ** 2 + e1 ** 2 + e2 ** 2)
+    e0, e1, e2 = e0 / norm, e1 / norm, e2 / norm
+    f0, f1, f2 = n1 * e2 - n2 * e1, n2 * e0 - n0 * e2, n0 * e1 - n1 * e0
+    s = np.sqrt(max(1.0 - mu ** 2, 0.))
+    cp, sp = np.cos(phi), np.sin(phi)
+    return mu * n0 + s * (cp * e0 + sp * f0), mu * n1 + s * (cp * e1 + sp * f1), mu * n2 + s * (cp * e2 + sp * f2)
+
+
+@jit(nopython=True)
+def scatter_reduced(nu, mu, w, T, x_crit):
+    '''
+    lyamc.kernel.scatter_atom for a photon with direction (sqrt(1 - mu^2), 0, mu) in a gas moving with
+    w along z, on scalar components: only the new cosine to the z axis is kept
+    :param nu: frequency in Hz
+    :param mu: cosine of the direction to the radial direction or the normal
+    :param w: radial or normal bulk velocity in km/s
+    :param T: temperature in K
+    :param x_crit: core-skipping threshold, 0 for none
+    :return: new frequency in Hz and new mu
+    '''
+    s = np.sqrt(max(1. - mu ** 2, 0.))
+    vth = get_vth(T)
+    x_gas = get_x(nu * (1. - w * mu / c), T)
+    u = _par_velocity_zm(x_gas, get_a(T)) * vth
+    # perpendicular velocity along e0 = (mu, 0, -s) and e1 = (0, 1, 0)
+    if np.abs(x_gas) < x_crit:
+        up = np.sqrt(x_crit ** 2 - np.log(np.random.rand())) * vth
+        phi = np.random.rand() * 2. * np.pi
+        u0, u1 = up * np.cos(phi), up * np.sin(phi)
+    else:
+        u0 = vth / np.sqrt(2) * np.random.normal()
+        u1 = vth / np.sqrt(2) * np.random.normal()
+    v0, v1, v2 = (u * s + u0 * mu) / c, u1 / c, (w + u * mu - u0 * s) / c
+    # into the centre of momentum frame, see lyamc.kernel._to_com
+    E, n0, n1, n2 = _boost(nu / m_hz, s, 0., mu, v0, v1, v2)
+    f = E / (1.0 + E)
+    E, n0, n1, n2 = _boost(E, n0, n1, n2, f * n0, f * n1, f * n2)
+    c0, c1, c2 = f * n0, f * n1, f * n2
+    n0, n1, n2 = _samplephase(n0, n1, n2)
+    # and back to the lab frame, see lyamc.kernel._from_com
+    E, n0, n1, n2 = _boost(E, n0, n1, n2, -c0, -c1, -c2)
+    E, n0, n1, n2 = _boost(E, n0, n1, n2, -v0, -v1, -v2)
+    return E * m_hz, min(max(n2, -1.), 1.)
+
+
+@jit(nopython=True)
+def run_photon_reduced(r, mu, x, geom, T_ic, N=10000, core_skip=False):
+    '''
+    Follows one photon in reduced coordinates from emission to escape, see lyamc.kernel.run_photon
+    :param r: initial radius or height in pc
+    :param mu: initial cosine to the radial direction or the normal
+    :return: reduced coordinates of the last scattering, final mu, final frequency, number of scatterings
+    '''
+    nu = get_nu(x, T_ic)
+    i = 0
+    while i < N - 1:
+        d_max = geom.distance_to_boundary(r, mu)
+        d, escaped = geom.tau_distance(nu, r, mu, -np.log(np.random.rand()), d_max)
+        if escaped:
+            break
+        r, mu = geom.move(r, mu, d)
+        T = geom.temperature(r)
+        x_crit = 0.
+        if core_skip:
+            x_crit = get_xcrit(T, geom.density(r), geom.R)
+        nu, mu = scatter_reduced(nu, mu, geom.velocity(r), T, x_crit)
+        i += 1
+    return r, mu, get_x(nu, T_ic), i
+
+
+@jit(nopython=True)
+def _run_photons_reduced(R0, x0, geom, T_ic, N, core_skip, seed, first_id):
+    n = len(R0)
+    p_last = np.zeros((n, 3))
+    k_last = np.zeros((n, 3))
+    x_last = np.zeros(n)
+    i_last = np.zeros(n, dtype=np.int64)
+    for j in range(n):
+        if seed >= 0:
+            np.random.seed(photon_seed(seed, first_id + j))
+        # isotropic emission
+        mu = 2. * np.random.rand() - 1.
+        r, mu, x_last[j], i_last[j] = run_photon_reduced(R0[j], mu, x0, geom, T_ic, N, core_skip)
+        p_last[j], k_last[j] = geom.embed(r, mu)
+    return p_last, k_last, x_last, i_last
+
+
+def run_photons_reduced(geom, nsim, x0=0., N=10000, core_skip=False, seed=None, first_id=0):
+    '''
+    Runs nsim photons with the symmetry-reduced kernel, see lyamc.kernel.run_photons.
+    :param geom: geometry of lyamc.geometry whose reduced() is not None
+    :return: p [nsim,3], k [nsim,3], x [nsim], i [nsim]
+    '''
+    g = geom.reduced() if isinstance(geom, Geometry) else None
+    if g is None:
+        raise ValueError('geometry %s has no symmetry-reduced form' % type(geom).__name__)
+    if seed is None:
+        P = geom.get_ICs(nsim)
+    else:
+        P = np.array([geom.get_IC(photon_rng(seed, first_id + j)) for j in range(nsim)], dtype=float).reshape(-1, 3)
+    R0 = np.array([g.reduce(p) for p in P], dtype=float)
+    T_ic = float(g.temperature(R0[0]))
+    return _run_photons_reduced(R0, float(x0), g, T_ic, N, core_skip, -1 if seed is None else int(seed),
+                                int(first_id))
@@ -0,0 +1,131 @@
+'''
+Per-photon random streams.
+
+Every photon of a run draws from its own stream keyed by (run seed, photon id), so a
+photon's history does not depend on how the photons are distributed over processes
+and any single photon can be re-simulated on its own. The serial engine uses a numpy
+Generator per photon, the compiled kernel reseeds its generator per photon, and the
+batch engine draws from PhotonStreams, counter-based streams evaluated for all photons
+of a batch at once.
+'''
+
+import numpy as np
+from numba import jit, vectorize
+from scipy.special import ndtri
+
+
+def photon_rng(seed, photon_id):
+    '''
+    Counter-based (Philox) generator of one photon
+    :param seed: seed of the run
+    :param photon_id: id of the photon
+    :return: numpy Generator
+    '''
+    return np.random.Generator(np.random.Philox(key=np.array([photon_id, seed], dtype=np.uint64)))
+
+
+@jit(nopython=True)
+def splitmix64(z):
+    '''SplitMix64 finalizer of the 64-bit integer z'''
+    z = np.uint64(z) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+@jit(nopython=True)
+def photon_key(seed, photon_id):
+    '''
+    64-bit key of the stream of one photon
+    :param seed: seed of the run
+    :param photon_id: id of the photon
+    :return: key in [0, 2^64)
+    '''
+    return splitmix64(splitmix64(seed) ^ np.uint64(photon_id))
+
+
+@jit(nopython=True)
+def photon_seed(seed, photon_id):
+    '''
+    32-bit seed of one photon for the generator of the compiled kernel
+    :param seed: seed of the run
+    :param photon_id: id of the photon
+    :return: seed in [0, 2^32)
+    '''
+    return photon_key(seed, photon_id) >> np.uint64(32)
+
+
+@vectorize(['uint64(int64, int64)'])
+def photon_keys(seed, photon_id):
+    '''photon_key for arrays of photon ids'''
+    return photon_key(seed, photon_id)
+
+
+@vectorize(['float64(uint64, uint64)'])
+def counter_uniform(key, counter):
+    '''Uniform number in (0, 1), number counter of the stream key'''
+    return ((splitmix64(key ^ splitmix64(counter)) >> np.uint64(11)) + 0.5) * 2. ** -53
+
+
+class PhotonStreams:
+    '''
+    Random streams of the photons of a batch, for the batched functions that take a numpy
+    Generator (random and normal with the photons along the first axis).
+
+    Row j of every draw is taken from the stream of photon j at counter
+    event * 2^32 + purpose * 2^26 + position, where event is 0 for the emission and the number
+    of the scattering otherwise, purpose separates the draws of different steps within an event
+    and position counts the draws of the purpose. The numbers of a photon therefore do not depend
+    on the other photons of the batch, on the batch size or on how many draws another step made.
+    '''
+
+    def __init__(self, seed, ids, events, purpose=0):
+        '''
+        :param seed: seed of the run
+        :param ids: photon ids [n]
+        :param events: 0 for the emission, number of the scattering otherwise [n] (or scalar)
+        :param purpose: step within the event, < 64
+        '''
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        events = np.broadcast_to(np.asarray(events, dtype=np.uint64), ids.shape)
+        self.key = photon_keys(np.int64(seed), ids)
+        self.base = (events << np.uint64(32)) | np.uint64(purpose << 26)
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.key)
+
+    def __getitem__(self, sel):
+        '''Streams of the photons sel, continuing at the same position'''
+        sub = PhotonStreams.__new__(PhotonStreams)
+        sub.key, sub.base, sub.pos = self.key[sel], self.base[sel], self.pos
+        return sub
+
+    def purpose(self, purpose):
+        '''Streams of the same photons and events for another step'''
+        sub = self[:]
+        sub.base = (self.base & ~np.uint64(2 ** 32 - 1)) | np.uint64(purpose << 26)
+        sub.pos = 0
+        return sub
+
+    def random(self, size=None):
+        '''
+        Uniform numbers in (0, 1)
+        :param size: n or a shape (n, ...), n photons of the streams by default
+        '''
+        shape = (len(self),) if size is None else tuple(np.atleast_1d(size))
+        if shape[0] != len(self):
+            raise ValueError('%d draws for %d photon streams' % (shape[0], len(self)))
+        m = int(np.prod(shape[1:]))
+        counter = self.base.reshape(-1, 1) + np.uint64(self.pos) + np.arange(m, dtype=np.uint64)
+        self.pos += m
+        return counter_uniform(self.key.reshape(-1, 1), counter).reshape(shape)
+
+    def normal(self, loc=0., scale=1., size=None):
+        '''Normal numbers, see random'''
+        return loc + scale * ndtri(self.random(size))
+
+
+def subset(rng, sel):
+    '''Random numbers for the photons sel of a batch: their PhotonStreams, or rng itself if it is shared'''
+    return rng[sel] if isinstance(rng, PhotonStreams) else rng
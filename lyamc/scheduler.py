@@ -0,0 +1,187 @@
+'''
+Work queue for multi-node runs.
+
+The photons of a model are split into small chunks stored in an SQLite database on the
+shared filesystem. Workers claim one chunk at a time, keep it alive with heartbeats
+and mark it done once its photons are written. Chunks whose worker stopped sending
+heartbeats are handed out again, and no chunk is handed out after the deadline.
+Each chunk is written to its own output file and the photons of a chunk are reproducible,
+so a chunk that runs twice overwrites its first result instead of duplicating it, also
+once the first result is in the catalogue (see lyamc.catalogue).
+'''
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from lyamc.general import decodename
+from lyamc.geometry import get_geometry
+from lyamc.kernel import run_photons, seed_kernel
+from lyamc.output import PhotonStore
+from lyamc.transport import run_batch
+
+
+class WorkQueue:
+    '''
+    Chunks of photons in an SQLite database, see the module docstring.
+    '''
+
+    def __init__(self, path, stale=600.):
+        '''
+        :param path: database file
+        :param stale: a running chunk without heartbeat for this many seconds is handed out again
+        '''
+        self.path = path
+        self.stale = stale
+        self.db = sqlite3.connect(path, timeout=120., isolation_level=None)
+
+    @classmethod
+    def create(cls, path, nsim, geometry, params, mode='zm', engine='kernel', chunk_size=100, seed=None,
+               deadline=None, core_skip=False, stale=600.):
+        '''
+        New queue with nsim photons in chunks of chunk_size
+        :param path: database file, must not exist
+        :param geometry: geometry name, see get_geometry
+        :param params: geometry parameters
+        :param mode: parallel velocity mode of the batch engine
+        :param engine: 'kernel' or 'batch'
+        :param seed: seed of the run, random if None; both engines draw from per-photon streams
+        :param deadline: unix time after which no chunk is handed out
+        :param core_skip: skip core scatterings
+        '''
+        if os.path.exists(path):
+            raise IOError('queue %s exists already' % path)
+        if seed is None:
+            seed = np.random.randint(2 ** 31 - 2 ** 24)
+        queue = cls(path, stale)
+        queue.db.executescript('''
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE chunks (id INTEGER PRIMARY KEY, start INTEGER, n INTEGER, seed INTEGER, state TEXT,
+                                 worker TEXT, heartbeat REAL, attempts INTEGER DEFAULT 0);
+            CREATE INDEX chunks_state ON chunks (state);
+        ''')
+        run = {'geometry': geometry, 'params': list(params), 'mode': mode, 'engine': engine,
+               'core_skip': core_skip, 'deadline': deadline, 'seed': int(seed)}
+        queue.db.execute('BEGIN')
+        queue.db.execute('INSERT INTO meta VALUES (?, ?)', ('run', json.dumps(run)))
+        queue.db.executemany('INSERT INTO chunks (id, start, n, seed, state) VALUES (?, ?, ?, ?, ?)',
+                             [(j, start, min(chunk_size, nsim - start), seed + j, 'pending')
+                              for j, start in enumerate(range(0, nsim, chunk_size))])
+        queue.db.execute('COMMIT')
+        return queue
+
+    @property
+    def run(self):
+        '''Description of the run: geometry, params, mode, engine, core_skip, deadline and seed'''
+        return json.loads(self.db.execute("SELECT value FROM meta WHERE key = 'run'").fetchone()[0])
+
+    def claim(self, worker):
+        '''
+        Hands out the next pending chunk, after re-queueing the chunks of dead workers
+        :param worker: name of the worker
+        :return: chunk id, id of its first photon, number of photons and seed of the chunk,
+                 or None if nothing is left or the deadline has passed
+        '''
+        deadline = self.run['deadline']
+        now = time.time()
+        if (deadline is not None) and (now > deadline):
+            return None
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute("UPDATE chunks SET state = 'pending', worker = NULL "
+                            "WHERE state = 'running' AND heartbeat < ?", (now - self.stale,))
+            row = self.db.execute("SELECT id, start, n, seed FROM chunks WHERE state = 'pending' ORDER BY id LIMIT 1"
+                                  ).fetchone()
+            if row is not None:
+                self.db.execute("UPDATE chunks SET state = 'running', worker = ?, heartbeat = ?, "
+                                "attempts = attempts + 1 WHERE id = ?", (worker, now, row[0]))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return row
+
+    def heartbeat(self, worker, chunk):
+        '''Marks the chunk as alive, False if the chunk was taken away from the worker'''
+        cur = self.db.execute("UPDATE chunks SET heartbeat = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                              (time.time(), chunk, worker))
+        return cur.rowcount == 1
+
+    def complete(self, worker, chunk):
+        '''Marks the chunk as done'''
+        self.db.execute("UPDATE chunks SET state = 'done', heartbeat = ? WHERE id = ? AND worker = ?",
+                        (time.time(), chunk, worker))
+
+    def progress(self):
+        '''
+        :return: dict state -> (number of chunks, number of photons)
+        '''
+        return {state: (nchunks, nphotons) for state, nchunks, nphotons in
+                self.db.execute('SELECT state, COUNT(*), SUM(n) FROM chunks GROUP BY state')}
+
+
+def work(path, worker=None, max_time=None, stale=600., outdir='output', verbal=True, poll=None):
+    '''
+    Runs chunks of the queue until all chunks are done, its deadline has passed or max_time is over.
+    While other workers still run chunks the worker waits for them, so that the chunks of a
+    worker that dies are handed out again once they are stale.
+    :param path: database file of the queue
+    :param worker: name of the worker, host:pid if None
+    :param max_time: no new chunk is claimed after this many seconds
+    :param stale: see WorkQueue
+    :param outdir: directory of the output
+    :param poll: seconds between two looks at the queue while waiting, stale / 10 if None
+    :return: number of photons done by this worker
+    '''
+    if worker is None:
+        worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    queue = WorkQueue(path, stale)
+    run = queue.run
+    geom = get_geometry(run['geometry'], run['params'])
+    name = decodename(run['geometry'], run['params'])
+    tag = os.path.splitext(os.path.basename(path))[0]
+    poll = stale / 10. if poll is None else poll
+    start, done = time.time(), 0
+    while (max_time is None) or (time.time() - start < max_time):
+        claimed = queue.claim(worker)
+        if claimed is None:
+            expired = (run['deadline'] is not None) and (time.time() > run['deadline'])
+            if expired or ('running' not in queue.progress()):
+                break
+            time.sleep(poll)
+            continue
+        chunk, first_id, n, seed = claimed
+        # heartbeats from a separate connection while the chunk runs
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(path, stale, worker, chunk, stop), daemon=True)
+        beat.start()
+        try:
+            np.random.seed(seed)
+            seed_kernel(seed)
+            if run['engine'] == 'kernel':
+                p, k, x, i = run_photons(geom, n, core_skip=run['core_skip'], seed=run['seed'], first_id=first_id)
+            else:
+                p, k, x, i = run_batch(geom, n, core_skip=run['core_skip'], mode=run['mode'], verbal=False,
+                                       seed=run['seed'], first_id=first_id)
+        finally:
+            stop.set()
+            beat.join()
+        with PhotonStore(os.path.join(outdir, '%s_%s%06d_%s_last' % (name, tag, chunk, run['mode'])),
+                         chunk_size=n, background=False) as store:
+            store.append(p, k, x, i)
+        queue.complete(worker, chunk)
+        done += n
+        if verbal:
+            print(worker, 'chunk', chunk, 'done,', queue.progress())
+    return done
+
+
+def _heartbeat(path, stale, worker, chunk, stop):
+    queue = WorkQueue(path, stale)
+    while not stop.wait(stale / 4.):
+        queue.heartbeat(worker, chunk)
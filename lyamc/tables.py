@@ -0,0 +1,173 @@
+'''
+Lookup tables for the parallel velocity of the scattering atom.
+
+For a Voigt parameter a the table holds the inverse CDF u(x, p) of
+P(u) ~ exp(-u^2) / ((x - u)^2 + a^2), u in units of vth and x in the frame of the gas.
+Tables for several temperatures are stacked along a log-spaced grid in a,
+built on demand and cached on disk under a hash of their content.
+'''
+
+import hashlib
+import os
+
+import numpy as np
+from numba import jit
+from scipy.special import erf
+
+from lyamc.general import get_a, get_vth
+
+TABLE_VERSION = 1
+
+
+def build_par_velocity_slice(a, x_list, p_list, nu=2000, ntheta=400):
+    '''
+    Inverse CDF of the parallel velocity for one Voigt parameter.
+    :param a: Voigt parameter
+    :param x_list: dimensionless frequencies in the gas frame
+    :param p_list: probabilities
+    :param nu: number of points of the uniform part of the velocity grid
+    :param ntheta: number of points resolving the Lorentzian at u = x
+    :return: table [len(x_list), len(p_list)] of u in units of vth
+    '''
+    theta = np.linspace(-0.5, 0.5, ntheta + 2)[1:-1] * np.pi
+    ltab = np.zeros([len(x_list), len(p_list)])
+    for xi, x in enumerate(x_list):
+        u = np.sort(np.concatenate([np.linspace(-7 + min(x, 0), 7 + max(x, 0), nu), x + a * np.tan(theta)]))
+        f = np.exp(-u ** 2) / ((x - u) ** 2 + a ** 2)
+        cdf = np.concatenate([[0], np.cumsum((f[1:] + f[:-1]) / 2. * np.diff(u))])
+        cdf /= cdf[-1]
+        ltab[xi, :] = np.interp(p_list, cdf, u)
+    return ltab
+
+
+@jit(nopython=True)
+def sample_par_velocity_lookup(x, r, x_list, s_list, p_list, ltab):
+    '''
+    Bilinear inverse-CDF sampling of parallel velocities for arrays of (x, r).
+    For |x| beyond the table the far-wing limit is used: P(u) ~ exp(-(u - 1/x)^2),
+    i.e. u = 1/x + s with r = (erf(s) + 1) / 2.
+    :param x: dimensionless frequencies in the gas frame [n]
+    :param r: uniform random numbers [n]
+    :param x_list: uniform grid in x of the table
+    :param s_list: grid in s, p_list = (erf(s_list) + 1) / 2
+    :param p_list: grid in probability of the table
+    :param ltab: table [len(x_list), len(p_list)]
+    :return: u in units of vth [n]
+    '''
+    n = len(x)
+    u = np.zeros(n)
+    nx = len(x_list)
+    dx = x_list[1] - x_list[0]
+    for j in range(n):
+        ip = min(max(np.searchsorted(p_list, r[j]) - 1, 0), len(p_list) - 2)
+        wp = min(max((r[j] - p_list[ip]) / (p_list[ip + 1] - p_list[ip]), 0.), 1.)
+        if np.abs(x[j]) > x_list[-1]:
+            u[j] = 1. / x[j] + (1. - wp) * s_list[ip] + wp * s_list[ip + 1]
+            continue
+        fx = (x[j] - x_list[0]) / dx
+        ix = min(int(fx), nx - 2)
+        wx = fx - ix
+        u[j] = (1. - wx) * ((1. - wp) * ltab[ix, ip] + wp * ltab[ix, ip + 1]) + \
+               wx * ((1. - wp) * ltab[ix + 1, ip] + wp * ltab[ix + 1, ip + 1])
+    return u
+
+
+class ParVelocityTable:
+    '''
+    3-D (a, x, p) inverse-CDF table of the parallel velocity.
+    Slices are built the first time they are needed and cached in cache_dir;
+    values for a given temperature are interpolated linearly in a between slices.
+    '''
+
+    def __init__(self, x_list=None, s_list=None, la_step=0.05, cache_dir='tables'):
+        '''
+        :param x_list: dimensionless frequencies in the gas frame
+        :param s_list: probabilities are p = (erf(s) + 1) / 2, dense in the tails
+        :param la_step: spacing of the a grid in dex
+        :param cache_dir: directory for the cached slices
+        '''
+        self.x_list = np.linspace(-8., 8., 801) if x_list is None else np.asarray(x_list, dtype=float)
+        self.s_list = np.linspace(-5, 5, 800) if s_list is None else np.asarray(s_list, dtype=float)
+        self.p_list = (erf(self.s_list) + 1.) / 2.
+        self.la_step = la_step
+        self.cache_dir = cache_dir
+        self.slices = {}
+
+    def slice_path(self, ia):
+        '''Cache file for the slice with a = 10^(ia * la_step)'''
+        h = hashlib.sha1()
+        h.update(repr((TABLE_VERSION, ia, self.la_step)).encode())
+        h.update(self.x_list.tobytes())
+        h.update(self.s_list.tobytes())
+        return os.path.join(self.cache_dir, 'par_velocity_%s.npz' % h.hexdigest()[:16])
+
+    def get_slice(self, ia):
+        '''
+        Table for a = 10^(ia * la_step): from memory, from disk or built.
+        :param ia: index on the a grid
+        :return: table [len(x_list), len(p_list)]
+        '''
+        ia = int(ia)
+        if ia not in self.slices:
+            path = self.slice_path(ia)
+            if os.path.exists(path):
+                self.slices[ia] = np.load(path)['ltab']
+            else:
+                ltab = build_par_velocity_slice(10 ** (ia * self.la_step), self.x_list, self.p_list)
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp = path + '.%d.tmp.npz' % os.getpid()
+                np.savez(tmp, ltab=ltab, x_list=self.x_list, s_list=self.s_list, p_list=self.p_list,
+                         a=10 ** (ia * self.la_step))
+                os.replace(tmp, path)
+                self.slices[ia] = ltab
+        return self.slices[ia]
+
+    def get_table(self, a):
+        '''
+        Table for an arbitrary Voigt parameter, linear in a between the two neighbouring slices.
+        :param a: Voigt parameter
+        :return: table [len(x_list), len(p_list)] of u in units of vth
+        '''
+        ia, w = self.a_weight(a)
+        return (1. - w) * self.get_slice(ia) + w * self.get_slice(ia + 1)
+
+    def a_weight(self, a):
+        '''
+        Lower slice index and interpolation weight of the upper slice for Voigt parameter(s) a
+        '''
+        ia = np.floor(np.log10(a) / self.la_step).astype(int)
+        a0, a1 = 10. ** (ia * self.la_step), 10. ** ((ia + 1) * self.la_step)
+        return ia, (a - a0) / (a1 - a0)
+
+    def sample(self, r, x, a):
+        '''
+        Parallel velocities for probabilities r and frequencies x, see sample_par_velocity_lookup.
+        Samples from the two neighbouring slices are blended with the same weights as in get_table,
+        which is identical to sampling the interpolated table.
+        :param r: uniform random numbers
+        :param x: dimensionless frequencies in the gas frame
+        :param a: Voigt parameter(s)
+        :return: u in units of vth
+        '''
+        r, x, a = np.broadcast_arrays(np.asarray(r, dtype=float), np.asarray(x, dtype=float),
+                                      np.asarray(a, dtype=float))
+        shape = x.shape
+        r, x, a = r.reshape(-1), x.reshape(-1), a.reshape(-1)
+        u = np.zeros(len(x))
+        ia, w = self.a_weight(a)
+        for i in np.unique(ia):
+            s = ia == i
+            u0 = sample_par_velocity_lookup(x[s], r[s], self.x_list, self.s_list, self.p_list, self.get_slice(i))
+            u1 = sample_par_velocity_lookup(x[s], r[s], self.x_list, self.s_list, self.p_list, self.get_slice(i + 1))
+            u[s] = (1. - w[s]) * u0 + w[s] * u1
+        return u.reshape(shape)
+
+    def __call__(self, r, x, T):
+        '''
+        Parallel velocity of the atom in km/s, same role as the interp2d table of runner.py
+        :param r: uniform random number(s)
+        :param x: dimensionless frequency in the gas frame
+        :param T: temperature in K
+        :return: velocity in km/s
+        '''
+        return self.sample(r, x, get_a(T)) * get_vth(T)
@@ -2,10 +2,13 @@
 Routines for determining the trajectory of the photon
 '''
 
+import weakref
+
 from scipy.integrate import cumtrapz
 
 from lyamc.atomic import *
 from lyamc.geometry import *
+from lyamc.jitgeometry import adaptive_march
 
 
 def get_trajectory(x, n, d):
@@ -61,3 +64,158 @@ def interp_d(d, sf, q):
     ''' Given the survival function returns the distance traveled before scattering.
     '''
     return np.interp(q, sf[::-1], d[::-1])
+
+
+def get_distance_homogeneous(nu, p, k, geom, q):
+    '''
+    Exact distance sampling for homogeneous static media (geom.homogeneous_static):
+    the photon escapes if tau = -ln(q) exceeds the optical depth n sigma(x) d_b to the
+    boundary, otherwise it scatters at d = tau / (n * sigma(x)).
+    Works for one photon (p, k of shape [3]) or for n photons ([n,3]).
+    :param nu: frequency of the photon(s) in Hz
+    :param p: position(s)
+    :param k: direction(s)
+    :param geom: geometry
+    :param q: uniform random number(s)
+    :return: distance(s) in pc and escape flag(s)
+    '''
+    p2, k2 = np.atleast_2d(p), np.atleast_2d(k)
+    ndens = geom.density(p2)
+    s = sigma(nu, geom.temperature(p2), np.zeros_like(k2), k2)
+    kappa = ndens * s * cm_in_pc
+    tau = -np.log(q)
+    d_b = geom.distance_to_boundary(p2, k2)
+    escaped = tau >= kappa * d_b
+    with np.errstate(divide='ignore'):
+        d = np.where(escaped, d_b, tau / kappa)
+    if np.ndim(p) == 1:
+        return d[0], escaped[0]
+    return d, escaped
+
+
+@jit(nopython=True)
+def _linear_tau_distance_batch(tau_target, d, K, a, x0, x1):
+    n = len(tau_target)
+    res = np.zeros(n)
+    escaped = np.zeros(n, dtype=np.bool_)
+    for j in range(n):
+        res[j], escaped[j] = linear_tau_distance(tau_target[j], d[j], K[j], a[j], x0[j], x1[j])
+    return res, escaped
+
+
+def get_distance_linear(nu, p, k, geom, q):
+    '''
+    Exact distance sampling for uniform media with a velocity linear in position
+    (geom.linear_velocity): x is linear along the ray, so the optical depth is a difference of
+    two values of the cumulative Voigt function and is inverted in closed form,
+    see lyamc.atomic.linear_tau_distance. Uses the tabulated Voigt function (H_table).
+    Works for one photon (p, k of shape [3]) or for n photons ([n,3]).
+    :param nu: frequency of the photon(s) in Hz
+    :param p: position(s)
+    :param k: direction(s)
+    :param geom: geometry
+    :param q: uniform random number(s)
+    :return: distance(s) in pc and escape flag(s)
+    '''
+    p2, k2 = np.atleast_2d(p), np.atleast_2d(k)
+    n = len(p2)
+    nu = np.broadcast_to(np.asarray(nu, dtype=float), (n,))
+    ndens, u0, T = geom.fields(p2)
+    d_b = geom.distance_to_boundary(p2, k2)
+    u1 = geom.velocity(p2 + k2 * d_b.reshape(-1, 1))
+    x0 = get_x(nu * (1. - np.sum(u0 * k2, axis=1) / c), T)
+    x1 = get_x(nu * (1. - np.sum(u1 * k2, axis=1) / c), T)
+    K = 1.045e-13 / np.sqrt(np.pi) * (T / 1e4) ** -0.5 * ndens * cm_in_pc
+    d, escaped = _linear_tau_distance_batch(np.broadcast_to(-np.log(q), (n,)).astype(float), d_b, K,
+                                            4.7e-4 * (T / 1e4) ** -0.5, x0, x1)
+    if np.ndim(p) == 1:
+        return d[0], escaped[0]
+    return d, escaped
+
+
+# ---------------------------------------------------------------------
+# Adaptive ray marching: n photons at once
+# ---------------------------------------------------------------------
+def get_dtaudl_batch(nu, l, k, geom):
+    '''
+    d\tau / dl for l in pc at positions l for photons with directions k
+    :param nu: frequencies of the photons in Hz [m]
+    :param l: positions [m,3]
+    :param k: directions [m,3]
+    :param geom: geometry
+    :return: array [m]
+    '''
+    ndens, u, T = geom.fields(l)
+    return sigma(nu, T, u, k) * ndens * cm_in_pc
+
+
+_compiled = weakref.WeakKeyDictionary()
+
+
+@jit(nopython=True)
+def _march_batch(nu, p, k, tau_target, d_max, geom, rtol, atol):
+    n = len(nu)
+    d = np.zeros(n)
+    escaped = np.zeros(n, dtype=np.bool_)
+    for j in range(n):
+        d[j], escaped[j] = adaptive_march(nu[j], p[j], k[j], tau_target[j], d_max[j], geom, rtol, atol)
+    return d, escaped
+
+
+def march_to_tau_batch(nu, p, k, geom, tau_target, d_max=None, rtol=1e-3, atol=1e-4):
+    '''
+    Integrates d\tau / dl along n rays with the adaptive march of the compiled geometry
+    (lyamc.jitgeometry.adaptive_march) and stops each ray as soon as its target optical depth
+    is reached or it leaves the geometry.
+    :param nu: frequencies of the photons in Hz [n]
+    :param p: positions [n,3]
+    :param k: directions [n,3]
+    :param geom: geometry
+    :param tau_target: optical depths to reach [n], i.e. -ln(q)
+    :param d_max: distances to the boundary [n], geom.distance_to_boundary by default
+    :param rtol: relative tolerance per step
+    :param atol: absolute tolerance in tau per step
+    :return: distances in pc [n] and a mask of photons that escaped
+    '''
+    if hasattr(geom, 'tau_distance'):
+        # piecewise constant geometries integrate the optical depth exactly
+        return geom.tau_distance(nu, p, k, tau_target, d_max)
+    n = len(nu)
+    if d_max is None:
+        d_max = geom.distance_to_boundary(p, k)
+    if geom not in _compiled:
+        _compiled[geom] = geom.kernel()
+    return _march_batch(np.asarray(nu, dtype=float).reshape(-1), np.ascontiguousarray(p, dtype=float).reshape(-1, 3),
+                        np.ascontiguousarray(k, dtype=float).reshape(-1, 3),
+                        np.broadcast_to(tau_target, (n,)).astype(float), np.broadcast_to(d_max, (n,)).astype(float),
+                        _compiled[geom], rtol, atol)
+
+
+def march_to_tau(nu, p, k, geom, tau_target, d_max=None, rtol=1e-3, atol=1e-4):
+    '''
+    Single photon version of march_to_tau_batch.
+    :return: distance in pc and escape flag
+    '''
+    if d_max is not None:
+        d_max = np.array([d_max])
+    d, escaped = march_to_tau_batch(np.array([nu], dtype=float).reshape(-1), np.array(p, dtype=float).reshape(1, 3),
+                                    np.array(k, dtype=float).reshape(1, 3), geom,
+                                    np.array([tau_target], dtype=float).reshape(-1), d_max, rtol, atol)
+    return d[0], escaped[0]
+
+
+def get_distance_batch(nu, p, k, geom, q):
+    '''
+    Draws the distances to the next scattering for n photons at once.
+    :param nu: frequencies of the photons in Hz [n]
+    :param p: positions [n,3]
+    :param k: directions [n,3]
+    :param geom: geometry
+    :param q: uniform random numbers [n]
+    :return: distances in pc [n] and a mask of photons that escaped
+    '''
+    if getattr(geom, 'homogeneous_static', False):
+        return get_distance_homogeneous(nu, p, k, geom, q)
+    elif getattr(geom, 'linear_velocity', False):
+        return get_distance_linear(nu, p, k, geom, q)
+    return march_to_tau_batch(nu, p, k, geom, -np.log(q))
@@ -0,0 +1,176 @@
+'''
+Event-based transport: a batch of photons is kept in structure-of-arrays form
+and all of them are moved together, one scattering per step.
+'''
+
+from lyamc.coordinates import scattering_lab_frame
+from lyamc.redistribution import *
+from lyamc.rng import PhotonStreams, subset
+from lyamc.trajectory import *
+
+m_hz = cons.MHK * cons.K2HZ
+
+
+class PhotonBatch:
+    '''
+    State of n photons: position p [n,3] in pc, direction k [n,3],
+    dimensionless frequency x [n], number of scatterings i [n] and photon id [n].
+    '''
+
+    def __init__(self, p, k, x, i=None, id=None):
+        self.p = np.array(p, dtype=float).reshape(-1, 3)
+        self.k = np.array(k, dtype=float).reshape(-1, 3)
+        self.x = np.array(x, dtype=float).reshape(-1)
+        n = len(self.x)
+        self.i = np.zeros(n, dtype=int) if i is None else np.array(i, dtype=int)
+        self.id = np.arange(n) if id is None else np.array(id, dtype=int)
+
+    def __len__(self):
+        return len(self.x)
+
+    def compact(self, keep):
+        '''
+        Removes photons from the batch.
+        :param keep: boolean mask of photons that stay in the batch
+        :return: PhotonBatch with the removed photons
+        '''
+        out = PhotonBatch(self.p[~keep], self.k[~keep], self.x[~keep], self.i[~keep], self.id[~keep])
+        self.p, self.k, self.x = self.p[keep], self.k[keep], self.x[keep]
+        self.i, self.id = self.i[keep], self.id[keep]
+        return out
+
+
+def emit_batch(geom, n, x=0., seed=None, first_id=0):
+    '''
+    Initial conditions for n photons: geometry IC, isotropic directions and frequency x.
+    :param seed: seed of the run, the photons then draw from their PhotonStreams instead of np.random
+    :param first_id: id of the first photon
+    '''
+    ids = first_id + np.arange(n)
+    rng = np.random if seed is None else PhotonStreams(seed, ids, 0)
+    p = geom.get_ICs(n, rng)
+    k = rng.normal(size=(n, 3))
+    k /= np.sqrt(np.sum(k ** 2, axis=1)).reshape(-1, 1)
+    return PhotonBatch(p, k, np.ones(n) * x, id=ids)
+
+
+def get_par_velocity_batch(x_gas, T, mode='zm', sampler=None, rng=None):
+    '''
+    Parallel velocities of the atoms for n photons
+    :param x_gas: dimensionless frequencies in the gas frame [n]
+    :param T: temperatures [n]
+    :param mode: 'zm' (rejection sampling, sampler is a ZMSampler or None)
+                 or 'lookup' (sampler is a ParVelocityTable)
+    :param rng: numpy Generator, np.random if None, or the PhotonStreams of the photons
+    :return: u in units of vth [n]
+    '''
+    if mode == 'zm':
+        if sampler is None:
+            return get_par_velocity_of_atoms(x_gas, get_a(T), rng)
+        return sampler.sample(x_gas, get_a(T), rng)
+    elif mode == 'lookup':
+        rng = np.random if rng is None else rng
+        return sampler.sample(rng.random(len(x_gas)), x_gas, get_a(T))
+    raise ValueError('mode %s is not supported by the batched engine' % mode)
+
+
+def scatter_batch(batch, geom, T_ic, core_skip=False, mode='zm', sampler=None, seed=None):
+    '''
+    Moves all photons of the batch to their next scattering and scatters them.
+    :param batch: PhotonBatch, modified in place
+    :param geom: geometry
+    :param T_ic: temperature of the dimensionless frequencies x of the batch (as in runner.py), which
+                 therefore stand for the lab-frame frequencies whatever the local temperature
+    :param core_skip: skip core scatterings, x_crit is set by the local a * tau0
+    :param mode: parallel velocity mode, see get_par_velocity_batch
+    :param sampler: ZMSampler or ParVelocityTable, see get_par_velocity_batch
+    :param seed: seed of the run, every photon then draws from its PhotonStreams at the event of
+                 its next scattering instead of from np.random
+    :return: boolean mask of photons that escaped instead of scattering
+    '''
+    n = len(batch)
+    rng = np.random if seed is None else PhotonStreams(seed, batch.id, batch.i + 1)
+    nu = get_nu(x=batch.x, T=T_ic)
+    d_absorbed, escaped = get_distance_batch(nu, batch.p, batch.k, geom, rng.random(n))
+    p_new = batch.p + batch.k * d_absorbed.reshape(-1, 1)
+    ndens, u, T = geom.fields(p_new)
+    escaped |= ndens <= 0
+    s = ~escaped
+    if s.any():
+        p_s, k_s, nu_s = p_new[s], batch.k[s], nu[s]
+        ndens, u, T = ndens[s], u[s], T[s]
+        vth = get_vth(T)
+        # frequency in the frame of the gas
+        x_gas = get_x(nu_s * (1. - np.sum(u * k_s, axis=1) / c), T)
+        x_crit = 0.
+        if core_skip:
+            x_crit = get_xcrit(get_atau0(T, ndens, geom.R))
+        rng_s = subset(rng, s)
+        # the rejection sampler makes a varying number of draws, so the other steps draw from streams of their own
+        rng_par, rng_perp, rng_dir = (rng_s.purpose(j) for j in (1, 2, 3)) if seed is not None else (rng_s,) * 3
+        v_atom = u + (get_par_velocity_batch(x_gas, T, mode, sampler, rng_par) * vth).reshape(-1, 1) * k_s + \
+                 get_perp_velocity_of_atoms(T, k_s, x_gas, x_crit, rng_perp)
+        freqs, k_new = scattering_lab_frame(nu_s / m_hz, k_s, v_atom / c, rng_dir)
+        batch.p[s] = p_s
+        batch.k[s] = k_new
+        batch.x[s] = get_x(freqs * m_hz, T_ic)
+        batch.i[s] += 1
+    return escaped
+
+
+def run_batch(geom, nsim, batch_size=4096, N=10000, core_skip=False, mode='zm', verbal=True, store=None,
+              checkpoint=None, state=None, sampler=None, seed=None, first_id=0):
+    '''
+    Runs nsim photons through the geometry, batch_size photons at a time.
+    The output matches runner.py: position of the last scattering,
+    final direction, final frequency and the number of scatterings.
+    :param geom: geometry
+    :param nsim: number of photons
+    :param batch_size: number of photons moved together
+    :param N: maximum number of scatterings per photon
+    :param core_skip: skip core scatterings, see scatter_batch
+    :param mode: parallel velocity mode, 'zm' or 'lookup'
+    :param store: PhotonStore that receives the photons as soon as they are done
+    :param checkpoint: Checkpointer, the batch is saved whenever it is due (requires store)
+    :param state: checkpoint to resume from, the output then only contains the photons done after it
+    :param sampler: ZMSampler or ParVelocityTable to reuse, a new one if None
+    :param seed: seed of the run; every photon then draws from its own PhotonStreams, so the photons do not
+                 depend on the batch size or on how the run is split, otherwise all photons share np.random
+    :param first_id: id of the first photon
+    :return: p [nsim,3], k [nsim,3], x [nsim], i [nsim]
+    '''
+    T_ic = geom.temperature(geom.get_IC())[0]
+    if sampler is None:
+        sampler = ParVelocityTable() if mode == 'lookup' else ZMSampler()
+    p_last, k_last, x_last, i_last = [], [], [], []
+    emitted = 0
+    batch = PhotonBatch(np.zeros([0, 3]), np.zeros([0, 3]), np.zeros(0))
+    if state is not None:
+        emitted = state['emitted']
+        batch = PhotonBatch(*state['batch'])
+        np.random.set_state(state['rng'])
+    while (emitted < nsim) or (len(batch) > 0):
+        if (checkpoint is not None) and checkpoint.due():
+            checkpoint.save(store, emitted=emitted, batch=(batch.p, batch.k, batch.x, batch.i, batch.id))
+        nnew = min(batch_size - len(batch), nsim - emitted)
+        if nnew > 0:
+            new = emit_batch(geom, nnew, seed=seed, first_id=first_id + emitted)
+            emitted += nnew
+            batch = PhotonBatch(np.concatenate([batch.p, new.p]), np.concatenate([batch.k, new.k]),
+                                np.concatenate([batch.x, new.x]), np.concatenate([batch.i, new.i]),
+                                np.concatenate([batch.id, new.id]))
+        escaped = scatter_batch(batch, geom, T_ic, core_skip, mode, sampler, seed)
+        done = batch.compact(~escaped & (batch.i < N - 1))
+        if verbal and len(done) > 0:
+            print(emitted - len(batch), 'photons done')
+        if store is not None:
+            store.append(done.p, done.k, done.x, done.i)
+        p_last.append(done.p)
+        k_last.append(done.k)
+        x_last.append(done.x)
+        i_last.append(np.array([done.i, done.id]))
+    if len(i_last) == 0:
+        return np.zeros([0, 3]), np.zeros([0, 3]), np.zeros(0), np.zeros(0, dtype=int)
+    order = np.argsort(np.concatenate([t[1] for t in i_last]))
+    return np.concatenate(p_last)[order], np.concatenate(k_last)[order], \
+           np.concatenate(x_last)[order], np.concatenate([t[0] for t in i_last])[order]
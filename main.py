@@ -13,6 +13,9 @@ from lyamc.general import *
 geom = 'Zheng_sphere'
 params = [1., 2e4, 3.24, 0.0, 0.0, 200.0]
 mode = 'integral'
+# 'serial' (runner.py, any mode), 'batch' (lyamc.transport, zm or lookup) or 'kernel' (lyamc.kernel, its own
+# ZM sampler and the tabulated Voigt function, zm only)
+engine = 'serial'
 # geom = 'Neufeld_test'
 # params = [1e4, 10.]
 
@@ -26,15 +29,41 @@ s = """#!/bin/bash
 #SBATCH --error=trash/\%j.err
 #SBATCH --ntasks-per-node=28
 #SBATCH --time=24:00:00
+#SBATCH --requeue
 #SBATCH --export=all
 
 conda activate cfastpm
 
 """
 
-for i in range(N_per_node):
-    s = s + """python runner.py %i %s """ % (N_per_proc, mode) + decodename(geom, params, sep=' ') + """ &
-"""
+# the batch and kernel engines pull chunks from a shared work queue, the serial engine runs fixed photon counts
+if (engine == 'kernel') and (mode != 'zm'):
+    raise ValueError('the kernel engine samples the atom velocities with zm only, not %s' % mode)
+use_queue = engine in ['batch', 'kernel']
+queue = 'queue_' + decodename(geom, params) + '_%s.db' % mode
+
+if use_queue:
+    from lyamc.scheduler import WorkQueue
+
+    if os.path.exists(queue):
+        # a resubmission continues the chunks of the queue that are not done yet
+        run = WorkQueue(queue).run
+        if (run['engine'] != engine) or (run['mode'] != mode):
+            raise ValueError('queue %s was created for engine %s and mode %s' % (queue, run['engine'], run['mode']))
+        print('resuming', queue, WorkQueue(queue).progress())
+    else:
+        WorkQueue.create(queue, N_per_node * N_per_proc * N_nodes, geom, params, mode=mode, engine=engine,
+                         chunk_size=N_per_proc)
+    # workers stop claiming chunks an hour before the time limit
+    for i in range(N_per_node):
+        s = s + """python queue_runner.py work %s --max_time %i &
+""" % (queue, 23 * 3600)
+else:
+    # a requeued job keeps its id and resumes every process from its checkpoint
+    for i in range(N_per_node):
+        s = s + """python runner.py %i %s """ % (N_per_proc, mode) + decodename(geom, params, sep=' ') + \
+            """ --checkpoint checkpoints/${SLURM_JOB_ID}_%i.pkl &
+""" % i
 
 s += """wait
 
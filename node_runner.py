@@ -1,28 +1,36 @@
 import argparse
-import os
-from multiprocessing import Pool
 
-from lyamc.general import *
-
-parser = argparse.ArgumentParser(description='Process some integers.')
-parser.add_argument('N', metavar='geom', type=int, nargs=1,
-                    help='geometry name')
+parser = argparse.ArgumentParser(description='Runs N chunks of photons on one node with a pool of warm workers.')
+parser.add_argument('N', metavar='N', type=int, nargs=1,
+                    help='number of chunks')
 parser.add_argument('geometry', metavar='geom', type=str, nargs=1,
                     help='geometry name')
 parser.add_argument('params', metavar='params', type=float, nargs='+',
-                    help='geometry name')
+                    help='geometry parameters')
+parser.add_argument('--nproc', type=int, default=28,
+                    help='number of workers')
+parser.add_argument('--chunk_size', type=int, default=100,
+                    help='number of photons per chunk')
+parser.add_argument('--engine', type=str, default='kernel', choices=['batch', 'kernel'],
+                    help='engine of the workers, see runner.py')
+parser.add_argument('--mode', type=str, default='zm', choices=['zm', 'lookup'],
+                    help='parallel velocity mode of the batch engine')
+parser.add_argument('--core_skip', action='store_true',
+                    help='skip core scatterings with x_crit set by the local a * tau0')
 
 args = parser.parse_args()
 
-p = Pool(28)
+from lyamc.general import *
+from lyamc.output import PhotonStore
+from lyamc.pool import WarmPool
 
 geom = args.geometry[0]
 params = args.params
-
-
-def f(x):
-    os.system('python runner.py 100 ' + decodename(geom, params, sep=' '))
-    return 0
-
-
-print(p.map(f, np.arange(args.N[0])))
+mode = args.mode if args.engine == 'batch' else 'zm'
+
+# every chunk is written as soon as it is done, so a killed node keeps the finished chunks
+filename = str(np.random.rand())[2:]
+with PhotonStore('output/' + decodename(geom, params) + '_%s_%s_last' % (filename, mode),
+                 chunk_size=args.chunk_size) as store:
+    with WarmPool(geom, params, nproc=args.nproc, engine=args.engine, mode=mode, core_skip=args.core_skip) as pool:
+        pool.run(args.N[0] * args.chunk_size, chunk_size=args.chunk_size, store=store)
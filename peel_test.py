@@ -0,0 +1,42 @@
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from lyamc.catalogue import compact, load_catalogue
+from lyamc.general import decodename
+from lyamc.output import PhotonStore
+
+# The observer spectra of runner.py --peel are written next to the escaped photons. They must not be
+# taken for a shard by the catalogue (lyamc.catalogue) or for a chunk by PhotonStore.resume.
+
+outdir = tempfile.mkdtemp()
+geometry, params, mode = 'Zheng_sphere', ['1e-6', '1e4', '1', '0', '0', '0'], 'zm'
+name = decodename(geometry, [float(p) for p in params])
+
+try:
+    subprocess.check_call([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runner.py'),
+                           '20', mode, geometry] + params + ['--engine', 'kernel', '--peel', '0,0,1', '--seed', '1',
+                                                             '--chunk_size', '10'], cwd=outdir)
+    output = os.path.join(outdir, 'output')
+    peel = glob.glob(os.path.join(output, '*_peel.npz'))
+    assert len(peel) == 1
+    # the first compaction removes the manifest of the store, the second one sees the peel file alone
+    assert compact(name, mode, output) == 20
+    assert compact(name, mode, output) == 20
+    assert len(load_catalogue(name, mode, output)[2]) == 20
+    with np.load(peel[0]) as temp:
+        assert temp['nphot'] == 20
+
+    # a run resumed from a checkpoint after the peel file was written
+    store = PhotonStore(peel[0][:-len('_peel.npz')] + '_last', chunk_size=10, background=False)
+    store.append(np.zeros([5, 3]), np.zeros([5, 3]), np.zeros(5), np.ones(5, dtype=int))
+    PhotonStore.resume(store.state(), background=False).close()
+    assert os.path.exists(peel[0])
+finally:
+    shutil.rmtree(outdir)
+print('the peel output is neither a shard nor a chunk')
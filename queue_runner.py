@@ -0,0 +1,47 @@
+"""
+
+Creates a work queue of photon chunks and runs workers on it, see lyamc.scheduler.
+
+    python queue_runner.py create queue.db 100000 zm Zheng_sphere 1. 2e4 3.24 0. 0. 200.
+    python queue_runner.py work queue.db
+
+"""
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Work queue of photon chunks shared by many workers.')
+sub = parser.add_subparsers(dest='command')
+create = sub.add_parser('create', help='create a queue')
+create.add_argument('queue', type=str, help='database file of the queue')
+create.add_argument('nsim', type=int, help='number of photons')
+create.add_argument('randtype', type=str, help='parallel velocity mode of the batch engine')
+create.add_argument('geometry', type=str, help='geometry name')
+create.add_argument('params', type=float, nargs='+', help='geometry parameters')
+create.add_argument('--engine', type=str, default='kernel', choices=['batch', 'kernel'])
+create.add_argument('--chunk_size', type=int, default=100, help='number of photons per chunk')
+create.add_argument('--hours', type=float, default=None, help='no chunk is handed out after this many hours')
+create.add_argument('--core_skip', action='store_true')
+work = sub.add_parser('work', help='run chunks of a queue')
+work.add_argument('queue', type=str, help='database file of the queue')
+work.add_argument('--max_time', type=float, default=None, help='no new chunk is claimed after this many seconds')
+work.add_argument('--stale', type=float, default=600.,
+                  help='chunks without heartbeat for this many seconds are handed out again')
+status = sub.add_parser('status', help='progress of a queue')
+status.add_argument('queue', type=str, help='database file of the queue')
+
+args = parser.parse_args()
+
+import time
+
+from lyamc.scheduler import WorkQueue, work
+
+if args.command == 'create':
+    deadline = None if args.hours is None else time.time() + args.hours * 3600.
+    WorkQueue.create(args.queue, args.nsim, args.geometry, args.params, mode=args.randtype, engine=args.engine,
+                     chunk_size=args.chunk_size, deadline=deadline, core_skip=args.core_skip)
+elif args.command == 'work':
+    print(work(args.queue, max_time=args.max_time, stale=args.stale), 'photons done')
+elif args.command == 'status':
+    print(WorkQueue(args.queue).progress())
+else:
+    parser.print_help()
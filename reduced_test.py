@@ -0,0 +1,31 @@
+import time
+
+import numpy as np
+from scipy.stats import ks_2samp
+
+from lyamc.geometry import Neufeld_test, Zheng_sphere
+from lyamc.kernel import run_photons
+from lyamc.reduced import run_photons_reduced
+
+# The symmetry-reduced engine (lyamc.reduced) against the 3-D kernel: the spectra, the numbers of
+# scatterings and the escape directions agree, and the reduced scatterings make the engine faster.
+
+cases = [('static sphere', Zheng_sphere(nbar=3e-3, T=1e4, R=1., A=0., V=0., DeltaV=0., IC='center'), 1000),
+         ('expanding sphere', Zheng_sphere(nbar=3e-3, T=1e4, R=1., A=0., V=100., DeltaV=0., IC='center'), 1000),
+         ('slab', Neufeld_test(tau=1e3, T=1e4), 1000)]
+
+for name, geom, nsim in cases:
+    # compile first
+    run_photons(geom, 1, seed=1)
+    run_photons_reduced(geom, 1, seed=1)
+    t0 = time.time()
+    p, k, x, i = run_photons(geom, nsim, seed=2)
+    t_kernel = time.time() - t0
+    t0 = time.time()
+    p_r, k_r, x_r, i_r = run_photons_reduced(geom, nsim, seed=3)
+    t_reduced = time.time() - t0
+    pvalues = [ks_2samp(x, x_r).pvalue, ks_2samp(i, i_r).pvalue, ks_2samp(np.abs(k[:, 2]), np.abs(k_r[:, 2])).pvalue]
+    print('%s: mean scatterings %.1f / %.1f, speed-up %.2f, KS p-values of x, i, |k_z| %.2f %.2f %.2f' %
+          ((name, i.mean(), i_r.mean(), t_kernel / t_reduced) + tuple(pvalues)))
+    assert min(pvalues) > 0.001, 'the reduced engine differs from the kernel for the %s' % name
+print('reduced engine agrees with the kernel')
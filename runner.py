@@ -5,6 +5,7 @@ Main script for running the MC simulation.
 """
 
 import argparse
+from functools import partial
 
 parser = argparse.ArgumentParser(description='Process some integers.')
 parser.add_argument('nsim', metavar='nsim', type=int, nargs=1,
@@ -15,10 +16,46 @@ parser.add_argument('geometry', metavar='geom', type=str, nargs=1,
                     help='geometry name')
 parser.add_argument('params', metavar='params', type=float, nargs='+',
                     help='geometry name')
-
-from scipy import interpolate
+parser.add_argument('--engine', type=str, default='serial', choices=['serial', 'batch', 'kernel', 'reduced'],
+                    help='serial: one photon at a time, batch: all photons moved together (lyamc.transport), '
+                         'kernel: compiled single-photon kernel (lyamc.kernel), reduced: compiled kernel in the '
+                         'reduced coordinates of spherically symmetric and plane-parallel media (lyamc.reduced)')
+parser.add_argument('--batch_size', type=int, default=4096,
+                    help='number of photons moved together by the batch engine')
+parser.add_argument('--core_skip', action='store_true',
+                    help='skip core scatterings with x_crit set by the local a * tau0')
+parser.add_argument('--diffusion', type=float, default=None, metavar='ATAU',
+                    help='kernel engine: replace the core scatterings in homogeneous static regions with a * tau >= '
+                         'ATAU by diffusion steps (lyamc.diffusion), e.g. 1e3; the number of scatterings of the '
+                         'output then counts the explicit ones only')
+parser.add_argument('--peel', type=str, nargs='+', default=None, metavar='X,Y,Z',
+                    help='kernel engine: peel off every scattering toward these observer directions and write their '
+                         'spectra and images to output/<model>_<run>_<mode>_peel.npz next to the '
+                         '<model>_<run>_<mode>_last chunks (lyamc.peeling)')
+parser.add_argument('--cdf_cache_mb', type=float, default=64,
+                    help='memory budget of the CDF cache of the integral mode in MB')
+parser.add_argument('--chunk_size', type=int, default=1000,
+                    help='number of escaped photons per output chunk; the kernel and reduced engines also run '
+                         'the photons in blocks of this size, and their photons reach the output (and the '
+                         'checkpoints) only when a whole block has returned')
+parser.add_argument('--compress', action='store_true',
+                    help='compress the output chunks')
+parser.add_argument('--checkpoint', type=str, default=None,
+                    help='checkpoint file; the run resumes from it if it exists')
+parser.add_argument('--checkpoint_interval', type=float, default=600.,
+                    help='time between checkpoints in seconds')
+parser.add_argument('--seed', type=int, default=None,
+                    help='seed of the run; every photon then draws from its own stream keyed by (seed, photon id)')
+parser.add_argument('--photon', type=int, default=None,
+                    help='re-simulate only the photon with this id (serial engine, requires --seed)')
 
 args = parser.parse_args()
+if (args.photon is not None) and (args.seed is None or args.engine != 'serial'):
+    parser.error('--photon requires --seed and the serial engine')
+if (args.diffusion is not None) and (args.engine != 'kernel'):
+    parser.error('--diffusion requires the kernel engine')
+if (args.peel is not None) and (args.engine != 'kernel' or args.diffusion is not None):
+    parser.error('--peel requires the kernel engine without --diffusion')
 
 nsim = args.nsim[0]
 print(args.geometry)
@@ -27,35 +64,22 @@ from lyamc.redistribution import *
 from lyamc.trajectory import *
 from lyamc.coordinates import *
 from lyamc.cons import *
+from lyamc.transport import run_batch
+from lyamc.kernel import run_photons
+from lyamc.reduced import run_photons_reduced
+from lyamc.diffusion import run_photons_diffusion
+from lyamc.peeling import Observers, run_photons_peeling
+from lyamc.output import PhotonStore
+from lyamc.checkpoint import Checkpointer
+from lyamc.rng import photon_rng
 
 m_hz = 2.2687318181383202e+23
 
-if args.geometry[0] == 'Neufeld_test':
-    geom = Neufeld_test(tau=args.params[0],
-                        T=args.params[1])
-elif args.geometry[0] == 'plane_gradient':
-    geom = plane_gradient(n=args.params[0],
-                          T=args.params[1],
-                          gradV=args.params[2])
-elif args.geometry[0] == 'Zheng_sphere':
-    geom = Zheng_sphere(nbar=args.params[0],
-                        T=args.params[1],
-                        R=args.params[2],
-                        A=args.params[3],
-                        V=args.params[4],
-                        DeltaV=args.params[5],
-                        IC='center')
-else:
-    print('define a proper geometry')
+geom = get_geometry(args.geometry[0], args.params)
 ### Photon parameters:
 
 print('N_HI = ', geom.nbar * cm_in_pc * geom.R)
 
-p_last = []
-k_last = []
-x_last = []
-i_last = []
-
 z_map_list = np.linspace(-geom.R * 10, geom.R * 10, 1000)
 z_map = np.zeros([len(z_map_list) - 1, 3])
 
@@ -167,127 +191,177 @@ z_map = np.zeros([len(z_map_list) - 1, 3])
 
 
 
-p = geom.get_IC()
+# checkpoints of the photons in flight, the output buffer and the random state
+ckpt, state = None, None
+if args.checkpoint is not None:
+    ckpt = Checkpointer(args.checkpoint, args.checkpoint_interval,
+                        run=[nsim, args.randtype, args.geometry, args.params, args.engine, args.core_skip,
+                             args.diffusion, args.peel])
+    state = ckpt.load()
+
+# escaped photons are written in chunks while the simulation runs
+if state is not None:
+    print('resuming from', args.checkpoint)
+    store = PhotonStore.resume(state['store'])
+else:
+    filename = str(np.random.rand())[2:]
+    store = PhotonStore('output/' + decodename(args.geometry[0], args.params) + '_%s_%s_last' % (filename, args.randtype[0]),
+                        chunk_size=args.chunk_size, compress=args.compress)
+
+if args.engine == 'batch':
+    # with a seed every photon draws from its own stream, whatever the batch size
+    run_batch(geom, nsim, batch_size=args.batch_size, core_skip=args.core_skip, mode=args.randtype[0], store=store,
+              checkpoint=ckpt, state=state, seed=args.seed)
+elif args.engine in ['kernel', 'reduced']:
+    # the compiled kernel keeps its own random state; photons are streamed to the store and checkpoints are
+    # taken between blocks of chunk_size photons, so --chunk_size is the streaming granularity here
+    run_chunk = run_photons if args.engine == 'kernel' else run_photons_reduced
+    if args.diffusion is not None:
+        run_chunk = partial(run_photons_diffusion, atau_min=args.diffusion)
+    observers = None
+    if args.peel is not None:
+        observers = Observers([[float(c) for c in d.split(',')] for d in args.peel], size=2 * geom.R)
+        if state is not None:
+            observers.resume(state['peel'])
+        run_chunk = partial(run_photons_peeling, observers=observers)
+    done = 0 if state is None else state['done']
+    while done < nsim:
+        n = min(args.chunk_size, nsim - done)
+        store.append(*run_chunk(geom, n, core_skip=args.core_skip, seed=args.seed, first_id=done))
+        done += n
+        if (ckpt is not None) and ckpt.due():
+            ckpt.save(store, done=done, peel=None if observers is None else observers.state())
+    if observers is not None:
+        # _peel instead of _last: the file is neither a chunk of the store nor a shard of the catalogue
+        observers.save(store.prefix[:-len('_last')] + '_peel.npz')
+else:
+    p = geom.get_IC()
+
+    local_temperature = geom.temperature(p)[0]
 
-local_temperature = geom.temperature(p)
+    # parallel velocity tables, built on demand and cached in tables/
+    f_ltab = ParVelocityTable()
+    cdf_cache.max_bytes = args.cdf_cache_mb * 2 ** 20
 
-a = ALYA / 4 / np.pi / (NULYA * get_vth(local_temperature) / c)
-a_data = np.load('a_%0.10f.npz' % a)
-a_x_list = a_data['x_list']
-a_s_list = a_data['s_list']
-a_p_list = a_data['p_list']
-a_ltab = a_data['ltab']
-f_ltab = interpolate.interp2d(a_p_list, a_x_list, a_ltab, kind='linear', bounds_error=True)
+    # np.random.seed(10)
 
-# np.random.seed(10)
+    iii0, photon = 0, None
+    if state is not None:
+        iii0, photon = state['iii'], state['photon']
 
-for iii in range(nsim):
-    verbal = True
-    p = geom.get_IC()
+    for iii in (range(iii0, nsim) if args.photon is None else [args.photon]):
+        verbal = True
+        # random stream of the photon, the global one without a seed
+        rng = None if args.seed is None else photon_rng(args.seed, iii)
+        rnd = np.random if rng is None else rng
+        p = geom.get_IC(rng)
+
+        local_temperature = geom.temperature(p)[0]
 
-    local_temperature = geom.temperature(p)
-
-    k, temp = random_n([], mode='uniform')  # normal vector
-
-    x = np.random.normal(0, 1)  # * get_vth(local_temperature) / c
-    x = 0
-
-    N = 10000
-
-    p_history = np.zeros([N, 3]) * np.nan
-    p_history[0, :] = p
-
-    k_history = np.zeros([N, 3])
-    k_history[0, :] = k
-
-    x_history = np.zeros(N)
-    x_history[0] = x
-
-    d_absorbed = 0
-    d = np.concatenate([[0], np.logspace(-10, 0, 100)])
-
-    proper_redistribution = True
-
-    i = -1
-    # Loading parallel velocity intepolation table
-    while (d_absorbed < d.max()) & (i < N - 2):
-        d = np.concatenate([[0], np.logspace(-7, 0, 100)])
-        # d = np.linspace()
-        i += 1
-        if verbal:
-            if i % 1000 == 0:
-                print(i, d_absorbed, x, np.sqrt(p[0] ** 2 + p[1] ** 2 + p[2] ** 2))
-        # define initial parameters
-        p = p_history[i, :].copy()  # position
-        k = k_history[i, :].copy()  # direction
-        x = x_history[i].copy()  # dimensionless frequency
-        nu = get_nu(x=x, T=local_temperature)  # frequency
-        # Find the position of new scattering
-        l, d = get_trajectory(p, k, d)  # searching for a trajectory
-        sf = get_survival_function(nu, l, d, k, geom)  # getting surfvival function
-        q = np.random.rand()
-        d_absorbed = interp_d(d, sf, q)  # randomly selecting absorption point
-        while (d_absorbed == d.max()) & (d.max() < geom.R * 2):
-            # print('Expanding!')
-            d *= 2
-            l, d = get_trajectory(p, k, d)  # searching for a trajectory
-            sf = get_survival_function(nu, l, d, k, geom)  # getting surfvival function
-            d_absorbed = interp_d(d, sf, q)
-        while d_absorbed < d[10]:
-            # print('Refining!')
-            d /= 2
-            l, d = get_trajectory(p, k, d)  # searching for a trajectory
-            sf = get_survival_function(nu, l, d, k, geom)  # getting surfvival function
-            d_absorbed = interp_d(d, sf, q)
-        p_new = get_shift(p, k, d_absorbed)  # extracting new position
-        if np.sum(p_new ** 2) < geom.R ** 2:
-            # The environment of new scattering
-            local_velocity_new = geom.velocity(p_new.reshape(1, -1))  # new local velocity
-            local_temperature_new = geom.temperature(p_new.reshape(1, -1))  # new local temperature
-            # selecting a random atom
-            v_atom = local_velocity_new + \
-                     get_par_velocity_of_atom(nu, local_temperature_new, local_velocity_new, k, f_ltab,
-                                              mode=args.randtype[0]) + \
-                     get_perp_velocity_of_atom(nu, local_temperature_new, local_velocity_new, k)
-            # generating new direction and new frequency
-            if proper_redistribution:
-                nu_i = np.array([nu / m_hz])
-                ns = k.reshape(1, -1)
-                vs = v_atom.reshape(1, -1) / c
-                res = scattering_lab_frame(nu_i, ns, vs)
-                x_new = get_x(res[0] * m_hz, local_temperature_new)
-                k_new = res[1]
-                vth = get_vth(local_temperature_new)
-                # print(x_new - x - np.sum(vs * (res[1] - ns), axis=-1)/vth*c)
+        k, temp = random_n([], mode='uniform', rng=rng)  # normal vector
+
+        x = rnd.normal(0, 1)  # * get_vth(local_temperature) / c
+        x = 0
+
+        N = 10000
+
+        p_history = np.zeros([N, 3]) * np.nan
+        p_history[0, :] = p
+
+        k_history = np.zeros([N, 3])
+        k_history[0, :] = k
+
+        x_history = np.zeros(N)
+        x_history[0] = x
+
+        d_absorbed = 0
+        escaped = False
+
+        proper_redistribution = True
+
+        i = -1
+        if photon is not None:
+            # continue the photon that was in flight at the checkpoint
+            i, p_history, k_history, x_history, local_temperature, rng_state = photon
+            if rng is None:
+                np.random.set_state(state['rng'])
+            else:
+                rng.bit_generator.state = rng_state
+            photon = None
+        # Loading parallel velocity intepolation table
+        while (not escaped) and (i < N - 2):
+            if (ckpt is not None) and ckpt.due():
+                ckpt.save(store, iii=iii, photon=(i, p_history, k_history, x_history, local_temperature,
+                                                  None if rng is None else rng.bit_generator.state))
+            i += 1
+            if verbal:
+                if i % 1000 == 0:
+                    print(i, d_absorbed, x, np.sqrt(p[0] ** 2 + p[1] ** 2 + p[2] ** 2))
+            # define initial parameters
+            p = p_history[i, :].copy()  # position
+            k = k_history[i, :].copy()  # direction
+            x = x_history[i].copy()  # dimensionless frequency
+            nu = get_nu(x=x, T=local_temperature)  # frequency
+            # Find the position of new scattering
+            q = rnd.random()
+            if geom.homogeneous_static:
+                # exact sampling, no survival function needed
+                d_absorbed, escaped = get_distance_homogeneous(nu, p, k, geom, q)
+            elif geom.linear_velocity:
+                # x is linear along the ray: closed form from the cumulative Voigt table
+                d_absorbed, escaped = get_distance_linear(nu, p, k, geom, q)
+            else:
+                # adaptive marching up to the target optical depth or the boundary
+                d_absorbed, escaped = march_to_tau(nu, p, k, geom, -np.log(q))
+            p_new = get_shift(p, k, d_absorbed)  # extracting new position
+            if not escaped:
+                # The environment of new scattering
+                local_density_new, local_velocity_new, local_temperature_new = geom.fields(p_new)
+                local_temperature_new = local_temperature_new[0]  # new local temperature
+                x_crit = 0.
+                if args.core_skip:
+                    x_crit = get_xcrit(get_atau0(local_temperature_new, local_density_new, geom.R))
+                # selecting a random atom
+                v_atom = local_velocity_new + \
+                         get_par_velocity_of_atom(nu, local_temperature_new, local_velocity_new, k, f_ltab,
+                                                  mode=args.randtype[0], rng=rng) + \
+                         get_perp_velocity_of_atom(nu, local_temperature_new, local_velocity_new, k, x_crit, rng=rng)
+                # generating new direction and new frequency
+                if proper_redistribution:
+                    nu_i = np.array([nu / m_hz])
+                    ns = k.reshape(1, -1)
+                    vs = v_atom.reshape(1, -1) / c
+                    res = scattering_lab_frame(nu_i, ns, vs, rng)
+                    # x stays relative to the emission temperature, so that it stands for the lab-frame frequency
+                    x_new = get_x(res[0] * m_hz, local_temperature)
+                    k_new = res[1]
+                    vth = get_vth(local_temperature_new)
+                    # print(x_new - x - np.sum(vs * (res[1] - ns), axis=-1)/vth*c)
+                else:
+                    k_new, mu = random_n(k, rng=rng)  # , mode='uniform')  # new direction
+                    # print(k, k_new)
+                    x_new_in = get_x(nu, local_temperature)
+                    x_new = get_xout(xin=x_new_in,
+                                     v=v_atom,
+                                     kin=k,
+                                     kout=k_new,
+                                     mu=mu,
+                                     T=local_temperature)
+                # recording data into arrays
+                p_history[i + 1, :] = p_new
+                k_history[i + 1, :] = k_new
+                x_history[i + 1] = x_new
             else:
-                k_new, mu = random_n(k)  # , mode='uniform')  # new direction
-                # print(k, k_new)
-                x_new_in = get_x(nu, local_temperature_new)
-                x_new = get_xout(xin=x_new_in,
-                                 v=v_atom,
-                                 kin=k,
-                                 kout=k_new,
-                                 mu=mu,
-                                 T=local_temperature)
-            # recording data into arrays
-            p_history[i + 1, :] = p_new
-            k_history[i + 1, :] = k_new
-            x_history[i + 1] = x_new
-        else:
-            i = i - 1
-    print(i)
-    # filename = str(np.random.rand())[2:]
-    # np.savez('output/' + decodename(args.geometry[0], args.params) + '_%s.npz' % filename, p=p_history[:i + 2],
-    #          k=k_history[:i + 2], x=x_history[:i + 2])
-    # i, p_history, k_history, x_history = simulation(geom)
-    p_last.append(p_history[i + 1, :])
-    k_last.append(k_history[i + 1, :])
-    x_last.append(x_history[i + 1])
-    i_last.append(i + 1)
-
-filename = str(np.random.rand())[2:]
-np.savez('output/' + decodename(args.geometry[0], args.params) + '_%s_%s_last.npz' % (filename, args.randtype[0]),
-         p=p_last,
-         k=k_last,
-         x=x_last,
-         i=i_last)
+                i = i - 1
+        print(i)
+        # filename = str(np.random.rand())[2:]
+        # np.savez('output/' + decodename(args.geometry[0], args.params) + '_%s.npz' % filename, p=p_history[:i + 2],
+        #          k=k_history[:i + 2], x=x_history[:i + 2])
+        # i, p_history, k_history, x_history = simulation(geom)
+        store.append(p_history[i + 1, :], k_history[i + 1, :], x_history[i + 1], i + 1)
+    if args.randtype[0] == 'integral':
+        print('CDF cache: %d entries, hit rate %.3f' % (len(cdf_cache), cdf_cache.hit_rate))
+
+store.close()
+if ckpt is not None:
+    ckpt.clear()
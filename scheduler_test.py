@@ -0,0 +1,34 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from lyamc.catalogue import compact, load_catalogue
+from lyamc.general import decodename
+from lyamc.scheduler import WorkQueue, work
+
+# A chunk of a work queue (lyamc.scheduler) that runs twice, here once more after its first result
+# went into the catalogue, must not add its photons twice: the rerun is bit-identical and replaces
+# the rows of the first run.
+
+outdir = tempfile.mkdtemp()
+geometry, params, mode = 'Zheng_sphere', [1e-6, 1e4, 1., 0., 0., 0.], 'zm'
+name = decodename(geometry, params)
+path = os.path.join(outdir, 'queue.db')
+
+try:
+    queue = WorkQueue.create(path, 40, geometry, params, mode=mode, engine='kernel', chunk_size=10, seed=5)
+    assert work(path, outdir=outdir, verbal=False) == 40
+    assert compact(name, mode, outdir) == 40
+    first = np.sort(load_catalogue(name, mode, outdir, mmap=False)[2])
+
+    # chunk 2 is handed out again, as if its worker had stopped sending heartbeats
+    queue.db.execute("UPDATE chunks SET state = 'pending' WHERE id = 2")
+    assert work(path, outdir=outdir, verbal=False) == 10
+    assert compact(name, mode, outdir) == 40
+    again = np.sort(load_catalogue(name, mode, outdir, mmap=False)[2])
+    assert np.array_equal(first, again), 'the requeued chunk changed the catalogue'
+finally:
+    shutil.rmtree(outdir)
+print('a chunk that runs twice is in the catalogue once')
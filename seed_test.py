@@ -0,0 +1,24 @@
+import numpy as np
+
+from lyamc.geometry import Zheng_sphere
+from lyamc.transport import run_batch
+
+# With a seed, every photon of the batch engine draws from its own stream keyed by (seed, photon id)
+# (lyamc.rng.PhotonStreams): the photons must not depend on the batch size, on how the run is split
+# into chunks or on the state of np.random.
+
+geom = Zheng_sphere(nbar=1e-3, T=1e4, R=1., A=0.3, V=50., DeltaV=0., IC='uniform')
+nsim = 300
+
+for core_skip in [False, True]:
+    ref = run_batch(geom, nsim, batch_size=4096, seed=7, core_skip=core_skip, verbal=False)
+    np.random.seed(3)
+    small = run_batch(geom, nsim, batch_size=17, seed=7, core_skip=core_skip, verbal=False)
+    split = [np.concatenate(c) for c in
+             zip(run_batch(geom, 120, batch_size=50, seed=7, core_skip=core_skip, verbal=False),
+                 run_batch(geom, nsim - 120, batch_size=64, seed=7, first_id=120, core_skip=core_skip, verbal=False))]
+    print('core_skip', core_skip, 'mean scatterings %.1f' % ref[3].mean())
+    for name, run in [('batch size', small), ('split', split)]:
+        assert all(np.array_equal(a, b) for a, b in zip(ref, run)), 'the photons depend on the %s' % name
+assert not np.array_equal(ref[2], run_batch(geom, nsim, seed=8, verbal=False)[2])
+print('batch photons are reproducible per photon')
@@ -0,0 +1,44 @@
+import numpy as np
+
+from lyamc.diffusion import run_photons_diffusion
+from lyamc.general import get_vth
+from lyamc.geometry import Cartesian_grid
+from lyamc.kernel import run_photons
+from lyamc.peeling import Observers, run_photons_peeling
+from lyamc.transport import emit_batch, scatter_batch
+
+# The engines carry the lab-frame frequency between scatterings. In a static grid with two
+# temperatures, photons emitted at line offset x0 in a hot empty cell scatter on the atoms of a
+# cold cell, which are nearly at rest: the lab-frame frequency, i.e. x relative to the emission
+# temperature, is then kept up to the thermal jitter of the cold atoms. Keeping x relative to the
+# local temperature instead rescales the offset by vth(T_hot) / vth(T_cold) = 100 at every scattering.
+
+T_hot, T_cold = 1e4, 1.
+x0 = 5.
+nsim = 200
+
+density = np.array([0., 100.]).reshape(2, 1, 1)
+temperature = np.array([T_hot, T_cold]).reshape(2, 1, 1)
+geom = Cartesian_grid(density, np.zeros((2, 1, 1, 3)), temperature, L=[2., 1., 1.], IC=[-0.5, 0., 0.])
+
+# thermal jitter of x per scattering on the cold atoms, in units of the hot Doppler width
+jitter = get_vth(T_cold) / get_vth(T_hot)
+
+runs = {'kernel': run_photons(geom, nsim, x0=x0, seed=1),
+        'diffusion': run_photons_diffusion(geom, nsim, x0=x0, seed=1),
+        'peeling': run_photons_peeling(geom, nsim, Observers([[1., 0., 0.]]), x0=x0, seed=1)}
+
+# the batch engine, photons leave the batch once they escape
+np.random.seed(1)
+batch = emit_batch(geom, nsim, x=x0)
+done = []
+while len(batch) > 0:
+    done.append(batch.compact(~scatter_batch(batch, geom, T_hot)))
+runs['batch'] = (None, None, np.concatenate([d.x for d in done]), np.concatenate([d.i for d in done]))
+
+for name, (p, k, x, i) in runs.items():
+    dev = np.abs(x - x0) / (jitter * np.sqrt(np.maximum(i, 1)))
+    print(name, 'mean scatterings %.1f' % i.mean(), 'max |x - x0| / (jitter sqrt(i)) %.2f' % dev.max())
+    assert dev.max() < 10, 'x of %s is not kept in the lab frame' % name
+    assert i.mean() > 1
+print('lab-frame frequency conserved on atoms at rest')